@@ -0,0 +1,201 @@
+import os
+import threading
+import time
+
+from app.hashes import HASH_TYPES
+from app.lists import LIST_TYPES
+from app.resp import RequestParser, encode_command
+from app.stream import MIN_ID, Stream, format_id
+from app.strings import string_bytes
+
+# Rewritten lists, hashes and streams are split into commands of this many items
+REWRITE_ITEMS_PER_COMMAND = 64
+
+READ_CHUNK = 4 << 20
+
+
+class AppendOnlyFile:
+    """Log of write commands in RESP form, flushed by group commit.
+
+    Writers append() the commands they executed. Before replies go out,
+    commit() writes everything appended so far with a single write() and,
+    under appendfsync always, a single fsync(): whoever gets io_lock does
+    the I/O for every command appended up to then, so clients that commit
+    at the same time share one fsync. Under everysec a background thread
+    fsyncs once a second; under no the kernel decides.
+
+    While a rewrite is running, appended commands are also kept in
+    rewrite_buffer, to be added to the rewritten file before it replaces
+    the current one.
+    """
+
+    def __init__(self, path, fsync):
+        self.path = path
+        self.fsync = fsync
+        self.file = open(path, "ab")
+        # Guards buffer and the counters below
+        self.lock = threading.Lock()
+        # Held by whoever is writing or fsyncing the file
+        self.io_lock = threading.Lock()
+        self.buffer = []
+        # Commands appended, written to the file and known to be on disk
+        self.appended = 0
+        self.written = 0
+        self.synced = 0
+        self.rewrite_buffer = None
+        threading.Thread(target=self.__fsync_every_second, daemon=True).start()
+
+    def append(self, args):
+        data = encode_command(args)
+        with self.lock:
+            self.buffer.append(data)
+            self.appended += 1
+            if self.rewrite_buffer is not None:
+                self.rewrite_buffer.append(data)
+
+    def commit(self):
+        """Write out every command appended so far, and fsync it under appendfsync always"""
+        target = self.appended
+        if self.__done() >= target:
+            return
+        with self.io_lock:
+            # The previous holder may have covered these commands already
+            if self.__done() >= target:
+                return
+            self.__write()
+            if self.fsync == "always":
+                os.fsync(self.file.fileno())
+                self.synced = self.written
+
+    def start_rewrite(self):
+        """Start collecting the commands a rewrite must add; the caller holds every shard lock"""
+        with self.lock:
+            self.rewrite_buffer = []
+
+    def abort_rewrite(self):
+        with self.lock:
+            self.rewrite_buffer = None
+
+    def finish_rewrite(self, temp_path):
+        """Complete temp_path with the commands logged since the rewrite began and switch to it"""
+        with self.io_lock, self.lock:
+            with open(temp_path, "ab") as file:
+                file.write(b"".join(self.rewrite_buffer))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+            self.file.close()
+            self.file = open(self.path, "ab")
+            # Everything still buffered is in the rewrite buffer, now on disk
+            self.buffer.clear()
+            self.written = self.synced = self.appended
+            self.rewrite_buffer = None
+
+    def __done(self):
+        return self.synced if self.fsync == "always" else self.written
+
+    def __write(self):
+        """Write the buffered commands; the caller holds io_lock"""
+        with self.lock:
+            data = b"".join(self.buffer)
+            self.buffer.clear()
+            appended = self.appended
+        self.file.write(data)
+        self.file.flush()
+        self.written = appended
+
+    def __fsync_every_second(self):
+        while True:
+            time.sleep(1)
+            if self.fsync != "everysec" or self.synced >= self.appended:
+                continue
+            with self.io_lock:
+                self.__write()
+                fd = self.file.fileno()
+                written = self.written
+            # Clients keep writing while the disk catches up
+            os.fsync(fd)
+            self.synced = max(self.synced, written)
+
+
+def rewrite_aof(path, entries):
+    """Write the shortest command log that rebuilds entries, (key, value, expire ms or None)"""
+    with open(path, "wb", buffering=1 << 20) as file:
+        write = file.write
+        for key, value, expire in entries:
+            if isinstance(value, LIST_TYPES):
+                items = list(value)
+                for i in range(0, len(items), REWRITE_ITEMS_PER_COMMAND):
+                    write(encode_command([b"RPUSH", key] + items[i:i + REWRITE_ITEMS_PER_COMMAND]))
+            elif isinstance(value, HASH_TYPES):
+                items = value.items()
+                for i in range(0, len(items), REWRITE_ITEMS_PER_COMMAND):
+                    write(encode_command([b"HSET", key] + [item for pair in items[i:i + REWRITE_ITEMS_PER_COMMAND] for item in pair]))
+            elif isinstance(value, Stream):
+                rewrite_stream(write, key, value)
+                rewrite_groups(write, key, value.groups)
+            else:
+                write(encode_command([b"SET", key, string_bytes(value)]))
+            if expire is not None:
+                write(encode_command([b"PEXPIREAT", key, b"%d" % expire]))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def rewrite_stream(write, key, stream):
+    for entry_id, fields in stream.entries():
+        write(encode_command([b"XADD", key, format_id(entry_id)] + fields))
+    last_id = format_id(stream.last_id)
+    if not stream:
+        # XADD can't make an empty stream, so add an entry and trim it straight away
+        write(encode_command([b"XADD", key, b"MAXLEN", b"0", last_id if stream.last_id != MIN_ID else b"0-1", b"", b""]))
+    if stream.top_id() != stream.last_id:
+        # Deleted or trimmed entries still count towards the IDs new ones may get
+        write(encode_command([b"XSETID", key, last_id]))
+
+
+def rewrite_groups(write, key, groups):
+    """XGROUP and XCLAIM commands rebuilding a stream's groups, consumers and pending entries"""
+    for name, group in groups.items():
+        last_id = format_id(group.last_id)
+        write(encode_command([b"XGROUP", b"CREATE", key, name, last_id, b"MKSTREAM"]))
+        for consumer in group.consumers.values():
+            write(encode_command([b"XGROUP", b"CREATECONSUMER", key, name, consumer.name]))
+            for entry_id in consumer.pending_ids.scan():
+                entry = consumer.pending[entry_id]
+                write(encode_command([
+                    b"XCLAIM", key, name, consumer.name, b"0", format_id(entry_id),
+                    b"TIME", b"%d" % entry.delivery_time, b"RETRYCOUNT", b"%d" % entry.delivery_count,
+                    b"FORCE", b"JUSTID",
+                ]))
+
+
+def replay_aof(path, execute):
+    """Feed every command in the AOF at path to execute(args).
+
+    A command cut short by a crash mid-write is dropped and the file
+    truncated before it, as Redis does with aof-load-truncated. Returns
+    the number of commands replayed.
+    """
+    parser = RequestParser()
+    count = 0
+    size = 0
+    with open(path, "rb", buffering=0) as file:
+        while True:
+            data = file.read(READ_CHUNK)
+            if not data:
+                break
+            size += len(data)
+            parser.feed(data)
+            for args in parser.commands():
+                execute(args)
+                count += 1
+    incomplete = len(parser.buffer)
+    if parser.args is not None:
+        # Bytes of the partial command the parser already consumed
+        incomplete += len(b"*%d\r\n" % (len(parser.args) + parser.remaining))
+        incomplete += sum(len(b"$%d\r\n" % len(arg)) + len(arg) + 2 for arg in parser.args)
+    if incomplete:
+        print(f"AOF ends with an incomplete command, truncating {incomplete} bytes")
+        os.truncate(path, size - incomplete)
+    return count
@@ -0,0 +1,134 @@
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+
+class Waiter:
+    """A client blocked on one or more keys.
+
+    retry(key) is called by the writer that changed key, while it still
+    holds key's shard lock, and returns the reply for the client built
+    from that key alone, or None if there is still nothing for it. Only
+    looking at key keeps the writer from locking any other shard. A
+    consuming waiter (BLPOP) takes what it is served, so once one of them
+    misses on a key every waiter queued behind it would miss too.
+    timeout_reply is sent once the deadline passes, or called for the
+    reply if it is a function.
+    """
+
+    def __init__(self, connection, keys, retry, deadline, timeout_reply, consumes):
+        self.connection = connection
+        # BLPOP k k 0 waits on k once
+        self.keys = list(dict.fromkeys(keys))
+        self.retry = retry
+        self.deadline = deadline
+        self.timeout_reply = timeout_reply
+        self.consumes = consumes
+        self.done = False
+
+
+class BlockingRegistry:
+    """Clients blocked on keys, woken per key in FIFO order.
+
+    Writers call wake(key) after changing a key, with its shard still
+    locked, which only retries the clients waiting on that key. lock is
+    always taken after shard locks, never before. Every timeout lives in one heap, drained
+    either by the event loop or by a single timer thread in thread mode.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> FIFO of waiters, plus how many of them are still blocked;
+        # finished waiters are dropped lazily
+        self.waiters = {}
+        self.live = {}
+        self.timers = []
+        self.counter = itertools.count()
+        self.timer_changed = threading.Condition(self.lock)
+
+    def block(self, connection, keys, retry, deadline, timeout_reply, consumes=False):
+        """Register a waiter; the caller must hold the shard locks of keys"""
+        waiter = Waiter(connection, keys, retry, deadline, timeout_reply, consumes)
+        with self.lock:
+            for key in waiter.keys:
+                self.waiters.setdefault(key, collections.deque()).append(waiter)
+                self.live[key] = self.live.get(key, 0) + 1
+            if deadline is not None:
+                earliest = not self.timers or deadline < self.timers[0][0]
+                heapq.heappush(self.timers, (deadline, next(self.counter), waiter))
+                if earliest:
+                    self.timer_changed.notify()
+        return waiter
+
+    def wake(self, key):
+        """Serve the clients blocked on key, oldest first"""
+        if key not in self.waiters:
+            return
+        with self.lock:
+            queue = self.waiters.get(key)
+            if queue is None:
+                return
+            for waiter in list(queue):
+                if waiter.done:
+                    continue
+                response = waiter.retry(key)
+                if response is None:
+                    if waiter.consumes:
+                        break
+                    continue
+                self.__finish(waiter, response)
+
+    def cancel(self, waiter):
+        with self.lock:
+            self.__discard(waiter)
+
+    def next_deadline(self):
+        with self.lock:
+            while self.timers and self.timers[0][2].done:
+                heapq.heappop(self.timers)
+            return self.timers[0][0] if self.timers else None
+
+    def expire(self, now):
+        """Send the timeout reply to every waiter whose deadline has passed"""
+        with self.lock:
+            self.__expire(now)
+
+    def run_timers(self):
+        """Timer thread body for the thread-per-connection server"""
+        with self.lock:
+            while True:
+                self.__expire(time.time())
+                timeout = self.timers[0][0] - time.time() if self.timers else None
+                self.timer_changed.wait(timeout)
+
+    def __expire(self, now):
+        timers = self.timers
+        while timers and (timers[0][2].done or timers[0][0] <= now):
+            _, _, waiter = heapq.heappop(timers)
+            if not waiter.done:
+                reply = waiter.timeout_reply
+                self.__finish(waiter, reply() if callable(reply) else reply)
+
+    def __finish(self, waiter, response):
+        self.__discard(waiter)
+        waiter.connection.unblock(response)
+
+    def __discard(self, waiter):
+        if waiter.done:
+            return
+        waiter.done = True
+        for key in waiter.keys:
+            live = self.live[key] - 1
+            if live == 0:
+                del self.waiters[key]
+                del self.live[key]
+                continue
+            self.live[key] = live
+            queue = self.waiters[key]
+            while queue and queue[0].done:
+                queue.popleft()
+            # Compact once finished waiters make up most of the queue
+            if len(queue) > 2 * live:
+                self.waiters[key] = collections.deque(other for other in queue if not other.done)
@@ -0,0 +1,139 @@
+# Enough histogram slots for any duration below 2**63 microseconds
+LATENCY_BUCKETS = 64
+
+
+class Command:
+    """Entry of the command table.
+
+    Arity follows the Redis convention: it counts the command name itself,
+    and a negative arity -N means "at least N arguments". The call
+    counters are updated by Handler.dispatch without a lock, so in thread
+    mode a concurrent update may occasionally be lost.
+    """
+
+    def __init__(self, name, handler, arity, flags, first_key, last_key, step):
+        self.name = name
+        self.handler = handler
+        self.arity = arity
+        self.flags = flags
+        self.first_key = first_key
+        self.last_key = last_key
+        self.step = step
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.calls = 0
+        self.duration_ns = 0
+        # Calls by latency: slot i counts those under 2**i microseconds
+        self.histogram = [0] * LATENCY_BUCKETS
+
+    def check_arity(self, argc):
+        if self.arity >= 0:
+            return argc == self.arity
+        return argc >= -self.arity
+
+    def keys(self, args):
+        """The key arguments of a call; a negative last key counts from the end"""
+        if "movablekeys" in self.flags:
+            return MOVABLE_KEYS[self.name](args)
+        if self.first_key == 0:
+            return []
+        last_key = self.last_key if self.last_key >= 0 else len(args) + self.last_key
+        return args[self.first_key:last_key + 1:self.step]
+
+
+def xread_keys(args):
+    """XREAD ... STREAMS key [key ...] id [id ...]"""
+    for i in range(1, len(args)):
+        if args[i].upper() == b"STREAMS":
+            streams = args[i + 1:]
+            return streams[:len(streams) // 2]
+    return []
+
+
+# Key finders for commands whose key positions depend on their arguments
+MOVABLE_KEYS = {
+    "xread": xread_keys,
+    "xreadgroup": xread_keys,
+}
+
+
+# name, handler method, arity, flags, first key, last key, key step
+COMMAND_SPECS = [
+    ("ping", "handle_ping", -1, ["fast"], 0, 0, 0),
+    ("echo", "handle_echo", 2, ["fast"], 0, 0, 0),
+    ("command", "handle_command", -1, ["loading", "stale"], 0, 0, 0),
+    ("config", "handle_config", -2, ["admin", "noscript", "loading", "stale"], 0, 0, 0),
+    ("save", "handle_save", 1, ["admin", "noscript"], 0, 0, 0),
+    ("bgsave", "handle_bgsave", -1, ["admin", "noscript"], 0, 0, 0),
+    ("lastsave", "handle_lastsave", 1, ["random", "fast"], 0, 0, 0),
+    ("bgrewriteaof", "handle_bgrewriteaof", 1, ["admin", "noscript"], 0, 0, 0),
+    ("info", "handle_info", -1, ["random", "loading", "stale"], 0, 0, 0),
+    ("slowlog", "handle_slowlog", -2, ["admin", "random", "loading", "stale"], 0, 0, 0),
+    ("latency", "handle_latency", -2, ["admin", "noscript", "loading", "stale"], 0, 0, 0),
+    ("replicaof", "handle_replicaof", 3, ["admin", "noscript", "stale"], 0, 0, 0),
+    ("replconf", "handle_replconf", -1, ["admin", "noscript", "loading", "stale"], 0, 0, 0),
+    ("psync", "handle_psync", -3, ["admin", "noscript"], 0, 0, 0),
+    ("wait", "handle_wait", 3, ["noscript"], 0, 0, 0),
+    ("set", "handle_set", -3, ["write", "denyoom"], 1, 1, 1),
+    ("get", "handle_get", 2, ["readonly", "fast"], 1, 1, 1),
+    ("mget", "handle_mget", -2, ["readonly", "fast"], 1, -1, 1),
+    ("mset", "handle_mset", -3, ["write", "denyoom"], 1, -1, 2),
+    ("msetnx", "handle_msetnx", -3, ["write", "denyoom"], 1, -1, 2),
+    ("incr", "handle_incr", 2, ["write", "denyoom", "fast"], 1, 1, 1),
+    ("decr", "handle_decr", 2, ["write", "denyoom", "fast"], 1, 1, 1),
+    ("incrby", "handle_incrby", 3, ["write", "denyoom", "fast"], 1, 1, 1),
+    ("decrby", "handle_decrby", 3, ["write", "denyoom", "fast"], 1, 1, 1),
+    ("incrbyfloat", "handle_incrbyfloat", 3, ["write", "denyoom", "fast"], 1, 1, 1),
+    ("del", "handle_del", -2, ["write"], 1, -1, 1),
+    ("unlink", "handle_unlink", -2, ["write", "fast"], 1, -1, 1),
+    ("exists", "handle_exists", -2, ["readonly", "fast"], 1, -1, 1),
+    ("scan", "handle_scan", -2, ["readonly"], 0, 0, 0),
+    ("keys", "handle_keys", 2, ["readonly"], 0, 0, 0),
+    ("dbsize", "handle_dbsize", 1, ["readonly", "fast"], 0, 0, 0),
+    ("type", "handle_type", 2, ["readonly", "fast"], 1, 1, 1),
+    ("object", "handle_object", -2, ["readonly", "random"], 2, 2, 1),
+    ("expire", "handle_expire", -3, ["write", "fast"], 1, 1, 1),
+    ("pexpire", "handle_pexpire", -3, ["write", "fast"], 1, 1, 1),
+    ("expireat", "handle_expireat", -3, ["write", "fast"], 1, 1, 1),
+    ("pexpireat", "handle_pexpireat", -3, ["write", "fast"], 1, 1, 1),
+    ("ttl", "handle_ttl", 2, ["readonly", "fast"], 1, 1, 1),
+    ("pttl", "handle_pttl", 2, ["readonly", "fast"], 1, 1, 1),
+    ("persist", "handle_persist", 2, ["write", "fast"], 1, 1, 1),
+    ("rpush", "handle_rpush", -3, ["write", "denyoom", "fast"], 1, 1, 1),
+    ("lpush", "handle_lpush", -3, ["write", "denyoom", "fast"], 1, 1, 1),
+    ("lrange", "handle_lrange", 4, ["readonly"], 1, 1, 1),
+    ("llen", "handle_llen", 2, ["readonly", "fast"], 1, 1, 1),
+    ("lpop", "handle_lpop", -2, ["write", "fast"], 1, 1, 1),
+    ("blpop", "handle_blpop", -3, ["write", "blocking"], 1, -2, 1),
+    ("hset", "handle_hset", -4, ["write", "denyoom", "fast"], 1, 1, 1),
+    ("hget", "handle_hget", 3, ["readonly", "fast"], 1, 1, 1),
+    ("hmget", "handle_hmget", -3, ["readonly", "fast"], 1, 1, 1),
+    ("hgetall", "handle_hgetall", 2, ["readonly", "random"], 1, 1, 1),
+    ("hdel", "handle_hdel", -3, ["write", "fast"], 1, 1, 1),
+    ("hlen", "handle_hlen", 2, ["readonly", "fast"], 1, 1, 1),
+    ("hincrby", "handle_hincrby", 4, ["write", "denyoom", "fast"], 1, 1, 1),
+    ("hscan", "handle_hscan", -3, ["readonly", "random"], 1, 1, 1),
+    ("xadd", "handle_xadd", -5, ["write", "denyoom", "fast"], 1, 1, 1),
+    ("xtrim", "handle_xtrim", -4, ["write"], 1, 1, 1),
+    ("xdel", "handle_xdel", -3, ["write", "fast"], 1, 1, 1),
+    ("xlen", "handle_xlen", 2, ["readonly", "fast"], 1, 1, 1),
+    ("xsetid", "handle_xsetid", 3, ["write", "denyoom", "fast"], 1, 1, 1),
+    ("xrange", "handle_xrange", -4, ["readonly"], 1, 1, 1),
+    ("xrevrange", "handle_xrevrange", -4, ["readonly"], 1, 1, 1),
+    ("xread", "handle_xread", -4, ["readonly", "blocking", "movablekeys"], 0, 0, 0),
+    ("xgroup", "handle_xgroup", -2, ["write"], 2, 2, 1),
+    ("xreadgroup", "handle_xreadgroup", -7, ["write", "blocking", "movablekeys"], 0, 0, 0),
+    ("xack", "handle_xack", -4, ["write", "fast"], 1, 1, 1),
+    ("xpending", "handle_xpending", -3, ["readonly"], 1, 1, 1),
+    ("xclaim", "handle_xclaim", -6, ["write", "fast"], 1, 1, 1),
+    ("xautoclaim", "handle_xautoclaim", -6, ["write", "fast"], 1, 1, 1),
+]
+
+
+def build_command_table(target):
+    """Bind COMMAND_SPECS to the handler methods of target, keyed by lowercase name"""
+    table = {}
+    for name, method, arity, flags, first_key, last_key, step in COMMAND_SPECS:
+        table[name.encode()] = Command(name, getattr(target, method), arity, flags, first_key, last_key, step)
+    return table
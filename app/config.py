@@ -0,0 +1,127 @@
+from app.eviction import POLICIES
+
+
+class ConfigError(Exception):
+    pass
+
+
+# Every supported setting and its default, stored as strings like redis.conf
+DEFAULTS = {
+    "port": "6379",
+    # "thread" runs a thread per connection, "eventloop" runs every
+    # connection on one selectors loop
+    "io-mode": "thread",
+    # Processes sharing the port, each owning a hash partition of the keys
+    "workers": "1",
+    # How many times per second background jobs such as active expiry run
+    "hz": "10",
+    # Memory limit in bytes for the keyspace estimate; 0 means no limit
+    "maxmemory": "0",
+    "maxmemory-policy": "noeviction",
+    "maxmemory-samples": "5",
+    # RDB snapshots are saved to and loaded from dir/dbfilename
+    "dir": ".",
+    "dbfilename": "dump.rdb",
+    # Writes are also logged to dir/appendfilename, synced per appendfsync
+    "appendonly": "no",
+    "appendfilename": "appendonly.aof",
+    "appendfsync": "everysec",
+    # "host port" of the master to replicate, empty on a master
+    "replicaof": "",
+    # Size of the circular buffer replicas continue a broken link from
+    "repl-backlog-size": "1048576",
+    # Commands running at least this many microseconds go to the slow log;
+    # a negative value turns it off
+    "slowlog-log-slower-than": "10000",
+    "slowlog-max-len": "128",
+    # Events taking at least this many milliseconds are recorded by the
+    # latency monitor; 0 turns it off
+    "latency-monitor-threshold": "0",
+    # Per-command latency histograms for LATENCY HISTOGRAM and INFO latencystats
+    "latency-tracking": "yes",
+}
+
+CHOICES = {
+    "io-mode": ("thread", "eventloop"),
+    "maxmemory-policy": POLICIES,
+    "appendonly": ("yes", "no"),
+    "appendfsync": ("always", "everysec", "no"),
+    "latency-tracking": ("yes", "no"),
+}
+
+# Settings only read at startup, which CONFIG SET refuses
+IMMUTABLE = ("port", "io-mode", "workers", "appendonly", "appendfilename", "replicaof")
+
+INTEGER_RANGES = {
+    "port": (1, 65535),
+    "hz": (1, 500),
+    "workers": (1, 1024),
+    "maxmemory-samples": (1, 64),
+    "slowlog-log-slower-than": (-1, 2 ** 63 - 1),
+    "slowlog-max-len": (0, 2 ** 31 - 1),
+    "latency-monitor-threshold": (0, 2 ** 63 - 1),
+}
+
+MEMORY_SETTINGS = ("maxmemory", "repl-backlog-size")
+
+MEMORY_UNITS = {
+    "": 1, "b": 1,
+    "k": 1000, "kb": 1024,
+    "m": 1000 ** 2, "mb": 1024 ** 2,
+    "g": 1000 ** 3, "gb": 1024 ** 3,
+}
+
+
+def parse_memory(value):
+    """Parse a redis.conf memory size such as '100mb' into bytes"""
+    value = value.strip().lower()
+    digits = value.rstrip("kmgb")
+    unit = value[len(digits):]
+    if not digits.isdigit() or unit not in MEMORY_UNITS:
+        raise ValueError(f"invalid memory size '{value}'")
+    return int(digits) * MEMORY_UNITS[unit]
+
+
+def human_bytes(nbytes):
+    """Format a byte count the way INFO memory does, such as '1.50M'"""
+    for unit in ("B", "K", "M", "G"):
+        if nbytes < 1024 or unit == "G":
+            return f"{nbytes}B" if unit == "B" else f"{nbytes:.2f}{unit}"
+        nbytes /= 1024
+
+
+class Config:
+    def __init__(self):
+        self.values = dict(DEFAULTS)
+
+    def get(self, name):
+        return self.values[name]
+
+    def set(self, name, value):
+        if name not in self.values:
+            raise ConfigError(f"Unknown option '{name}'")
+        if name in CHOICES and value not in CHOICES[name]:
+            raise ConfigError(f"Invalid argument '{value}' for '{name}'")
+        if name in MEMORY_SETTINGS:
+            try:
+                value = str(parse_memory(value))
+            except ValueError:
+                raise ConfigError(f"Invalid argument '{value}' for '{name}'")
+        if name in INTEGER_RANGES:
+            low, high = INTEGER_RANGES[name]
+            if not value.lstrip("-").isdigit() or not low <= int(value) <= high:
+                raise ConfigError(f"Invalid argument '{value}' for '{name}'")
+        self.values[name] = value
+
+    @classmethod
+    def from_args(cls, argv):
+        """Build a Config from redis-server style '--name value' arguments"""
+        config = cls()
+        i = 0
+        while i < len(argv):
+            arg = argv[i]
+            if not arg.startswith("--") or i + 1 >= len(argv):
+                raise ConfigError(f"Bad argument '{arg}'")
+            config.set(arg[2:].lower(), argv[i + 1])
+            i += 2
+        return config
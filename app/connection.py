@@ -0,0 +1,94 @@
+import collections
+import itertools
+import threading
+import time
+
+from app.resp import Reply
+
+# Most systems cap a single sendmsg at 1024 buffers (IOV_MAX)
+IOV_MAX = 1024
+
+
+def send_buffers(sock, buffers):
+    """sendmsg as much of the buffers deque as the socket takes, dropping what was sent"""
+    sent = sock.sendmsg(itertools.islice(buffers, IOV_MAX))
+    remaining = sent
+    while remaining:
+        size = len(buffers[0])
+        if size > remaining:
+            buffers[0] = memoryview(buffers[0])[remaining:]
+            break
+        buffers.popleft()
+        remaining -= size
+    return sent
+
+
+class Connection:
+    """Client socket wrapper that batches replies.
+
+    Command handlers call sendall() as if they were talking to the socket
+    directly, or encode straight into reply; the replies are queued and
+    written out together by flush() once the whole batch of pipelined
+    commands has been processed.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reply = Reply()
+        # Buffers taken from reply that the socket has not accepted yet
+        self.outbuf = collections.deque()
+        self.unblocked = threading.Event()
+        self.response = None
+        # The port a replica says it listens on (REPLCONF listening-port)
+        self.listening_port = 0
+        # Set once the socket was handed over, e.g. to a replica stream
+        self.detached = False
+        # Time the current command spent waiting in block(), which its
+        # recorded latency leaves out
+        self.blocked_ns = 0
+
+    def sendall(self, data):
+        """Queue a reply, either encoded RESP or a Reply"""
+        if isinstance(data, Reply):
+            self.reply.extend(data)
+        else:
+            self.reply.write(data)
+
+    def flush(self):
+        self.outbuf.extend(self.reply.take())
+        while self.outbuf:
+            send_buffers(self.sock, self.outbuf)
+
+    def detach(self):
+        """Send pending replies and give up the socket to a new owner, returning it"""
+        self.flush()
+        self.detached = True
+        return self.sock
+
+    def block(self, waiter):
+        """Wait in the connection's own thread until the waiter is served or times out"""
+        # Replies to earlier pipelined commands must not wait on the block
+        self.flush()
+        start = time.perf_counter_ns()
+        self.unblocked.wait()
+        self.blocked_ns += time.perf_counter_ns() - start
+        self.unblocked.clear()
+        self.sendall(self.response)
+
+    def unblock(self, response):
+        self.response = response
+        self.unblocked.set()
+
+    def peer_address(self):
+        """The client's "ip:port", or an empty string if it has none"""
+        try:
+            host, port = self.sock.getpeername()[:2]
+        except (AttributeError, OSError, ValueError):
+            return ""
+        return f"{host}:{port}"
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def close(self):
+        self.sock.close()
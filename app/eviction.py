@@ -0,0 +1,265 @@
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+from app.hashes import FIELD_HASH, HashPack, HashTable
+from app.lists import ListPack
+from app.stream import Stream
+from app.strings import SHARED_INTEGERS
+
+POLICIES = ("noeviction", "allkeys-lru", "allkeys-lfu", "volatile-lru", "volatile-ttl")
+
+# Rough CPython 64-bit costs, close enough to compare against maxmemory
+KEY_OVERHEAD = 104  # keyspace dict slot plus the key's bytes object header
+BYTES_OVERHEAD = sys.getsizeof(b"")
+LIST_ITEM_OVERHEAD = BYTES_OVERHEAD + 8
+# A packed item's bulk header and line endings
+PACKED_ITEM_OVERHEAD = 8
+LISTPACK_OVERHEAD = sys.getsizeof(ListPack())
+HASHPACK_OVERHEAD = sys.getsizeof(HashPack()) + sys.getsizeof(HashPack().offsets) + sys.getsizeof(bytearray())
+# A packed hash field's offset and hash
+HASHPACK_INDEX_SIZE = HashPack().offsets.itemsize + FIELD_HASH.size
+# A dict slot, an order list slot, and the field and value bytes headers
+HASH_FIELD_OVERHEAD = 24 + 8 + 2 * BYTES_OVERHEAD
+# Both ID array slots and the packed fields' list slot and bytes header
+STREAM_ENTRY_OVERHEAD = 16 + 8 + BYTES_OVERHEAD
+
+EVICTION_POOL_SIZE = 16
+
+# Same LFU tuning as Redis' lfu-log-factor / lfu-decay-time defaults
+LFU_INIT_VAL = 5
+LFU_LOG_FACTOR = 10
+LFU_DECAY_MINUTES = 1
+
+
+def estimate_value(value):
+    """Approximate bytes held by a keyspace value"""
+    if isinstance(value, ListPack):
+        return LISTPACK_OVERHEAD + len(value.data)
+    if isinstance(value, deque):
+        return sys.getsizeof(value) + estimate_list_items(value, value)
+    if isinstance(value, Stream):
+        return sys.getsizeof(value.fields) + sum(estimate_stream_entry(packed) for packed in value.packed())
+    if isinstance(value, HashPack):
+        return HASHPACK_OVERHEAD + len(value.data) + HASHPACK_INDEX_SIZE * len(value)
+    if isinstance(value, HashTable):
+        return sys.getsizeof(value.fields) + sys.getsizeof(value.order) + sum(estimate_hash_field(value, field, item) for field, item in value.items())
+    if isinstance(value, int):
+        return 0 if 0 <= value < SHARED_INTEGERS else sys.getsizeof(value)
+    return len(value) + BYTES_OVERHEAD
+
+
+def estimate_list_items(lst, items):
+    """Approximate bytes items take up in lst"""
+    overhead = PACKED_ITEM_OVERHEAD if isinstance(lst, ListPack) else LIST_ITEM_OVERHEAD
+    return sum(len(item) + overhead for item in items)
+
+
+def estimate_hash_field(hsh, field, value):
+    """Approximate bytes one field and its value take up in hsh"""
+    overhead = 2 * PACKED_ITEM_OVERHEAD + HASHPACK_INDEX_SIZE if isinstance(hsh, HashPack) else HASH_FIELD_OVERHEAD
+    return len(field) + len(value) + overhead
+
+
+def estimate_stream_entry(packed):
+    return STREAM_ENTRY_OVERHEAD + len(packed)
+
+
+class KeySample:
+    """Set of keys that can hand out a uniformly random key in O(1)"""
+
+    def __init__(self):
+        self.keys = []
+        self.positions = {}
+
+    def add(self, key):
+        if key not in self.positions:
+            self.positions[key] = len(self.keys)
+            self.keys.append(key)
+
+    def remove(self, key):
+        position = self.positions.pop(key, None)
+        if position is None:
+            return
+        last = self.keys.pop()
+        if position < len(self.keys):
+            self.keys[position] = last
+            self.positions[last] = position
+
+    def sample(self, count):
+        keys = self.keys
+        return [keys[random.randrange(len(keys))] for _ in range(count)] if keys else []
+
+
+class Evictor:
+    """maxmemory accounting and Redis-style approximate eviction.
+
+    Tracking only runs while a limit is set: per-key size estimates, the
+    random-access key sample and the per-key LRU clock or LFU counter are
+    built from the keyspace when maxmemory is turned on and dropped when
+    it goes back to 0.
+
+    lock guards the accounting and is always taken last, after any shard
+    lock. touch() skips it: a lost LRU or LFU update only makes the
+    approximation a little rougher.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.maxmemory = 0
+        self.policy = "noeviction"
+        self.samples = 5
+        self.used = 0
+        # Bytes of the shards' cached GET replies: only copies, so counted
+        # apart from any key and always, to stay right across configure()
+        self.cached = 0
+        self.sizes = {}
+        self.all_keys = KeySample()
+        # LRU clock (seconds) or packed LFU counter per key, depending on policy
+        self.access = {}
+        self.pool = []
+        self.evicted_keys = 0
+        self.clock = time.monotonic()
+
+    def configure(self, maxmemory, policy, samples, keyspace):
+        """Apply the maxmemory settings; keyspace yields (key, value) when tracking starts"""
+        with self.lock:
+            self.__configure(maxmemory, policy, samples, keyspace)
+
+    def __configure(self, maxmemory, policy, samples, keyspace):
+        lfu_changed = (policy == "allkeys-lfu") != (self.policy == "allkeys-lfu")
+        self.maxmemory = maxmemory
+        self.policy = policy
+        self.samples = samples
+        self.pool = []
+        if maxmemory == 0:
+            self.enabled = False
+            self.used = 0
+            self.sizes = {}
+            self.all_keys = KeySample()
+            self.access = {}
+            return
+        if self.enabled and not lfu_changed:
+            return
+        self.enabled = True
+        self.used = 0
+        self.sizes = {}
+        self.all_keys = KeySample()
+        self.access = {}
+        for key, value in keyspace:
+            self.__track(key, estimate_value(value))
+
+    def track(self, key, nbytes):
+        """Account nbytes more for key, registering it if it is new"""
+        with self.lock:
+            self.__track(key, nbytes)
+
+    def __track(self, key, nbytes):
+        if key not in self.sizes:
+            nbytes += KEY_OVERHEAD + len(key)
+            self.sizes[key] = 0
+            self.all_keys.add(key)
+            self.access[key] = self.__initial_access()
+        self.sizes[key] += nbytes
+        self.used += nbytes
+
+    def track_cached(self, nbytes):
+        """Account nbytes more, or fewer if negative, of cached replies"""
+        with self.lock:
+            self.cached += nbytes
+
+    def untrack(self, key):
+        with self.lock:
+            size = self.sizes.pop(key, None)
+            if size is None:
+                return
+            self.used -= size
+            self.all_keys.remove(key)
+            self.access.pop(key, None)
+
+    def touch(self, key):
+        """Record an access for the LRU clock or LFU counter"""
+        current = self.access.get(key)
+        if current is None:
+            return
+        if self.policy == "allkeys-lfu":
+            self.access[key] = self.__lfu_increment(current)
+        else:
+            self.access[key] = self.clock
+
+    def over_limit(self):
+        return self.enabled and self.used + self.cached > self.maxmemory
+
+    @property
+    def volatile(self):
+        """Whether the policy only evicts keys that have a TTL"""
+        return self.policy.startswith("volatile-")
+
+    def pick_victim(self, volatile_keys, deadline):
+        """Return the best key to evict under the current policy, or None.
+
+        volatile_keys is a fresh sample of keys with a TTL, used by the
+        volatile policies; deadline(key) looks up a key's TTL deadline.
+        """
+        with self.lock:
+            candidates = volatile_keys if self.volatile else self.all_keys.sample(self.samples)
+            for key in candidates:
+                when = deadline(key) if self.volatile else None
+                if key in self.sizes and (when is not None or not self.volatile):
+                    self.__pool_insert(self.__score(key, when), key)
+            while self.pool:
+                _, key = self.pool.pop()
+                # Pool entries may have been deleted or persisted since they were sampled
+                if key in self.sizes and (not self.volatile or deadline(key) is not None):
+                    return key
+            return None
+
+    def __score(self, key, when):
+        """Higher scores are better eviction candidates; when is key's TTL deadline"""
+        if self.policy == "volatile-ttl":
+            return -when
+        if self.policy == "allkeys-lfu":
+            return 255 - self.__lfu_decay(self.access[key])
+        return self.clock - self.access[key]
+
+    def __pool_insert(self, score, key):
+        """Keep the EVICTION_POOL_SIZE best candidates seen, sorted by score"""
+        pool = self.pool
+        for i, (_, pooled) in enumerate(pool):
+            if pooled == key:
+                del pool[i]
+                break
+        if len(pool) >= EVICTION_POOL_SIZE:
+            if score <= pool[0][0]:
+                return
+            del pool[0]
+        position = 0
+        while position < len(pool) and pool[position][0] < score:
+            position += 1
+        pool.insert(position, (score, key))
+
+    def __initial_access(self):
+        if self.policy == "allkeys-lfu":
+            return (self.__minutes() << 8) | LFU_INIT_VAL
+        return self.clock
+
+    def __minutes(self):
+        return int(self.clock // 60) & 0xFFFF
+
+    def __lfu_decay(self, packed):
+        """Counter after decaying it by one per LFU_DECAY_MINUTES since its last access"""
+        counter = packed & 0xFF
+        elapsed = (self.__minutes() - (packed >> 8)) & 0xFFFF
+        return max(0, counter - elapsed // LFU_DECAY_MINUTES)
+
+    def __lfu_increment(self, packed):
+        """Logarithmic counter increment, as in Redis' LFULogIncr"""
+        counter = self.__lfu_decay(packed)
+        if counter < 255:
+            base = max(0, counter - LFU_INIT_VAL)
+            if random.random() < 1.0 / (base * LFU_LOG_FACTOR + 1):
+                counter += 1
+        return (self.__minutes() << 8) | counter
@@ -0,0 +1,82 @@
+import heapq
+import random
+import time
+
+
+def current_ms():
+    return int(time.time() * 1000)
+
+
+class ExpiryIndex:
+    """Expiry deadlines (unix time in ms) for the keys that have one.
+
+    deadlines is the authoritative key -> deadline table. The heap orders
+    the same deadlines so the active expiry cycle can pop exactly the keys
+    that are due. Overwritten or removed deadlines are left in the heap and
+    skipped when popped or sampled; the heap is rebuilt once they outnumber
+    the live ones, so every live key keeps an entry and at least about half
+    of the entries are live.
+    """
+
+    def __init__(self):
+        self.deadlines = {}
+        self.heap = []
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def get(self, key):
+        return self.deadlines.get(key)
+
+    def set(self, key, deadline):
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        self.__compact()
+
+    def remove(self, key):
+        """Drop key's deadline, returning whether it had one"""
+        if self.deadlines.pop(key, None) is None:
+            return False
+        self.__compact()
+        return True
+
+    def sample(self, count):
+        """count random keys that have a TTL, picked from the heap, or fewer if there are not that many"""
+        heap = self.heap
+        deadlines = self.deadlines
+        count = min(count, len(deadlines))
+        keys = []
+        # Every live key has an entry, so this ends; stale entries are skipped
+        while len(keys) < count:
+            deadline, key = heap[random.randrange(len(heap))]
+            if deadlines.get(key) == deadline:
+                keys.append(key)
+        return keys
+
+    def __compact(self):
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(when, key) for key, when in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def is_expired(self, key, now=None):
+        deadline = self.deadlines.get(key)
+        if deadline is None:
+            return False
+        return (current_ms() if now is None else now) > deadline
+
+    def pop_expired(self, now, time_limit):
+        """Yield keys whose deadline has passed until time_limit (time.monotonic())"""
+        heap = self.heap
+        deadlines = self.deadlines
+        checked = 0
+        while heap and heap[0][0] < now:
+            deadline, key = heapq.heappop(heap)
+            if deadlines.get(key) == deadline:
+                yield key
+            checked += 1
+            # Checking the clock on every key would cost more than the work
+            if checked % 32 == 0 and time.monotonic() >= time_limit:
+                return
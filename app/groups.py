@@ -0,0 +1,144 @@
+from bisect import bisect_left, insort
+
+from app.stream import MIN_ID
+
+
+class SortedIds:
+    """Entry IDs in order for range scans, over a dict saying which are still live.
+
+    Deliveries follow the stream, so a new ID nearly always sorts last and
+    adding it is an append. IDs dropped from the dict stay in the list and
+    are skipped by scans until they outnumber the live ones and the list
+    is rebuilt, as ExpiryIndex does with its heap.
+    """
+
+    def __init__(self, live):
+        self.live = live
+        self.ids = []
+
+    def add(self, entry_id):
+        ids = self.ids
+        if not ids or entry_id > ids[-1]:
+            ids.append(entry_id)
+        else:
+            insort(ids, entry_id)
+
+    def compact(self):
+        if len(self.ids) > 2 * len(self.live) + 64:
+            self.ids = sorted(self.live)
+
+    def scan(self, start=MIN_ID):
+        """Live IDs from start on, in order"""
+        ids = self.ids
+        live = self.live
+        previous = None
+        for i in range(bisect_left(ids, start), len(ids)):
+            entry_id = ids[i]
+            # An ID dropped and added back appears twice, side by side
+            if entry_id != previous and entry_id in live:
+                yield entry_id
+            previous = entry_id
+
+    def first(self):
+        return next(self.scan(), None)
+
+    def last(self):
+        for entry_id in reversed(self.ids):
+            if entry_id in self.live:
+                return entry_id
+        return None
+
+
+class PendingEntry:
+    """An entry delivered to a consumer and not acknowledged yet"""
+
+    __slots__ = ("consumer", "delivery_time", "delivery_count")
+
+    def __init__(self, consumer, delivery_time, delivery_count):
+        self.consumer = consumer
+        self.delivery_time = delivery_time
+        self.delivery_count = delivery_count
+
+
+class Consumer:
+    def __init__(self, name, now):
+        self.name = name
+        self.seen_time = now
+        # This consumer's share of the group's pending entries
+        self.pending = {}
+        self.pending_ids = SortedIds(self.pending)
+
+
+class ConsumerGroup:
+    """A consumer group of a stream.
+
+    last_id is the last entry delivered to the group. The pending entries
+    list maps every delivered but unacknowledged entry ID to its
+    PendingEntry, which is in its consumer's own pending dict as well;
+    both are indexed by ID for XPENDING ranges and history reads.
+    """
+
+    def __init__(self, last_id):
+        self.last_id = last_id
+        self.pending = {}
+        self.pending_ids = SortedIds(self.pending)
+        self.consumers = {}
+
+    def consumer(self, name, now):
+        """The consumer called name, created if needed; returns (consumer, created)"""
+        consumer = self.consumers.get(name)
+        if consumer is not None:
+            consumer.seen_time = now
+            return consumer, False
+        consumer = self.consumers[name] = Consumer(name, now)
+        return consumer, True
+
+    def deliver(self, consumer, entry_ids, now, noack):
+        """Record new entries, in ID order, as read by consumer"""
+        self.last_id = entry_ids[-1]
+        if noack:
+            return
+        for entry_id in entry_ids:
+            self.assign(entry_id, consumer, now, 1)
+
+    def assign(self, entry_id, consumer, delivery_time, delivery_count):
+        """Make entry_id pending for consumer, taking it over from whoever had it"""
+        entry = self.pending.get(entry_id)
+        if entry is None:
+            entry = self.pending[entry_id] = PendingEntry(consumer, delivery_time, delivery_count)
+            self.pending_ids.add(entry_id)
+        else:
+            if entry.consumer is not consumer:
+                self.__unassign(entry_id, entry)
+                entry.consumer = consumer
+            entry.delivery_time = delivery_time
+            entry.delivery_count = delivery_count
+        if entry_id not in consumer.pending:
+            consumer.pending[entry_id] = entry
+            consumer.pending_ids.add(entry_id)
+
+    def ack(self, entry_ids):
+        """Drop entry_ids from the pending entries list, returning how many were there"""
+        acked = 0
+        for entry_id in entry_ids:
+            entry = self.pending.pop(entry_id, None)
+            if entry is not None:
+                self.__unassign(entry_id, entry)
+                acked += 1
+        self.pending_ids.compact()
+        return acked
+
+    def delete_consumer(self, name):
+        """Remove a consumer and its pending entries, returning how many it had, or None"""
+        consumer = self.consumers.pop(name, None)
+        if consumer is None:
+            return None
+        for entry_id in consumer.pending:
+            del self.pending[entry_id]
+        self.pending_ids.compact()
+        return len(consumer.pending)
+
+    def __unassign(self, entry_id, entry):
+        consumer = entry.consumer
+        del consumer.pending[entry_id]
+        consumer.pending_ids.compact()
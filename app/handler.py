@@ -1,850 +1,2814 @@
-import time
+import fnmatch
+import functools
+import io
+import itertools
+import math
+import os
 import threading
+import time
 import uuid
+import warnings
+from collections import deque
+from time import perf_counter_ns
+
+from app.aof import AppendOnlyFile, replay_aof, rewrite_aof
+from app.blocking import BlockingRegistry
+from app.commands import build_command_table
+from app.config import IMMUTABLE, Config, ConfigError, human_bytes
+from app.connection import Connection
+from app.eviction import Evictor, estimate_hash_field, estimate_list_items, estimate_stream_entry, estimate_value
+from app.expiry import current_ms
+from app.groups import ConsumerGroup
+from app.keyspace import SCAN_EPOCH_BITS, SCAN_EPOCH_MASK, Keyspace, compile_glob
+from app.lazyfree import LazyFree
+from app.latency import LatencyMonitor, cumulative_histogram, histogram_percentile
+from app.hashes import HASH_TYPES, HashPack, HashTable, packable
+from app.lists import LIST_TYPES, ListPack, list_range, new_list
+from app.rdb import load_rdb, read_rdb, save_rdb
+from app.replication import REPLICA_ACKS, MasterLink, Replication
+from app.slowlog import SlowLog
+from app.stream import (
+    MAX_ID, MAX_ID_PART, MIN_ID, STREAM_NODE_MAX_ENTRIES, Stream, auto_id, format_id, increment_id, parse_id, semi_auto_id
+)
+from app.strings import (
+    INT64_MAX, INT64_MIN, compact_string, format_float, parse_float, parse_int64, stored_integer, string_bytes
+)
+from app.resp import (
+    EMPTY_ARRAY, LARGE_BULK, NULL_ARRAY, NULL_BULK, ProtocolError, Reply, RequestParser, bulk, integer
+)
+
+WRONGTYPE_ERROR = b"-WRONGTYPE Operation against a key holding the wrong kind of value\r\n"
+INVALID_STREAM_ID_ERROR = b"-ERR Invalid stream ID specified as stream command argument\r\n"
+OOM_ERROR = b"-OOM command not allowed when used memory > 'maxmemory'.\r\n"
+READONLY_ERROR = b"-READONLY You can't write against a read only replica.\r\n"
+
+# Values of the dictionary table that are not strings
+CONTAINER_TYPES = LIST_TYPES + HASH_TYPES
 
 class Handler:
-    def __init__(self):
-        # Store value and expiry (None or timestamp in seconds)
-        self.dictionary = dict()
-        self.lock = threading.Lock()
-        self.streams = {}
-
-    def handle(self, connection):
-        while True:
-            data = connection.recv(1024)
-            if not data:
-                break
-            if data.startswith(b"*1\r\n$4\r\nPING"):
-                self.handle_ping(connection)
-            elif data.startswith(b"*2\r\n$4\r\nECHO"):
-                self.handle_echo(connection, data)
-            elif data.startswith(b"*3\r\n$3\r\nSET") or data.startswith(b"*5\r\n$3\r\nSET"):
-                self.handle_set(connection, data)
-            elif data.startswith(b"*2\r\n$3\r\nGET"):
-                self.handle_get(connection, data)
-            elif b"\r\n$5\r\nRPUSH\r\n" in data:
-                self.handle_rpush(connection, data)
-            elif b"\r\n$6\r\nLRANGE\r\n" in data:
-                self.handle_lrange(connection, data)
-            elif b"\r\n$5\r\nLPUSH\r\n" in data:
-                self.handle_lpush(connection, data)
-            elif data.startswith(b"*2\r\n$4\r\nLLEN"):
-                self.handle_llen(connection, data)
-            elif b"\r\n$4\r\nLPOP\r\n" in data or data.startswith(b"*2\r\n$4\r\nLPOP"):
-                self.handle_lpop(connection, data)
-            elif b"BLPOP" in data:
-                self.handle_blpop(connection, data)
-            elif b"TYPE" in data:
-                self.handle_type(connection, data)
-            elif b"XADD" in data:
-                self.handle_xadd(connection, data)
-            elif b"XRANGE" in data:
-                self.handle_xrange(connection, data)
-            elif b"XREAD" in data:
-                self.handle_xread(connection, data)
-            else:
-                connection.sendall(b"-ERR unknown command\r\n")
-        connection.close()
+    def __init__(self, config=None):
+        self.config = config if config is not None else Config()
+        self.keyspace = Keyspace()
+        # Shard the next active expire cycle starts from
+        self.expire_cursor = 0
+        self.evictor = Evictor()
+        self.__apply_memory_config()
+        self.commands = build_command_table(self)
+        self.blocking = BlockingRegistry()
+        # Set in --workers mode to send commands on other workers' keys to them
+        self.router = None
+        # Unix time of the last successful save, and the BGSAVE child if one is running
+        self.last_save = int(time.time())
+        self.last_bgsave_ok = True
+        self.save_child = None
+        # The BGREWRITEAOF child; save_lock guards it as well
+        self.rewrite_child = None
+        self.save_lock = threading.Lock()
+        # Set by load_aof() when appendonly is on; every write is logged to it
+        self.aof = None
+        self.replication = Replication(int(self.config.get("repl-backlog-size")))
+        # Set while this server replicates a master
+        self.master_link = None
+        self.start_time = time.time()
+        # Frees what UNLINK removes off the clients' threads
+        self.lazyfree = LazyFree()
+        self.slowlog = SlowLog()
+        self.latency = LatencyMonitor()
+        self.__apply_latency_config()
+        # Client counts for INFO; clients_lock guards them in thread mode
+        self.clients_lock = threading.Lock()
+        self.connected_clients = 0
+        self.total_connections = 0
 
-    def handle_ping(self, connection):
-        connection.sendall(b"+PONG\r\n")
+    def handle(self, sock):
+        self.client_connected()
+        try:
+            self.__serve(Connection(sock))
+        finally:
+            self.client_disconnected()
 
-    def handle_echo(self, connection, data):
-        parts = data.split(b"\r\n")
+    def __serve(self, connection):
+        parser = RequestParser()
+        # Links to the other workers, opened as this client needs them
+        peers = {}
         try:
-            dollar_indices = [i for i, part in enumerate(parts) if part.startswith(b"$")]
-            if len(dollar_indices) >= 2:
-                arg_index = dollar_indices[1] + 1
-                message = parts[arg_index]
-                response = b"$" + str(len(message)).encode() + b"\r\n" + message + b"\r\n"
-                connection.sendall(response)
-            else:
-                connection.sendall(b"-ERR wrong number of arguments for 'echo' command\r\n")
-        except Exception:
-            connection.sendall(b"-ERR wrong number of arguments for 'echo' command\r\n")
+            while True:
+                data = connection.recv(65536)
+                if not data:
+                    break
+                parser.feed(data)
+                try:
+                    commands = parser.commands()
+                except ProtocolError as e:
+                    connection.sendall(b"-ERR Protocol error: " + str(e).encode() + b"\r\n")
+                    connection.flush()
+                    break
+                # Every complete command in this read is executed before the
+                # replies go out, so a pipelined batch costs one write
+                if self.router is not None:
+                    self.router.execute(connection, commands, peers)
+                else:
+                    for args in commands:
+                        self.dispatch(connection, args)
+                self.commit_writes()
+                connection.flush()
+                if connection.detached:
+                    # The socket now belongs to a replica stream
+                    return
+        finally:
+            # Whatever ended the thread, the client's socket goes with it
+            for peer in peers.values():
+                peer.close()
+            if not connection.detached:
+                connection.close()
 
-    def handle_set(self, connection, data):
-        parts = data.split(b"\r\n")
+    def dispatch(self, connection, args):
+        command = self.commands.get(args[0].lower())
+        if command is None:
+            connection.sendall(self.__unknown_command_error(args))
+            return
+        if not command.check_arity(len(args)):
+            connection.sendall(b"-ERR wrong number of arguments for '" + command.name.encode() + b"' command\r\n")
+            return
+        if self.master_link is not None and "write" in command.flags and connection is not self.master_link.connection:
+            connection.sendall(READONLY_ERROR)
+            return
+        if self.evictor.enabled and "denyoom" in command.flags and not self.__perform_evictions():
+            connection.sendall(OOM_ERROR)
+            return
+        start = perf_counter_ns()
         try:
-            dollar_indices = [i for i, part in enumerate(parts) if part.startswith(b"$")]
-            if len(dollar_indices) >= 3:
-                key_index = dollar_indices[1] + 1
-                value_index = dollar_indices[2] + 1
-                key = parts[key_index]
-                value = parts[value_index]
-                expiry = None
-                # Check for PX argument
-                if len(dollar_indices) >= 5:
-                    px_index = dollar_indices[3] + 1
-                    px_value_index = dollar_indices[4] + 1
-                    if parts[px_index].upper() == b"PX":
-                        try:
-                            ms = int(parts[px_value_index])
-                            expiry = time.time() + ms / 1000.0
-                        except Exception:
-                            connection.sendall(b"-ERR PX value is not an integer\r\n")
-                            return
-                # Store value and expiry (None if not set)
-                self.dictionary[key] = (value, expiry)
-                connection.sendall(b"+OK\r\n")
+            command.handler(connection, args)
+        except Exception as e:
+            # A failing command must not take its client, or on the event
+            # loop every client, down with it
+            print(f"Error running {command.name}: {e!r}")
+            connection.sendall(b"-ERR internal error running '" + command.name.encode() + b"'\r\n")
+            return
+        duration = perf_counter_ns() - start
+        if connection.blocked_ns:
+            duration -= connection.blocked_ns
+            connection.blocked_ns = 0
+        command.calls += 1
+        command.duration_ns += duration
+        if self.latency_tracking:
+            command.histogram[(duration // 1000).bit_length()] += 1
+        if duration >= self.slow_threshold_ns:
+            self.__record_slow_command(connection, command, args, duration)
+
+    def __record_slow_command(self, connection, command, args, duration):
+        """Slow log and latency monitor bookkeeping for a command over either threshold"""
+        if duration >= self.slowlog_threshold_ns:
+            self.slowlog.add(args, duration // 1000, connection.peer_address())
+        if duration >= self.latency_threshold_ns:
+            self.latency.add_sample("fast-command" if "fast" in command.flags else "command", duration // 1_000_000)
+
+    def __apply_latency_config(self):
+        """Cache the slow log and latency settings dispatch reads on every command"""
+        slower_than = int(self.config.get("slowlog-log-slower-than"))
+        monitor_threshold = int(self.config.get("latency-monitor-threshold"))
+        # A disabled check gets a threshold no duration reaches
+        self.slowlog_threshold_ns = slower_than * 1000 if slower_than >= 0 else math.inf
+        self.latency_threshold_ns = monitor_threshold * 1_000_000 if monitor_threshold > 0 else math.inf
+        self.slow_threshold_ns = min(self.slowlog_threshold_ns, self.latency_threshold_ns)
+        self.latency_tracking = self.config.get("latency-tracking") == "yes"
+        self.slowlog.resize(int(self.config.get("slowlog-max-len")))
+
+    def __monitor_latency(self, event, start):
+        """Report event to the latency monitor if it ran for the threshold since start"""
+        duration = perf_counter_ns() - start
+        if duration >= self.latency_threshold_ns:
+            self.latency.add_sample(event, duration // 1_000_000)
+
+    def client_connected(self):
+        with self.clients_lock:
+            self.connected_clients += 1
+            self.total_connections += 1
+
+    def client_disconnected(self):
+        with self.clients_lock:
+            self.connected_clients -= 1
+
+    def __unknown_command_error(self, args):
+        preview = b" ".join(b"'" + arg[:128] + b"'" for arg in args[1:])
+        return b"-ERR unknown command '" + args[0][:128] + b"', with args beginning with: " + preview + b"\r\n"
+
+    def handle_ping(self, connection, args):
+        if len(args) > 2:
+            connection.sendall(b"-ERR wrong number of arguments for 'ping' command\r\n")
+        elif len(args) == 2:
+            connection.reply.bulk(args[1])
+        else:
+            connection.sendall(b"+PONG\r\n")
+
+    def handle_echo(self, connection, args):
+        connection.reply.bulk(args[1])
+
+    def handle_command(self, connection, args):
+        subcommand = args[1].upper() if len(args) > 1 else None
+        if subcommand is None:
+            commands = list(self.commands.values())
+        elif subcommand == b"INFO":
+            commands = [self.commands.get(name.lower()) for name in args[2:]]
+        elif subcommand == b"COUNT":
+            connection.reply.integer(len(self.commands))
+            return
+        elif subcommand == b"DOCS":
+            # Docs are optional; redis-cli asks for them on startup
+            connection.sendall(EMPTY_ARRAY)
+            return
+        else:
+            connection.sendall(b"-ERR unknown subcommand '" + args[1] + b"'. Try COMMAND HELP.\r\n")
+            return
+        reply = connection.reply
+        reply.array(len(commands))
+        for command in commands:
+            self.__write_command_info(reply, command)
+
+    def __write_command_info(self, reply, command):
+        if command is None:
+            reply.write(NULL_ARRAY)
+            return
+        reply.array(6)
+        reply.bulk(command.name.encode())
+        reply.integer(command.arity)
+        reply.array(len(command.flags))
+        for flag in command.flags:
+            reply.write(b"+" + flag.encode() + b"\r\n")
+        for position in (command.first_key, command.last_key, command.step):
+            reply.integer(position)
+
+    def handle_config(self, connection, args):
+        subcommand = args[1].upper()
+        if subcommand == b"GET" and len(args) >= 3:
+            # Bytes that are not UTF-8 become U+FFFD, which no name contains
+            patterns = [arg.decode(errors="replace").lower() for arg in args[2:]]
+            matches = [
+                (name, value) for name, value in self.config.values.items()
+                if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+            ]
+            connection.reply.bulks([item.encode() for match in matches for item in match])
+        elif subcommand == b"SET" and len(args) >= 4 and len(args) % 2 == 0:
+            try:
+                for i in range(2, len(args), 2):
+                    name = args[i].decode().lower()
+                    if name in IMMUTABLE:
+                        raise ConfigError(f"can't set immutable config '{name}'")
+                    self.config.set(name, args[i + 1].decode())
+            except (ConfigError, UnicodeDecodeError) as e:
+                connection.sendall(b"-ERR CONFIG SET failed: " + str(e).encode() + b"\r\n")
+                return
+            self.__apply_memory_config()
+            self.__apply_latency_config()
+            if self.aof is not None:
+                self.aof.fsync = self.config.get("appendfsync")
+            backlog_size = int(self.config.get("repl-backlog-size"))
+            if backlog_size != self.replication.backlog_size:
+                self.replication.resize(backlog_size)
+            connection.sendall(b"+OK\r\n")
+        elif subcommand == b"RESETSTAT" and len(args) == 2:
+            for command in self.commands.values():
+                command.reset_stats()
+            for shard in self.keyspace.shards:
+                shard.expired_keys = 0
+            self.evictor.evicted_keys = 0
+            self.total_connections = self.connected_clients
+            connection.sendall(b"+OK\r\n")
+        else:
+            connection.sendall(b"-ERR unknown subcommand or wrong number of arguments for '" + args[1] + b"'\r\n")
+
+    def handle_save(self, connection, args):
+        if self.router is not None:
+            connection.sendall(b"-ERR SAVE is not supported in --workers mode\r\n")
+            return
+        with self.save_lock:
+            if self.save_child is not None:
+                connection.sendall(b"-ERR Background save already in progress\r\n")
+                return
+            try:
+                with self.keyspace.lock_all():
+                    self.__save_snapshot()
+            except Exception as e:
+                connection.sendall(b"-ERR " + str(e).encode() + b"\r\n")
+                return
+            self.last_save = int(time.time())
+        connection.sendall(b"+OK\r\n")
+
+    def handle_bgsave(self, connection, args):
+        if len(args) > 2 or (len(args) == 2 and args[1].upper() != b"SCHEDULE"):
+            connection.sendall(b"-ERR syntax error\r\n")
+            return
+        if self.router is not None:
+            connection.sendall(b"-ERR BGSAVE is not supported in --workers mode\r\n")
+            return
+        with self.save_lock:
+            if self.save_child is not None:
+                connection.sendall(b"-ERR Background save already in progress\r\n")
+                return
+            if self.rewrite_child is not None:
+                connection.sendall(b"-ERR Background append only file rewriting in progress\r\n")
+                return
+            with self.keyspace.lock_all():
+                pid = self.__fork()
+                if pid == 0:
+                    status = 1
+                    try:
+                        self.__save_snapshot()
+                        status = 0
+                    finally:
+                        os._exit(status)
+            self.save_child = pid
+        connection.sendall(b"+Background saving started\r\n")
+
+    def handle_lastsave(self, connection, args):
+        connection.reply.integer(self.last_save)
+
+    def handle_bgrewriteaof(self, connection, args):
+        if self.router is not None:
+            connection.sendall(b"-ERR BGREWRITEAOF is not supported in --workers mode\r\n")
+            return
+        error = self.__start_rewrite()
+        if error is not None:
+            connection.sendall(error)
+            return
+        connection.sendall(b"+Background append only file rewriting started\r\n")
+
+    def __start_rewrite(self):
+        """Fork the BGREWRITEAOF child, returning an error reply if one cannot start now"""
+        with self.save_lock:
+            if self.rewrite_child is not None:
+                return b"-ERR Background append only file rewriting already in progress\r\n"
+            if self.save_child is not None:
+                return b"-ERR Background save in progress, try again later\r\n"
+            with self.keyspace.lock_all():
+                # Writes from here on are not in the child's copy of the
+                # keyspace, so the AOF keeps them for the end of the rewrite
+                if self.aof is not None:
+                    self.aof.start_rewrite()
+                pid = self.__fork()
+                if pid == 0:
+                    status = 1
+                    try:
+                        rewrite_aof(self.__rewrite_temp_path(os.getpid()), self.__snapshot_entries())
+                        status = 0
+                    finally:
+                        os._exit(status)
+            self.rewrite_child = pid
+        return None
+
+    def handle_info(self, connection, args):
+        sections = {arg.decode(errors="replace").lower() for arg in args[1:]}
+        everything = bool(sections & {"all", "everything"})
+        default = not sections or "default" in sections
+        parts = []
+        for name, fields, in_default in (
+            ("server", self.__info_server, True),
+            ("clients", self.__info_clients, True),
+            ("memory", self.__info_memory, True),
+            ("stats", self.__info_stats, True),
+            ("replication", self.__info_replication, True),
+            ("commandstats", self.__info_commandstats, False),
+            ("latencystats", self.__info_latencystats, False),
+            ("keyspace", self.__info_keyspace, True),
+        ):
+            if everything or (default and in_default) or name in sections:
+                lines = "".join(f"{field}:{value}\r\n" for field, value in fields())
+                parts.append(f"# {name.capitalize()}\r\n{lines}")
+        connection.reply.bulk("\r\n".join(parts).encode())
+
+    def __info_server(self):
+        return [
+            ("redis_version", "7.2.0"),
+            ("redis_mode", "standalone"),
+            ("process_id", os.getpid()),
+            ("tcp_port", self.config.get("port")),
+            ("uptime_in_seconds", int(time.time() - self.start_time)),
+            ("hz", self.config.get("hz")),
+        ]
+
+    def __info_clients(self):
+        with self.blocking.lock:
+            blocking_keys = sum(1 for count in self.blocking.live.values() if count)
+        return [
+            ("connected_clients", self.connected_clients),
+            ("blocking_keys", blocking_keys),
+        ]
+
+    def __info_memory(self):
+        evictor = self.evictor
+        # The estimate is only kept while a maxmemory limit is set
+        return [
+            ("used_memory", evictor.used + evictor.cached),
+            ("used_memory_human", human_bytes(evictor.used + evictor.cached)),
+            ("maxmemory", evictor.maxmemory),
+            ("maxmemory_human", human_bytes(evictor.maxmemory)),
+            ("maxmemory_policy", evictor.policy),
+            ("lazyfree_pending_objects", self.lazyfree.pending),
+        ]
+
+    def __info_stats(self):
+        commands = self.commands.values()
+        return [
+            ("total_connections_received", self.total_connections),
+            ("total_commands_processed", sum(command.calls for command in commands)),
+            ("expired_keys", sum(shard.expired_keys for shard in self.keyspace.shards)),
+            ("evicted_keys", self.evictor.evicted_keys),
+            ("slowlog_len", len(self.slowlog)),
+        ]
+
+    def __info_commandstats(self):
+        fields = []
+        for command in self.commands.values():
+            if command.calls:
+                usec = command.duration_ns // 1000
+                fields.append((
+                    f"cmdstat_{command.name}",
+                    f"calls={command.calls},usec={usec},usec_per_call={usec / command.calls:.2f}",
+                ))
+        return fields
+
+    def __info_latencystats(self):
+        fields = []
+        for command in self.commands.values():
+            if any(command.histogram):
+                percentiles = ",".join(
+                    f"p{label}={histogram_percentile(command.histogram, fraction):.3f}"
+                    for label, fraction in (("50", 0.5), ("99", 0.99), ("99.9", 0.999))
+                )
+                fields.append((f"latency_percentiles_usec_{command.name}", percentiles))
+        return fields
+
+    def __info_keyspace(self):
+        keys = expires = 0
+        for shard in self.keyspace.shards:
+            keys += len(shard.dictionary) + len(shard.streams)
+            expires += len(shard.expires)
+        return [("db0", f"keys={keys},expires={expires},avg_ttl=0")] if keys else []
+
+    def handle_slowlog(self, connection, args):
+        subcommand = args[1].upper()
+        if subcommand == b"GET" and len(args) <= 3:
+            try:
+                count = int(args[2]) if len(args) == 3 else 10
+            except ValueError:
+                connection.sendall(b"-ERR value is out of range, must be positive\r\n")
+                return
+            if count < -1:
+                connection.sendall(b"-ERR count should be greater than or equal to -1\r\n")
+                return
+            entries = self.slowlog.latest(count)
+            reply = connection.reply
+            reply.array(len(entries))
+            for entry in entries:
+                reply.array(6)
+                reply.integer(entry.id)
+                reply.integer(entry.timestamp)
+                reply.integer(entry.duration_us)
+                reply.bulks(entry.args)
+                reply.bulk(entry.client.encode())
+                # Clients have no names here
+                reply.bulk(b"")
+        elif subcommand == b"LEN" and len(args) == 2:
+            connection.reply.integer(len(self.slowlog))
+        elif subcommand == b"RESET" and len(args) == 2:
+            self.slowlog.reset()
+            connection.sendall(b"+OK\r\n")
+        else:
+            connection.sendall(
+                b"-ERR unknown subcommand or wrong number of arguments for '" + args[1] + b"'. Try SLOWLOG HELP.\r\n"
+            )
+
+    def handle_latency(self, connection, args):
+        subcommand = args[1].upper()
+        reply = connection.reply
+        if subcommand == b"LATEST" and len(args) == 2:
+            latest = self.latency.latest()
+            reply.array(len(latest))
+            for name, timestamp, ms, max_ms in latest:
+                reply.array(4)
+                reply.bulk(name.encode())
+                reply.integer(timestamp)
+                reply.integer(ms)
+                reply.integer(max_ms)
+        elif subcommand == b"HISTORY" and len(args) == 3:
+            samples = self.latency.history(args[2].decode(errors="replace"))
+            reply.array(len(samples))
+            for timestamp, ms in samples:
+                reply.array(2)
+                reply.integer(timestamp)
+                reply.integer(ms)
+        elif subcommand == b"RESET":
+            reply.integer(self.latency.reset([arg.decode(errors="replace") for arg in args[2:]]))
+        elif subcommand == b"HISTOGRAM":
+            names = {arg.lower() for arg in args[2:]}
+            commands = [
+                command for name, command in self.commands.items()
+                if (not names or name in names) and any(command.histogram)
+            ]
+            # RESP2 has no maps, so like redis-cli shows them: flat name/value arrays
+            reply.array(len(commands) * 2)
+            for command in commands:
+                reply.bulk(command.name.encode())
+                buckets = cumulative_histogram(command.histogram)
+                reply.array(4)
+                reply.bulk(b"calls")
+                reply.integer(sum(command.histogram))
+                reply.bulk(b"histogram_usec")
+                reply.array(len(buckets) * 2)
+                for usec, calls in buckets:
+                    reply.integer(usec)
+                    reply.integer(calls)
+        else:
+            connection.sendall(
+                b"-ERR unknown subcommand or wrong number of arguments for '" + args[1] + b"'. Try LATENCY HELP.\r\n"
+            )
+
+    def __info_replication(self):
+        replication = self.replication
+        link = self.master_link
+        now = time.time()
+        fields = [("role", "master" if link is None else "slave")]
+        if link is not None:
+            fields += [
+                ("master_host", link.host),
+                ("master_port", link.port),
+                ("master_link_status", "up" if link.state == "connected" else "down"),
+                ("master_last_io_seconds_ago", int(now - link.last_io)),
+                ("master_sync_in_progress", int(link.state == "sync")),
+                ("slave_read_repl_offset", replication.offset()),
+                ("slave_repl_offset", replication.offset()),
+                ("slave_priority", 100),
+                ("slave_read_only", 1),
+            ]
+        replicas = list(replication.replicas)
+        fields.append(("connected_slaves", len(replicas)))
+        for i, replica in enumerate(replicas):
+            state = "online" if replica.online else "wait_bgsave"
+            lag = int(now - replica.ack_time)
+            fields.append((f"slave{i}", f"ip={replica.ip},port={replica.port},state={state},offset={replica.ack},lag={lag}"))
+        backlog = replication.backlog
+        fields += [
+            ("master_failover_state", "no-failover"),
+            ("master_replid", replication.replid),
+            ("master_replid2", replication.replid2),
+            ("master_repl_offset", replication.offset()),
+            # Like Redis, the first offset the old ID does not cover
+            ("second_repl_offset", replication.second_offset + 1 if replication.second_offset >= 0 else -1),
+            ("repl_backlog_active", int(backlog is not None)),
+            ("repl_backlog_size", replication.backlog_size),
+            ("repl_backlog_first_byte_offset", backlog.first_offset() + 1 if backlog is not None else 0),
+            ("repl_backlog_histlen", backlog.histlen if backlog is not None else 0),
+        ]
+        return fields
+
+    def handle_replicaof(self, connection, args):
+        if self.router is not None:
+            connection.sendall(b"-ERR REPLICAOF is not supported in --workers mode\r\n")
+            return
+        if args[1].upper() == b"NO" and args[2].upper() == b"ONE":
+            self.config.set("replicaof", "")
+        else:
+            try:
+                port = int(args[2])
+            except ValueError:
+                connection.sendall(b"-ERR Invalid master port\r\n")
+                return
+            self.config.set("replicaof", f"{args[1].decode(errors='replace')} {port}")
+        self.follow_master()
+        connection.sendall(b"+OK\r\n")
+
+    def follow_master(self):
+        """Replicate the master the replicaof setting names, or stop replicating if it is empty"""
+        target = self.config.get("replicaof").split()
+        if target and len(target) != 2:
+            raise ValueError(f"replicaof must be 'host port', got '{self.config.get('replicaof')}'")
+        master = (target[0], int(target[1])) if target else None
+        link = self.master_link
+        if link is not None:
+            if (link.host, link.port) == master:
+                return
+            link.stop()
+            self.master_link = None
+            if master is None:
+                self.replication.promote()
+        if master is not None:
+            self.master_link = MasterLink(self, *master)
+
+    def handle_replconf(self, connection, args):
+        # Only listening-port is kept, for INFO; capabilities are accepted as they come
+        if len(args) == 3 and args[1].lower() == b"listening-port":
+            try:
+                connection.listening_port = int(args[2])
+            except ValueError:
+                connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+                return
+        connection.sendall(b"+OK\r\n")
+
+    def handle_psync(self, connection, args):
+        if self.router is not None:
+            connection.sendall(b"-ERR PSYNC is not supported in --workers mode\r\n")
+            return
+        try:
+            offset = int(args[2])
+        except ValueError:
+            connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+            return
+        replication = self.replication
+        listening_port = connection.listening_port
+        sock = connection.detach()
+        start = replication.continue_position(args[1].decode(errors="replace"), offset)
+        if start is not None:
+            reply = b"+CONTINUE " + replication.replid.encode() + b"\r\n"
+            replication.attach(sock, listening_port, start, lambda sock: sock.sendall(reply), self.__replica_acked)
+            return
+        with self.keyspace.lock_all():
+            # The snapshot and the stream position it ends at are taken together
+            start = replication.full_sync_position()
+            pid = self.__fork()
+            if pid == 0:
+                status = 1
+                try:
+                    self.__save_snapshot(self.__sync_path(os.getpid()))
+                    status = 0
+                finally:
+                    os._exit(status)
+            preamble = functools.partial(self.__send_full_sync, pid, replication.replid, start)
+            replication.attach(sock, listening_port, start, preamble, self.__replica_acked)
+
+    def __send_full_sync(self, pid, replid, start, sock):
+        """Send a replica +FULLRESYNC and the snapshot the child pid writes for it"""
+        sock.sendall(b"+FULLRESYNC %s %d\r\n" % (replid.encode(), start))
+        _, status = os.waitpid(pid, 0)
+        path = self.__sync_path(pid)
+        try:
+            if os.waitstatus_to_exitcode(status) != 0:
+                raise OSError("the snapshot for the replica could not be written")
+            with open(path, "rb") as file:
+                sock.sendall(b"$%d\r\n" % os.fstat(file.fileno()).st_size)
+                sock.sendfile(file)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __sync_path(self, pid):
+        return os.path.join(self.config.get("dir"), f"temp-sync-{pid}.rdb")
+
+    def __replica_acked(self):
+        self.blocking.wake(REPLICA_ACKS)
+
+    def handle_wait(self, connection, args):
+        try:
+            numreplicas = int(args[1])
+            timeout = int(args[2])
+        except ValueError:
+            connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+            return
+        if timeout < 0:
+            connection.sendall(b"-ERR timeout is negative\r\n")
+            return
+        if self.master_link is not None:
+            connection.sendall(b"-ERR WAIT cannot be used with replica instances.\r\n")
+            return
+        replication = self.replication
+        # Every write this client made is in the stream up to here
+        target = replication.offset()
+        acked = replication.acked(target)
+        if acked >= numreplicas:
+            connection.reply.integer(acked)
+            return
+        deadline = time.time() + timeout / 1000 if timeout > 0 else None
+        waiter = self.blocking.block(
+            connection, [REPLICA_ACKS], lambda key: self.__enough_acks(target, numreplicas),
+            deadline, lambda: integer(replication.acked(target))
+        )
+        # Asking only once registered means no ACK is missed; one that
+        # serves the waiter before connection.block() is handled there
+        replication.request_acks()
+        self.commit_writes()
+        connection.block(waiter)
+
+    def __enough_acks(self, target, numreplicas):
+        acked = self.replication.acked(target)
+        return integer(acked) if acked >= numreplicas else None
+
+    def __fork(self):
+        """fork() for a background save or rewrite; the caller holds every shard lock"""
+        # Forking with every shard locked hands the child a keyspace that
+        # no other thread was halfway through changing
+        with warnings.catch_warnings():
+            # fork() warns in threaded processes; the child only writes
+            # the keyspace out and exits, touching no other lock
+            warnings.simplefilter("ignore", DeprecationWarning)
+            start = perf_counter_ns()
+            pid = os.fork()
+        if pid:
+            self.__monitor_latency("fork", start)
+        return pid
+
+    def propagate(self, args):
+        """Log a write as the command that repeats its effect; the caller holds the key's shard lock"""
+        if self.aof is not None:
+            self.aof.append(args)
+        # A replica passes its master's stream on as it arrived instead
+        if self.master_link is None:
+            self.replication.feed(args)
+
+    def commit_writes(self):
+        """Get logged writes into the AOF, per appendfsync, before their replies are sent"""
+        if self.aof is not None:
+            self.aof.commit()
+
+    def load_aof(self):
+        """Replay dir/appendfilename and log to it from then on; returns the commands replayed.
+
+        Without an AOF yet, one is written from the RDB snapshot, if any, so
+        the log starts from the data the server already has.
+        """
+        path = self.__aof_path()
+        replayed = 0
+        if os.path.exists(path):
+            connection = Connection(None)
+
+            # Straight to the handlers: replayed writes already fit in
+            # memory once, and are not client calls for the stats
+            def execute(args):
+                command = self.commands.get(args[0].lower())
+                if command is None or not command.check_arity(len(args)):
+                    raise ProtocolError(f"invalid command '{args[0].decode(errors='replace')}' in the AOF")
+                command.handler(connection, args)
+                connection.reply.take()
+
+            replayed = replay_aof(path, execute)
+        else:
+            self.load_snapshot()
+            with self.keyspace.lock_all():
+                rewrite_aof(path, self.__snapshot_entries())
+        self.aof = AppendOnlyFile(path, self.config.get("appendfsync"))
+        return replayed
+
+    def load_snapshot(self, owns=None):
+        """Load dir/dbfilename if it exists, keeping the keys owns(key) accepts; returns the key count"""
+        path = self.__snapshot_path()
+        if not os.path.exists(path):
+            return 0
+        with self.keyspace.lock_all():
+            return self.__load_entries(load_rdb(path), owns)
+
+    def load_full_sync(self, payload, replid, offset):
+        """Replace the keyspace with the snapshot a master sent and take over its history"""
+        with self.keyspace.lock_all():
+            for key in [key for key, _ in self.keyspace.items()]:
+                self.__delete_key(key)
+            self.__load_entries(read_rdb(io.BytesIO(payload)))
+        self.replication.reset(replid, offset)
+        # The log so far describes the old data set
+        if self.aof is not None:
+            self.__start_rewrite()
+
+    def __load_entries(self, entries, owns=None):
+        """Add (key, value, expire) entries to the keyspace; the caller holds every shard lock"""
+        now = current_ms()
+        loaded = 0
+        for key, value, expire in entries:
+            # Keys whose TTL ran out while the server was down are dropped
+            if (expire is not None and expire < now) or (owns is not None and not owns(key)):
+                continue
+            shard = self.keyspace.shard(key)
+            if isinstance(value, Stream):
+                shard.streams[key] = value
             else:
-                connection.sendall(b"-ERR wrong number of arguments for 'set' command\r\n")
+                shard.dictionary[key] = value
+            shard.index_key(key)
+            if expire is not None:
+                shard.expires.set(key, expire)
+            if self.evictor.enabled:
+                self.evictor.track(key, estimate_value(value))
+            loaded += 1
+        return loaded
+
+    def __save_snapshot(self, path=None):
+        """Write the keyspace to path, dir/dbfilename by default; the caller holds every shard lock"""
+        shards = self.keyspace.shards
+        save_rdb(
+            path or self.__snapshot_path(),
+            self.__snapshot_entries(),
+            sum(len(shard.dictionary) + len(shard.streams) for shard in shards),
+            sum(len(shard.expires) for shard in shards),
+            aux=[(b"redis-ver", b"7.2.0"), (b"redis-bits", b"64"), (b"ctime", b"%d" % time.time())],
+        )
+
+    def __snapshot_entries(self):
+        for shard in self.keyspace.shards:
+            deadlines = shard.expires.deadlines
+            for table in (shard.dictionary, shard.streams):
+                for key, value in table.items():
+                    yield key, value, deadlines.get(key)
+
+    def __snapshot_path(self):
+        return os.path.join(self.config.get("dir"), self.config.get("dbfilename"))
+
+    def __aof_path(self):
+        return os.path.join(self.config.get("dir"), self.config.get("appendfilename"))
+
+    def __rewrite_temp_path(self, pid):
+        return os.path.join(self.config.get("dir"), f"temp-rewriteaof-bg-{pid}.aof")
+
+    def __reap_rewrite_child(self):
+        with self.save_lock:
+            if self.rewrite_child is None:
+                return
+            pid, status = os.waitpid(self.rewrite_child, os.WNOHANG)
+            if pid == 0:
+                return
+            self.rewrite_child = None
+            temp_path = self.__rewrite_temp_path(pid)
+            try:
+                if os.waitstatus_to_exitcode(status) != 0:
+                    raise OSError("the rewrite child exited with an error")
+                if self.aof is not None:
+                    self.aof.finish_rewrite(temp_path)
+                else:
+                    os.replace(temp_path, self.__aof_path())
+            except OSError as e:
+                print(f"Background AOF rewrite failed: {e}")
+                if self.aof is not None:
+                    self.aof.abort_rewrite()
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    def __reap_save_child(self):
+        with self.save_lock:
+            if self.save_child is None:
+                return
+            pid, status = os.waitpid(self.save_child, os.WNOHANG)
+            if pid == 0:
+                return
+            self.save_child = None
+            self.last_bgsave_ok = os.waitstatus_to_exitcode(status) == 0
+            if self.last_bgsave_ok:
+                self.last_save = int(time.time())
+
+    def __apply_memory_config(self):
+        with self.keyspace.lock_all():
+            self.evictor.configure(
+                int(self.config.get("maxmemory")),
+                self.config.get("maxmemory-policy"),
+                int(self.config.get("maxmemory-samples")),
+                self.keyspace.items(),
+            )
+
+    def __perform_evictions(self):
+        """Evict keys until the memory estimate fits maxmemory; False if it cannot"""
+        if not self.evictor.over_limit():
+            return True
+        start = perf_counter_ns()
+        fits = self.__evict()
+        self.__monitor_latency("eviction-cycle", start)
+        return fits
+
+    def __evict(self):
+        evictor = self.evictor
+        if evictor.cached:
+            self.__drop_replies()
+        while evictor.over_limit():
+            if evictor.policy == "noeviction":
+                return False
+            volatile_keys = self.keyspace.sample_volatile(evictor.samples) if evictor.volatile else None
+            key = evictor.pick_victim(volatile_keys, self.keyspace.deadline)
+            if key is None:
+                return False
+            with self.keyspace.shard(key).lock:
+                # Deleting a key another client already removed still
+                # drops whatever accounting is left for it
+                if self.__delete_key(key):
+                    evictor.evicted_keys += 1
+                    # Otherwise an AOF replay or a replica would keep the key
+                    self.propagate([b"DEL", key])
+        return True
+
+    def handle_set(self, connection, args):
+        try:
+            key = args[1]
+            value = args[2]
+            expiry = None
+            # Check for PX / EX / PXAT / EXAT arguments
+            i = 3
+            while i < len(args):
+                option = args[i].upper()
+                if option in (b"PX", b"EX", b"PXAT", b"EXAT") and i + 1 < len(args):
+                    try:
+                        amount = int(args[i + 1])
+                    except ValueError:
+                        connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+                        return
+                    if amount <= 0:
+                        connection.sendall(b"-ERR invalid expire time in 'set' command\r\n")
+                        return
+                    ms = amount if option in (b"PX", b"PXAT") else amount * 1000
+                    expiry = ms if option.endswith(b"AT") else current_ms() + ms
+                    i += 2
+                else:
+                    connection.sendall(b"-ERR syntax error\r\n")
+                    return
+            shard = self.keyspace.shard(key)
+            with shard.lock:
+                self.__store_string(key, value)
+                if expiry is not None:
+                    shard.expires.set(key, expiry)
+                # A relative TTL is logged as its deadline, so replay keeps it
+                if expiry is None:
+                    self.propagate([b"SET", key, value])
+                else:
+                    self.propagate([b"SET", key, value, b"PXAT", b"%d" % expiry])
+            connection.sendall(b"+OK\r\n")
         except Exception:
-            connection.sendall(b"-ERR wrong number of arguments for 'set' command\r\n")
+            connection.sendall(b"-ERR error processing 'set' command\r\n")
+
+    def __store_string(self, key, value):
+        """Set key to a string value; the caller holds the key's shard lock"""
+        # Like SET, this replaces whatever the key held, including its TTL
+        shard = self.keyspace.shard(key)
+        if not self.__delete_key(key, replacing=True):
+            shard.index_key(key)
+        stored = shard.dictionary[key] = compact_string(value)
+        if self.evictor.enabled:
+            self.evictor.track(key, estimate_value(stored))
 
-    def handle_get(self, connection, data):
-        parts = data.split(b"\r\n")
+    def __encoded_string(self, shard, key, value):
+        """key's string value as a RESP bulk string, cached in shard; the caller holds the shard lock"""
+        encoded = shard.replies.get(key)
+        if encoded is None:
+            encoded = bulk(string_bytes(value))
+            # Large values are sent by reference already, so only small ones are worth a copy
+            if len(encoded) < LARGE_BULK:
+                shard.replies[key] = encoded
+                self.evictor.track_cached(len(encoded))
+        return encoded
+
+    def __drop_reply(self, shard, key):
+        """Forget key's cached GET reply; the caller holds the shard lock"""
+        encoded = shard.replies.pop(key, None)
+        if encoded is not None:
+            self.evictor.track_cached(-len(encoded))
+
+    def __drop_replies(self):
+        """Empty every shard's GET reply cache, the cheapest memory to give back"""
+        for shard in self.keyspace.shards:
+            with shard.lock:
+                freed = sum(len(encoded) for encoded in shard.replies.values())
+                shard.replies = {}
+            self.evictor.track_cached(-freed)
+
+    def handle_get(self, connection, args):
         try:
-            dollar_indices = [i for i, part in enumerate(parts) if part.startswith(b"$")]
-            if len(dollar_indices) >= 2:
-                key_index = dollar_indices[1] + 1
-                key = parts[key_index]
-                entry = self.dictionary.get(key, None)
-                if entry is None:
-                    connection.sendall(b"$-1\r\n")
+            key = args[1]
+            shard = self.keyspace.shard(key)
+            with shard.lock:
+                value = self.__search_dictionary(key)
+                if value is None:
+                    connection.sendall(NULL_BULK)
                     return
-                value, expiry = entry
-                # Check expiry
-                if expiry is not None and time.time() > expiry:
-                    # Key expired, remove it
-                    del self.dictionary[key]
-                    connection.sendall(b"$-1\r\n")
+                if isinstance(value, CONTAINER_TYPES):
+                    connection.sendall(WRONGTYPE_ERROR)
                     return
-                response = b"$" + str(len(value)).encode() + b"\r\n" + value + b"\r\n"
-                connection.sendall(response)
-            else:
-                connection.sendall(b"-ERR wrong number of arguments for 'get' command\r\n")
+                encoded = self.__encoded_string(shard, key, value)
+            connection.sendall(encoded)
         except Exception:
-            connection.sendall(b"-ERR wrong number of arguments for 'get' command\r\n")
+            connection.sendall(b"-ERR error processing 'get' command\r\n")
 
-    def handle_rpush(self, connection, data):
-        parts = data.split(b"\r\n")
-        try:
-            dollar_indices = [i for i, part in enumerate(parts) if part.startswith(b"$")]
-            if len(dollar_indices) < 3:
-                connection.sendall(b"-ERR wrong number of arguments for 'rpush' command\r\n")
-                return
-            key_index = dollar_indices[1] + 1
-            key = parts[key_index]
-            # All remaining $ indices are values
-            values = [parts[dollar_indices[i] + 1] for i in range(2, len(dollar_indices))]
-            values = [v for v in values if v != b'']
-            entry = self.dictionary.get(key)
-            if entry is not None:
-                current_value, expiry = entry
-                if not isinstance(current_value, list):
-                    connection.sendall(b"-ERR wrong type\r\n")
+    def handle_mget(self, connection, args):
+        keys = args[1:]
+        replies = []
+        # One acquisition of every shard involved serves the whole batch
+        with self.keyspace.lock(keys):
+            for key in keys:
+                value = self.__search_dictionary(key)
+                if value is None or isinstance(value, CONTAINER_TYPES):
+                    replies.append(NULL_BULK)
+                else:
+                    replies.append(self.__encoded_string(self.keyspace.shard(key), key, value))
+        reply = connection.reply
+        reply.array(len(replies))
+        for encoded in replies:
+            reply.write(encoded)
+
+    def handle_mset(self, connection, args):
+        if len(args) % 2 == 0:
+            connection.sendall(b"-ERR wrong number of arguments for 'mset' command\r\n")
+            return
+        with self.keyspace.lock(args[1::2]):
+            for i in range(1, len(args), 2):
+                self.__store_string(args[i], args[i + 1])
+            self.propagate([b"MSET"] + args[1:])
+        connection.sendall(b"+OK\r\n")
+
+    def handle_msetnx(self, connection, args):
+        if len(args) % 2 == 0:
+            connection.sendall(b"-ERR wrong number of arguments for 'msetnx' command\r\n")
+            return
+        keys = args[1::2]
+        with self.keyspace.lock(keys):
+            if any(self.__key_exists(key) for key in keys):
+                connection.reply.integer(0)
+                return
+            for i in range(1, len(args), 2):
+                self.__store_string(args[i], args[i + 1])
+            self.propagate([b"MSET"] + args[1:])
+        connection.reply.integer(1)
+
+    def handle_incr(self, connection, args):
+        self.__handle_incr(connection, args, 1)
+
+    def handle_decr(self, connection, args):
+        self.__handle_incr(connection, args, -1)
+
+    def handle_incrby(self, connection, args):
+        increment = parse_int64(args[2])
+        if increment is None:
+            connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+            return
+        self.__handle_incr(connection, args, increment)
+
+    def handle_decrby(self, connection, args):
+        decrement = parse_int64(args[2])
+        if decrement is None:
+            connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+            return
+        if decrement == INT64_MIN:
+            connection.sendall(b"-ERR decrement would overflow\r\n")
+            return
+        self.__handle_incr(connection, args, -decrement)
+
+    def __handle_incr(self, connection, args, increment):
+        """INCR and friends: add increment to the integer at args[1], keeping its TTL"""
+        key = args[1]
+        shard = self.keyspace.shard(key)
+        with shard.lock:
+            value = self.__search_dictionary(key)
+            if (value is None and key in shard.streams) or isinstance(value, CONTAINER_TYPES):
+                connection.sendall(WRONGTYPE_ERROR)
+                return
+            if value is None:
+                current = 0
+            elif value.__class__ is int:
+                current = value
+            else:
+                current = parse_int64(value)
+                if current is None:
+                    connection.sendall(b"-ERR value is not an integer or out of range\r\n")
                     return
-                current_value.extend(values)
-                lst = current_value
+            result = current + increment
+            if not INT64_MIN <= result <= INT64_MAX:
+                connection.sendall(b"-ERR increment or decrement would overflow\r\n")
+                return
+            self.__replace_string(key, value, stored_integer(result))
+            self.propagate(args)
+        connection.reply.integer(result)
+
+    def handle_incrbyfloat(self, connection, args):
+        key = args[1]
+        increment = parse_float(args[2])
+        if increment is None:
+            connection.sendall(b"-ERR value is not a valid float\r\n")
+            return
+        shard = self.keyspace.shard(key)
+        with shard.lock:
+            value = self.__search_dictionary(key)
+            if (value is None and key in shard.streams) or isinstance(value, CONTAINER_TYPES):
+                connection.sendall(WRONGTYPE_ERROR)
+                return
+            current = 0.0 if value is None else parse_float(string_bytes(value))
+            if current is None:
+                connection.sendall(b"-ERR value is not a valid float\r\n")
+                return
+            result = current + increment
+            if not math.isfinite(result):
+                connection.sendall(b"-ERR increment would produce NaN or Infinity\r\n")
+                return
+            formatted = format_float(result)
+            self.__replace_string(key, value, compact_string(formatted))
+            # Logged as the value it produced, so replay cannot round differently
+            expiry = shard.expires.get(key)
+            if expiry is None:
+                self.propagate([b"SET", key, formatted])
+            else:
+                self.propagate([b"SET", key, formatted, b"PXAT", b"%d" % expiry])
+        connection.reply.bulk(formatted)
+
+    def __replace_string(self, key, old, stored):
+        """Store a computed string value in place of old, None for a new key, keeping the TTL.
+
+        The caller holds the key's shard lock.
+        """
+        shard = self.keyspace.shard(key)
+        shard.dictionary[key] = stored
+        if old is None:
+            shard.index_key(key)
+            if self.evictor.enabled:
+                self.evictor.track(key, estimate_value(stored))
+            return
+        self.__drop_reply(shard, key)
+        if self.evictor.enabled:
+            self.evictor.track(key, estimate_value(stored) - estimate_value(old))
+
+    def handle_del(self, connection, args):
+        self.__handle_delete(connection, args, lazy=False)
+
+    def handle_unlink(self, connection, args):
+        self.__handle_delete(connection, args, lazy=True)
+
+    def __handle_delete(self, connection, args, lazy):
+        deleted = []
+        with self.keyspace.lock(args[1:]):
+            for key in args[1:]:
+                # Checking first leaves keys whose TTL already ran out uncounted
+                if not self.__key_exists(key):
+                    continue
+                value = self.__remove_key(key)
+                deleted.append(key)
+                if lazy:
+                    self.lazyfree.free(value)
+            if deleted:
+                self.propagate([args[0].upper()] + deleted)
+        connection.reply.integer(len(deleted))
+
+    def handle_exists(self, connection, args):
+        with self.keyspace.lock(args[1:]):
+            # A key named twice counts twice, as in Redis
+            count = sum(self.__key_exists(key) for key in args[1:])
+        connection.reply.integer(count)
+
+    def handle_scan(self, connection, args):
+        if self.router is not None:
+            connection.sendall(b"-ERR SCAN is not supported in --workers mode\r\n")
+            return
+        try:
+            cursor = int(args[1])
+        except ValueError:
+            cursor = -1
+        if cursor < 0:
+            connection.sendall(b"-ERR invalid cursor\r\n")
+            return
+        options = self.__parse_scan_options(connection, args, 2, allow_type=True)
+        if options is None:
+            return
+        keys, cursor = self.__scan(cursor, *options)
+        reply = connection.reply
+        reply.array(2)
+        reply.bulk(b"%d" % cursor)
+        reply.bulks(keys)
+
+    def __parse_scan_options(self, connection, args, i, allow_type):
+        """(pattern, count, type) from the [MATCH p] [COUNT n] [TYPE t] options at args[i:], or None after an error"""
+        pattern = None
+        count = 10
+        type_name = None
+        while i < len(args):
+            option = args[i].upper()
+            if i + 1 >= len(args):
+                connection.sendall(b"-ERR syntax error\r\n")
+                return None
+            if option == b"MATCH":
+                # A lone * matches everything, so it is not worth running
+                pattern = compile_glob(args[i + 1]) if args[i + 1] != b"*" else None
+            elif option == b"COUNT":
+                try:
+                    count = int(args[i + 1])
+                except ValueError:
+                    connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+                    return None
+                if count < 1:
+                    connection.sendall(b"-ERR syntax error\r\n")
+                    return None
+            elif option == b"TYPE" and allow_type:
+                type_name = args[i + 1].lower()
             else:
-                lst = values
-                expiry = None
-            self.dictionary[key] = (lst, expiry)
-            response = b":" + str(len(lst)).encode() + b"\r\n"
+                connection.sendall(b"-ERR syntax error\r\n")
+                return None
+            i += 2
+        return pattern, count, type_name
+
+    def __scan(self, cursor, pattern, count, type_name):
+        """Walk each shard's scan_order from cursor until count keys are found; returns them and the next cursor.
+
+        The cursor is a shard index, a position in its scan_order and the
+        shard's scan_epoch. A shard is read under its lock alone, so a scan
+        never holds up more than one shard at a time. Positions only move
+        when scan_order is compacted, which bumps scan_epoch; a cursor from
+        an older epoch starts that shard over, returning some keys twice as
+        Redis allows, but a key that exists for the whole scan is returned
+        at least once. The cursor is 0 once no shard has keys left.
+        """
+        shards = self.keyspace.shards
+        rest, index = divmod(cursor, len(shards))
+        position, epoch = rest >> SCAN_EPOCH_BITS, rest & SCAN_EPOCH_MASK
+        found = []
+        # Bounds the entries a call walks past when deleted keys, TYPE or
+        # expired keys leave them empty-handed, like Redis' maxiterations
+        budget = count * 10
+        while index < len(shards) and len(found) < count and budget > 0:
+            shard = shards[index]
+            expired = []
+            with shard.lock:
+                if epoch != shard.scan_epoch & SCAN_EPOCH_MASK:
+                    position = 0
+                epoch = shard.scan_epoch & SCAN_EPOCH_MASK
+                order = shard.scan_order
+                end = min(len(order), position + budget)
+                while position < end and len(found) < count:
+                    key = order[position]
+                    position += 1
+                    budget -= 1
+                    if key not in shard.dictionary and key not in shard.streams:
+                        continue
+                    if key in shard.expires and shard.expires.is_expired(key):
+                        expired.append(key)
+                    elif type_name is None or self.__type_name(shard, key) == type_name:
+                        found.append(key)
+                # Deleted after the walk, as a delete may compact scan_order
+                for key in expired:
+                    self.__delete_key(key)
+                    shard.expired_keys += 1
+                if position >= len(order):
+                    index += 1
+                    position = 0
+        # Skip shards with nothing left, so the last page ends the scan
+        while index < len(shards):
+            shard = shards[index]
+            with shard.lock:
+                if position < len(shard.scan_order) or epoch != shard.scan_epoch & SCAN_EPOCH_MASK:
+                    break
+            index += 1
+            position = 0
+        if pattern is not None:
+            found = [key for key in found if pattern.fullmatch(key)]
+        if index >= len(shards):
+            return found, 0
+        return found, (position << SCAN_EPOCH_BITS | epoch) * len(shards) + index
+
+    def __type_name(self, shard, key):
+        """TYPE's answer for a key of shard, which the caller holds the lock of"""
+        if key in shard.streams:
+            return b"stream"
+        value = shard.dictionary.get(key)
+        if value is None:
+            return b"none"
+        if isinstance(value, LIST_TYPES):
+            return b"list"
+        return b"hash" if isinstance(value, HASH_TYPES) else b"string"
+
+    def handle_keys(self, connection, args):
+        if self.router is not None:
+            connection.sendall(b"-ERR KEYS is not supported in --workers mode\r\n")
+            return
+        pattern = compile_glob(args[1]) if args[1] != b"*" else None
+        now = current_ms()
+        keys = []
+        # One shard at a time, so other clients only ever wait on the shard being read
+        for shard in self.keyspace.shards:
+            with shard.lock:
+                for table in (shard.dictionary, shard.streams):
+                    keys.extend(
+                        key for key in table
+                        if (pattern is None or pattern.fullmatch(key))
+                        and not (key in shard.expires and shard.expires.is_expired(key, now))
+                    )
+        connection.reply.bulks(keys)
+
+    def handle_dbsize(self, connection, args):
+        if self.router is not None:
+            connection.sendall(b"-ERR DBSIZE is not supported in --workers mode\r\n")
+            return
+        # Reading the table sizes without their locks is safe, if momentarily stale
+        connection.reply.integer(sum(len(shard.dictionary) + len(shard.streams) for shard in self.keyspace.shards))
+
+    def handle_rpush(self, connection, args):
+        try:
+            key = args[1]
+            # All remaining arguments are values
+            values = args[2:]
+            shard = self.keyspace.shard(key)
+            with shard.lock:
+                lst = self.__search_dictionary(key)
+                if lst is not None or self.__search_stream(key) is not None:
+                    if not isinstance(lst, LIST_TYPES):
+                        connection.sendall(WRONGTYPE_ERROR)
+                        return
+                    lst.extend(values)
+                    self.__list_pushed(key, lst, values)
+                else:
+                    lst = self.__list_created(key, new_list(values))
+                response = integer(len(lst))
+                self.propagate(args)
+                # Serve clients blocked on this key, after this reply is computed
+                self.blocking.wake(key)
             connection.sendall(response)
         except Exception:
             connection.sendall(b"-ERR error processing 'rpush' command\r\n")
 
-    def handle_lrange(self, connection, data):
-        parts = data.split(b"\r\n")
+    def __list_created(self, key, lst):
+        shard = self.keyspace.shard(key)
+        shard.dictionary[key] = lst
+        shard.index_key(key)
+        if self.evictor.enabled:
+            self.evictor.track(key, estimate_value(lst))
+        return lst
+
+    def __list_pushed(self, key, lst, values):
+        """Bookkeeping after pushing values onto a list: unpack it once it outgrows the packed encoding"""
+        if self.evictor.enabled:
+            self.evictor.track(key, estimate_list_items(lst, values))
+        if lst.__class__ is ListPack and not lst.fits():
+            converted = self.keyspace.shard(key).dictionary[key] = deque(lst)
+            if self.evictor.enabled:
+                self.evictor.track(key, estimate_value(converted) - estimate_value(lst))
+
+    def handle_lrange(self, connection, args):
         try:
-            dollar_indices = [i for i, part in enumerate(parts) if part.startswith(b"$")]
-            if len(dollar_indices) < 4:
-                connection.sendall(b"-ERR wrong number of arguments for 'lrange' command\r\n")
-                return
-            key_index = dollar_indices[1] + 1
-            start_index = dollar_indices[2] + 1
-            end_index = dollar_indices[3] + 1
-            key = parts[key_index]
+            key = args[1]
             try:
-                start = int(parts[start_index])
-                end = int(parts[end_index])
+                start = int(args[2])
+                end = int(args[3])
             except ValueError:
-                connection.sendall(b"-ERR start or end is not an integer\r\n")
-                return
-            entry = self.dictionary.get(key)
-            if entry is None:
-                connection.sendall(b"*0\r\n")
-                return
-            value, expiry = entry
-            if not isinstance(value, list):
-                connection.sendall(b"-ERR wrong type\r\n")
-                return
-            # Handle negative indices
-            if start < 0:
-                start += len(value)
-            if end < 0:
-                end += len(value)
-            # Adjust end to be inclusive
-            end += 1
-            # Slice the list safely
-            sliced = value[max(0, start):min(len(value), end)]
-            response = b"*" + str(len(sliced)).encode() + b"\r\n"
-            for item in sliced:
-                response += b"$" + str(len(item)).encode() + b"\r\n" + item + b"\r\n"
-            connection.sendall(response)
+                connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+                return
+            with self.keyspace.shard(key).lock:
+                value = self.__search_dictionary(key)
+                if value is None:
+                    connection.sendall(EMPTY_ARRAY)
+                    return
+                if not isinstance(value, LIST_TYPES):
+                    connection.sendall(WRONGTYPE_ERROR)
+                    return
+                if value.__class__ is ListPack:
+                    # The items are stored encoded, so the reply is one slice
+                    count, encoded = value.encoded_range(start, end)
+                    connection.reply.array(count)
+                    connection.reply.write(encoded)
+                    return
+                sliced = list_range(value, start, end)
+            connection.reply.bulks(sliced)
         except Exception:
             connection.sendall(b"-ERR error processing 'lrange' command\r\n")
 
-    def handle_lpush(self, connection, data):
-        parts = data.split(b"\r\n")
+    def handle_lpush(self, connection, args):
         try:
-            dollar_indices = [i for i, part in enumerate(parts) if part.startswith(b"$")]
-            if len(dollar_indices) < 3:
-                connection.sendall(b"-ERR wrong number of arguments for 'lpush' command\r\n")
-                return
-            key_index = dollar_indices[1] + 1
-            key = parts[key_index]
-            # All remaining $ indices are values
-            values = []
-            for i in range(2, len(dollar_indices)):
-                value_index = dollar_indices[i] + 1
-                if value_index < len(parts):
-                    values.append(parts[value_index])
-            # Store or update the list in the dictionary
-            entry = self.dictionary.get(key)
-            if entry is not None:
-                current_value, expiry = entry
-                if not isinstance(current_value, list):
-                    connection.sendall(b"-ERR wrong type\r\n")
-                    return
-                for v in values:
-                    current_value.insert(0, v)
-                lst = current_value
-            else:
-                lst = list(reversed(values))
-                expiry = None
-            self.dictionary[key] = (lst, expiry)
-            # Respond with the length of the list
-            response = b":" + str(len(lst)).encode() + b"\r\n"
+            key = args[1]
+            # All remaining arguments are values
+            values = args[2:]
+            shard = self.keyspace.shard(key)
+            with shard.lock:
+                # Store or update the list in the dictionary
+                lst = self.__search_dictionary(key)
+                if lst is not None or self.__search_stream(key) is not None:
+                    if not isinstance(lst, LIST_TYPES):
+                        connection.sendall(WRONGTYPE_ERROR)
+                        return
+                    # Each value goes to the head in turn, as Redis does
+                    lst.extendleft(values)
+                    self.__list_pushed(key, lst, values)
+                else:
+                    lst = self.__list_created(key, new_list(values[::-1]))
+                # Respond with the length of the list
+                response = integer(len(lst))
+                self.propagate(args)
+                # Serve clients blocked on this key, after this reply is computed
+                self.blocking.wake(key)
             connection.sendall(response)
         except Exception:
             connection.sendall(b"-ERR error processing 'lpush' command\r\n")
 
-    def handle_llen(self, connection, data):
-        parts = data.split(b"\r\n")
+    def handle_llen(self, connection, args):
         try:
-            dollar_indices = [i for i, part in enumerate(parts) if part.startswith(b"$")]
-            if len(dollar_indices) < 2:
-                connection.sendall(b"-ERR wrong number of arguments for 'llen' command\r\n")
-                return
-            key_index = dollar_indices[1] + 1
-            key = parts[key_index]
-            entry = self.dictionary.get(key)
-            if entry is None:
+            key = args[1]
+            with self.keyspace.shard(key).lock:
+                value = self.__search_dictionary(key)
+                length = len(value) if isinstance(value, LIST_TYPES) else None
+            if value is None:
                 connection.sendall(b":0\r\n")
                 return
-            value, expiry = entry
-            # Check expiry for lists as well
-            if expiry is not None and time.time() > expiry:
-                del self.dictionary[key]
-                connection.sendall(b":0\r\n")
-                return
-            if not isinstance(value, list):
-                connection.sendall(b"-ERR wrong type\r\n")
+            if length is None:
+                connection.sendall(WRONGTYPE_ERROR)
                 return
-            response = b":" + str(len(value)).encode() + b"\r\n"
-            connection.sendall(response)
+            connection.reply.integer(length)
         except Exception:
             connection.sendall(b"-ERR error processing 'llen' command\r\n")
 
-    def handle_lpop(self, connection, data):
-        parts = data.split(b"\r\n")
+    def handle_lpop(self, connection, args):
         try:
-            dollar_indices = [i for i, part in enumerate(parts) if part.startswith(b"$")]
-            if len(dollar_indices) < 2:
+            key = args[1]
+            count = None
+            if len(args) > 3:
                 connection.sendall(b"-ERR wrong number of arguments for 'lpop' command\r\n")
                 return
-            key_index = dollar_indices[1] + 1
-            key = parts[key_index]
-            count = None
-            if (len(dollar_indices) >= 3):
-                count_index = dollar_indices[2] + 1
+            if len(args) == 3:
                 try:
-                    count = int(parts[count_index])
+                    count = int(args[2])
                     if count <= 0:
                         connection.sendall(b"-ERR count must be positive\r\n")
                         return
                 except ValueError:
-                    connection.sendall(b"-ERR count is not an integer\r\n")
+                    connection.sendall(b"-ERR value is not an integer or out of range\r\n")
                     return
-            entry = self.dictionary.get(key)
-            if entry is None:
-                connection.sendall(b"$-1\r\n")
-                return
-            value, expiry = entry
-            if expiry is not None and time.time() > expiry:
-                del self.dictionary[key]
-                connection.sendall(b"$-1\r\n")
-                return
-            if not isinstance(value, list):
-                connection.sendall(b"-ERR wrong type\r\n")
-                return
-            if count is None:
-                if len(value) == 0:
-                    connection.sendall(b"$-1\r\n")
+            with self.keyspace.shard(key).lock:
+                value = self.__search_dictionary(key)
+                if value is None:
+                    # With a count the reply is an array, so a missing list is a null one
+                    connection.sendall(NULL_BULK if count is None else NULL_ARRAY)
                     return
-                first_element = value.pop(0)
-                self.dictionary[key] = (value, expiry)
-                response = b"$" + str(len(first_element)).encode() + b"\r\n" + first_element + b"\r\n"
-                connection.sendall(response)
-            else:
-                if count <= 0 or len(value) == 0:
-                    connection.sendall(b"*0\r\n")
+                if not isinstance(value, LIST_TYPES):
+                    connection.sendall(WRONGTYPE_ERROR)
                     return
-                popped = []
-                for _ in range(min(count, len(value))):
-                    popped.append(value.pop(0))
-                self.dictionary[key] = (value, expiry)
-                response = b"*" + str(len(popped)).encode() + b"\r\n"
-                for item in popped:
-                    response += b"$" + str(len(item)).encode() + b"\r\n" + item + b"\r\n"
-                connection.sendall(response)
+                # Lists are deleted once empty, so there is always something to pop
+                popped = [value.popleft() for _ in range(min(count or 1, len(value)))]
+                self.__list_popped(key, value, popped)
+            if count is None:
+                connection.reply.bulk(popped[0])
+            else:
+                connection.reply.bulks(popped)
         except Exception:
-            connection.sendall(b"-ERR error processing 'lop' command\r\n")
+            connection.sendall(b"-ERR error processing 'lpop' command\r\n")
 
-    def handle_blpop(self, connection, data):
-        parts = data.split(b"\r\n")
+    def handle_blpop(self, connection, args):
         try:
-            dollar_indices = [i for i, part in enumerate(parts) if part.startswith(b"$")]
-            if len(dollar_indices) < 3:
-                connection.sendall(b"-ERR wrong number of arguments for 'blpop' command\r\n")
-                return
-            key_indices = [dollar_indices[i] + 1 for i in range(1, len(dollar_indices) - 1)]
-            keys = [parts[i] for i in key_indices]
-            timeout_idx = dollar_indices[-1] + 1
+            keys = args[1:-1]
             try:
-                timeout = float(parts[timeout_idx])
-            except Exception:
-                connection.sendall(b"-ERR timeout is not a float\r\n")
-                return
-            start_time = time.time()
-            while True:
-                for key in keys:
-                    with self.lock:
-                        entry = self.dictionary.get(key)
-                        if entry is not None:
-                            value, expiry = entry
-                            if expiry is not None and time.time() > expiry:
-                                del self.dictionary[key]
-                                continue
-                            if not isinstance(value, list):
-                                connection.sendall(b"-ERR wrong type\r\n")
-                                return
-                            if len(value) > 0:
-                                first_element = value.pop(0)
-                                self.dictionary[key] = (value, expiry)
-                                response = (
-                                    b"*2\r\n"
-                                    + b"$" + str(len(key)).encode() + b"\r\n" + key + b"\r\n"
-                                    + b"$" + str(len(first_element)).encode() + b"\r\n" + first_element + b"\r\n"
-                                )
-                                connection.sendall(response)
-                                return
-                if timeout > 0 and (time.time() - start_time) >= timeout:
-                    connection.sendall(b"*-1\r\n")
-                    return
-                time.sleep(0.01)
-        except Exception:
-            connection.sendall(b"-ERR error processing 'blpop' command\r\n")
-
-    def handle_type(self, connection, data):
-        parts = data.split(b"\r\n")
-        try:
-            dollar_indices = [i for i, part in enumerate(parts) if part.startswith(b"$")]
-            if len(dollar_indices) < 2:
-                connection.sendall(b"-ERR wrong number of arguments for 'type' command\r\n")
+                timeout = float(args[-1])
+            except ValueError:
+                connection.sendall(b"-ERR timeout is not a float or out of range\r\n")
                 return
-            key_index = dollar_indices[1] + 1
-            key = parts[key_index]
-            
-            # Check dictionary first
-            value, expiry = self.__search_dictionary(key)
-            if value is not None:
-                if isinstance(value, list):
-                    connection.sendall(b"+list\r\n")
-                else:
-                    connection.sendall(b"+string\r\n")
+            if timeout < 0:
+                connection.sendall(b"-ERR timeout is negative\r\n")
                 return
-            
-            # Check streams
-            stream_data = self.__search_stream(key)
-            if stream_data is not None:
-                connection.sendall(b"+stream\r\n")
+            with self.keyspace.lock(keys):
+                response = self.__try_blpop(keys)
+                if response is None:
+                    deadline = time.time() + timeout if timeout > 0 else None
+                    waiter = self.blocking.block(
+                        connection, keys, lambda key: self.__try_blpop([key]), deadline, NULL_ARRAY, consumes=True
+                    )
+            if response is not None:
+                connection.sendall(response)
                 return
-            
-            # Key doesn't exist
-            connection.sendall(b"+none\r\n")
+            self.commit_writes()
+            connection.block(waiter)
         except Exception:
-            connection.sendall(b"-ERR error processing 'type' command\r\n")
+            connection.sendall(b"-ERR error processing 'blpop' command\r\n")
 
-    def __search_dictionary(self, key):
-        entry = self.dictionary.get(key)
-        if entry is None:
-            return None, None
-        value, expiry = entry
-        if expiry is not None and time.time() > expiry:
-            del self.dictionary[key]
-            return None, None
-        return value, expiry
-    
-    def __search_stream(self, stream_name):
-        if stream_name in self.streams:
-            return self.streams[stream_name]
+    def __try_blpop(self, keys):
+        """Pop from the first non-empty list among keys, returning the reply or None.
+
+        The caller holds the shard locks of keys.
+        """
+        for key in keys:
+            value = self.__search_dictionary(key)
+            if value is None:
+                continue
+            if not isinstance(value, LIST_TYPES):
+                return WRONGTYPE_ERROR
+            if len(value) > 0:
+                first_element = value.popleft()
+                self.__list_popped(key, value, [first_element])
+                reply = Reply()
+                reply.bulks([key, first_element])
+                return reply
         return None
 
-    def handle_xadd(self, connection, data):
-        parts = data.split(b"\r\n")
-        try:
-            dollar_indices = [i for i, part in enumerate(parts) if part.startswith(b"$")]
-            if len(dollar_indices) < 4:
-                connection.sendall(b"-ERR wrong number of arguments for 'xadd' command\r\n")
+    def __list_popped(self, key, lst, popped):
+        """Bookkeeping after popping items off a list: drop it once empty"""
+        # BLPOP is logged as the LPOP it ended up doing
+        self.propagate([b"LPOP", key, b"%d" % len(popped)])
+        if not lst:
+            self.__delete_key(key)
+        elif self.evictor.enabled:
+            self.evictor.track(key, -estimate_list_items(lst, popped))
+
+    def handle_hset(self, connection, args):
+        if len(args) % 2:
+            connection.sendall(b"-ERR wrong number of arguments for 'hset' command\r\n")
+            return
+        key = args[1]
+        shard = self.keyspace.shard(key)
+        with shard.lock:
+            hsh = self.__search_dictionary(key)
+            if hsh is None:
+                if key in shard.streams:
+                    connection.sendall(WRONGTYPE_ERROR)
+                    return
+                hsh = self.__hash_created(key)
+            elif not isinstance(hsh, HASH_TYPES):
+                connection.sendall(WRONGTYPE_ERROR)
                 return
-            
-            stream_index = dollar_indices[1] + 1
-            id_index = dollar_indices[2] + 1
-            stream_name = parts[stream_index]
-            entry_id = parts[id_index]
-            
-            # Handle different ID formats
-            final_entry_id = None
-            
-            # Auto-generated ID (full auto-generation)
-            if entry_id == b'*':
-                curr_ms = self.__get_current_milliseconds()
-                final_entry_id = f"{curr_ms}-0".encode()
-            # Semi auto-generated ID (timestamp-*)
-            elif b"-*" in entry_id:
-                generated_id = self.__validation_semi_auto_generated(connection, stream_name, entry_id)
-                if generated_id is None:  # Validation failed
+            added = 0
+            for i in range(2, len(args), 2):
+                hsh, new = self.__hash_set(key, hsh, args[i], args[i + 1])
+                added += new
+            self.propagate(args)
+        connection.reply.integer(added)
+
+    def __hash_created(self, key):
+        hsh = HashPack()
+        shard = self.keyspace.shard(key)
+        shard.dictionary[key] = hsh
+        shard.index_key(key)
+        if self.evictor.enabled:
+            self.evictor.track(key, estimate_value(hsh))
+        return hsh
+
+    def __hash_set(self, key, hsh, field, value):
+        """Set a field of the hash at key, unpacking it once it outgrows the packed encoding.
+
+        Returns the hash, which the conversion replaces, and whether the field is new.
+        """
+        evictor = self.evictor
+        # Converting first saves copying a long item into a pack about to be unpacked
+        if hsh.__class__ is HashPack and not packable(field, value):
+            hsh = self.__unpack_hash(key, hsh)
+        old = hsh.get(field) if evictor.enabled else None
+        new = hsh.set(field, value)
+        if evictor.enabled:
+            delta = estimate_hash_field(hsh, field, value)
+            if old is not None:
+                delta -= estimate_hash_field(hsh, field, old)
+            evictor.track(key, delta)
+        if hsh.__class__ is HashPack and not hsh.fits():
+            hsh = self.__unpack_hash(key, hsh)
+        return hsh, new
+
+    def __unpack_hash(self, key, hsh):
+        converted = self.keyspace.shard(key).dictionary[key] = HashTable(hsh.items())
+        if self.evictor.enabled:
+            self.evictor.track(key, estimate_value(converted) - estimate_value(hsh))
+        return converted
+
+    def __search_hash(self, connection, key):
+        """The hash at key, or None if there is none; WRONGTYPE is sent and False returned for other types"""
+        hsh = self.__search_dictionary(key)
+        if hsh is not None and not isinstance(hsh, HASH_TYPES):
+            connection.sendall(WRONGTYPE_ERROR)
+            return False
+        return hsh
+
+    def handle_hget(self, connection, args):
+        with self.keyspace.shard(args[1]).lock:
+            hsh = self.__search_hash(connection, args[1])
+            if hsh is False:
+                return
+            value = hsh.get(args[2]) if hsh is not None else None
+        if value is None:
+            connection.sendall(NULL_BULK)
+            return
+        connection.reply.bulk(value)
+
+    def handle_hmget(self, connection, args):
+        with self.keyspace.shard(args[1]).lock:
+            hsh = self.__search_hash(connection, args[1])
+            if hsh is False:
+                return
+            values = [hsh.get(field) if hsh is not None else None for field in args[2:]]
+        reply = connection.reply
+        reply.array(len(values))
+        for value in values:
+            if value is None:
+                reply.write(NULL_BULK)
+            else:
+                reply.bulk(value)
+
+    def handle_hgetall(self, connection, args):
+        with self.keyspace.shard(args[1]).lock:
+            hsh = self.__search_hash(connection, args[1])
+            if hsh is False:
+                return
+            if hsh is None:
+                connection.sendall(EMPTY_ARRAY)
+                return
+            if hsh.__class__ is HashPack:
+                # The fields are stored encoded, so the reply is the buffer itself
+                connection.reply.array(2 * len(hsh))
+                connection.reply.write(hsh.encoded())
+                return
+            items = hsh.items()
+        connection.reply.bulks([item for pair in items for item in pair])
+
+    def handle_hdel(self, connection, args):
+        key = args[1]
+        with self.keyspace.shard(key).lock:
+            hsh = self.__search_hash(connection, key)
+            if hsh is False:
+                return
+            removed = 0
+            if hsh is not None:
+                evictor = self.evictor
+                for field in args[2:]:
+                    old = hsh.get(field) if evictor.enabled else None
+                    if hsh.delete(field):
+                        removed += 1
+                        if old is not None:
+                            evictor.track(key, -estimate_hash_field(hsh, field, old))
+                if not hsh:
+                    self.__delete_key(key)
+            if removed:
+                self.propagate(args)
+        connection.reply.integer(removed)
+
+    def handle_hlen(self, connection, args):
+        with self.keyspace.shard(args[1]).lock:
+            hsh = self.__search_hash(connection, args[1])
+            if hsh is False:
+                return
+            length = len(hsh) if hsh is not None else 0
+        connection.reply.integer(length)
+
+    def handle_hincrby(self, connection, args):
+        key, field = args[1], args[2]
+        increment = parse_int64(args[3])
+        if increment is None:
+            connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+            return
+        shard = self.keyspace.shard(key)
+        with shard.lock:
+            hsh = self.__search_hash(connection, key)
+            if hsh is False:
+                return
+            if hsh is None:
+                if key in shard.streams:
+                    connection.sendall(WRONGTYPE_ERROR)
                     return
-                final_entry_id = generated_id
-            # Explicit ID
+                hsh = self.__hash_created(key)
+                current = 0
             else:
-                if not self.__validation_non_auto_generated(connection, stream_name, entry_id):
+                value = hsh.get(field)
+                current = parse_int64(value) if value is not None else 0
+                if current is None:
+                    connection.sendall(b"-ERR hash value is not an integer\r\n")
                     return
-                final_entry_id = entry_id
-            
-            # Field-value parsing
-            field_value_pairs = {}
-            for i in range(3, len(dollar_indices), 2):
-                if i + 1 < len(dollar_indices):
-                    field_index = dollar_indices[i] + 1
-                    value_index = dollar_indices[i + 1] + 1
-                    field = parts[field_index]
-                    value = parts[value_index]
-                    field_value_pairs[field] = value
-            
-            # Initialize stream if it doesn't exist
-            if stream_name not in self.streams:
-                self.streams[stream_name] = []
+            result = current + increment
+            if not INT64_MIN <= result <= INT64_MAX:
+                connection.sendall(b"-ERR increment or decrement would overflow\r\n")
+                return
+            self.__hash_set(key, hsh, field, b"%d" % result)
+            self.propagate(args)
+        connection.reply.integer(result)
+
+    def handle_hscan(self, connection, args):
+        try:
+            cursor = int(args[2])
+        except ValueError:
+            cursor = -1
+        if cursor < 0:
+            connection.sendall(b"-ERR invalid cursor\r\n")
+            return
+        options = self.__parse_scan_options(connection, args, 3, allow_type=False)
+        if options is None:
+            return
+        pattern, count, _ = options
+        with self.keyspace.shard(args[1]).lock:
+            hsh = self.__search_hash(connection, args[1])
+            if hsh is False:
+                return
+            if hsh is None:
+                items, cursor = [], 0
+            elif hsh.__class__ is HashPack:
+                # Like Redis, a packed hash is returned whole
+                items, cursor = hsh.items(), 0
+            else:
+                items, cursor = hsh.scan(cursor, count)
+        if pattern is not None:
+            items = [(field, value) for field, value in items if pattern.fullmatch(field)]
+        reply = connection.reply
+        reply.array(2)
+        reply.bulk(b"%d" % cursor)
+        reply.bulks([item for pair in items for item in pair])
+
+    def handle_type(self, connection, args):
+        try:
+            key = args[1]
+            with self.keyspace.shard(key).lock:
+                value = self.__search_dictionary(key)
+                stream_data = self.__search_stream(key) if value is None else None
             
-            # Store the entry
-            entry = (final_entry_id, field_value_pairs)
-            self.streams[stream_name].append(entry)
+            # Check dictionary first
+            if value is not None:
+                if isinstance(value, LIST_TYPES):
+                    connection.sendall(b"+list\r\n")
+                elif isinstance(value, HASH_TYPES):
+                    connection.sendall(b"+hash\r\n")
+                else:
+                    connection.sendall(b"+string\r\n")
+                return
             
-            # Send response with the actual ID that was used
-            response = b"$" + str(len(final_entry_id)).encode() + b"\r\n" + final_entry_id + b"\r\n"
-            connection.sendall(response)
+            # Check streams
+            if stream_data is not None:
+                connection.sendall(b"+stream\r\n")
+                return
             
+            # Key doesn't exist
+            connection.sendall(b"+none\r\n")
         except Exception:
-            connection.sendall(b"-ERR error processing 'xadd' command\r\n")
+            connection.sendall(b"-ERR error processing 'type' command\r\n")
 
-    def __validation_non_auto_generated(self, connection, stream_name, entry_id):
-        if not self.__validate_stream_id(entry_id):
-            connection.sendall(b"-ERR invalid stream ID\r\n")
-            return False
-        
-        if not self.__check_id_greater_than_min(entry_id):
-            connection.sendall(b"-ERR The ID specified in XADD must be greater than 0-0\r\n")
-            return False
-        
-        if stream_name not in self.streams:
-            self.streams[stream_name] = []
-        
-        if len(self.streams[stream_name]) > 0:
-            last_entry_id = self.streams[stream_name][-1][0]
-            if not self.__check_id_greater_than(entry_id, last_entry_id):
-                connection.sendall(b"-ERR The ID specified in XADD is equal or smaller than the target stream top item\r\n")
-                return False
-        
-        return True
+    def handle_object(self, connection, args):
+        if args[1].upper() != b"ENCODING" or len(args) != 3:
+            connection.sendall(
+                b"-ERR unknown subcommand or wrong number of arguments for '" + args[1] + b"'. Try OBJECT HELP.\r\n"
+            )
+            return
+        key = args[2]
+        with self.keyspace.shard(key).lock:
+            value = self.__search_dictionary(key)
+            if value is None:
+                value = self.__search_stream(key)
+            encoding = self.__encoding(value) if value is not None else None
+        if encoding is None:
+            connection.sendall(NULL_BULK)
+            return
+        connection.reply.bulk(encoding)
 
-    def __validation_semi_auto_generated(self, connection, stream_name, entry_id):
-        timestamp_part = entry_id.split(b"-", 1)[0]
-        if not self.__check_timestamp(timestamp_part):
-            connection.sendall(b"-ERR invalid stream ID\r\n")
-            return None
-        
-        timestamp = int(timestamp_part)
-        next_sequence = self.__get_next_sequence_for_timestamp(stream_name, timestamp)
-        generated_id = timestamp_part + b'-' + str(next_sequence).encode()
-        return generated_id
+    def __encoding(self, value):
+        """The name Redis gives the encoding of value"""
+        if value.__class__ is ListPack or value.__class__ is HashPack:
+            return b"listpack"
+        if value.__class__ is HashTable:
+            return b"hashtable"
+        if isinstance(value, deque):
+            return b"quicklist"
+        if isinstance(value, Stream):
+            return b"stream"
+        if value.__class__ is int:
+            return b"int"
+        # Redis allocates strings up to 44 bytes together with their header
+        return b"embstr" if len(value) <= 44 else b"raw"
 
-    def __check_id_greater_than(self, id1, id2):
-        if self.__validate_stream_id(id1) is False or self.__validate_stream_id(id2) is False:
-            return False
-        t1, s1 = id1.split(b"-", 1)
-        t2, s2 = id2.split(b"-", 1)
-        if int(t1) > int(t2):
-            return True
-        elif int(t1) == int(t2) and int(s1) > int(s2):
-            return True 
-        return False
+    def handle_expire(self, connection, args):
+        self.__handle_expire(connection, args, unit=1000)
 
-    def __validate_stream_id(self, id):
-        parsed_id = id.split(b"-", 1)
-        if len(parsed_id) != 2:
-            return False
-        try:
-            # In milliseconds
-            timestamp = parsed_id[0]
-            # Sequence number
-            sequence_number = parsed_id[1]
-            validate_timestamp_res = self.__check_timestamp(timestamp)
-            validate_sequence_number_res = self.__check_sequence_number(sequence_number)
-            return validate_timestamp_res and validate_sequence_number_res
-        except Exception:
-            return False
-        
-    def __check_sequence_number(self, sequence_number):
-        try:
-            int(sequence_number)
-        except Exception:
-            return False
-        return True
+    def handle_pexpire(self, connection, args):
+        self.__handle_expire(connection, args, unit=1)
+
+    def handle_expireat(self, connection, args):
+        self.__handle_expire(connection, args, unit=1000, absolute=True)
+
+    def handle_pexpireat(self, connection, args):
+        self.__handle_expire(connection, args, unit=1, absolute=True)
 
-    def __check_timestamp(self, timestamp):
+    def __handle_expire(self, connection, args, unit, absolute=False):
         try:
-            int(timestamp)
-        except Exception:
-            return False
-        return True
-    
-    def __check_id_greater_than_min(self, id):
-        return self.__check_id_greater_than(id, b"0-0")
-        
-    def __get_next_sequence_for_timestamp(self, stream_name, timestamp):
-        if stream_name not in self.streams:
-            # For timestamp 0, start with sequence 1, otherwise start with 0
-            return 1 if timestamp == 0 else 0
-        
-        # Find the highest sequence number for this timestamp
-        max_sequence = -1
-        for entry_id, _ in self.streams[stream_name]:
+            key = args[1]
             try:
-                entry_timestamp, entry_sequence = entry_id.split(b'-')
-                if int(entry_timestamp) == timestamp:
-                    max_sequence = max(max_sequence, int(entry_sequence))
-            except (ValueError, IndexError):
-                continue
-        
-        # If no entries found for this timestamp
-        if max_sequence == -1:
-            return 1 if timestamp == 0 else 0
-        
-        # Return next sequence number
-        return max_sequence + 1
-    
-    def __validate_auto_generated_id(self):
-        curr_ms = self.__get_current_milliseconds()
-        entry_id = f"{curr_ms}-0"
-        return self.__validate_auto_generated_id_format(entry_id)
-    
-    def __get_current_milliseconds(self):
-        return int(time.time() * 1000)
-    
-    def __validate_auto_generated_id_format(self, value):
+                deadline = int(args[2]) * unit + (0 if absolute else current_ms())
+            except ValueError:
+                connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+                return
+            flags = {arg.upper() for arg in args[3:]}
+            unsupported = flags - {b"NX", b"XX", b"GT", b"LT"}
+            if unsupported:
+                connection.sendall(b"-ERR Unsupported option " + unsupported.pop() + b"\r\n")
+                return
+            if b"NX" in flags and len(flags) > 1:
+                connection.sendall(b"-ERR NX and XX, GT or LT options at the same time are not compatible\r\n")
+                return
+            if {b"GT", b"LT"} <= flags:
+                connection.sendall(b"-ERR GT and LT options at the same time are not compatible\r\n")
+                return
+            shard = self.keyspace.shard(key)
+            with shard.lock:
+                if not self.__key_exists(key):
+                    connection.sendall(b":0\r\n")
+                    return
+                current = shard.expires.get(key)
+                # A key without a TTL counts as an infinite one for GT and LT
+                if (b"NX" in flags and current is not None) or (b"XX" in flags and current is None) \
+                        or (b"GT" in flags and (current is None or deadline <= current)) \
+                        or (b"LT" in flags and current is not None and deadline >= current):
+                    connection.sendall(b":0\r\n")
+                    return
+                if deadline <= current_ms():
+                    # A TTL that is already over deletes the key right away
+                    self.__delete_key(key)
+                else:
+                    shard.expires.set(key, deadline)
+                # Replaying the deadline deletes the key again if it is over
+                self.propagate([b"PEXPIREAT", key, b"%d" % deadline])
+            connection.sendall(b":1\r\n")
+        except Exception:
+            connection.sendall(b"-ERR error processing 'expire' command\r\n")
+
+    def handle_ttl(self, connection, args):
+        self.__handle_ttl(connection, args, unit=1000)
+
+    def handle_pttl(self, connection, args):
+        self.__handle_ttl(connection, args, unit=1)
+
+    def __handle_ttl(self, connection, args, unit):
+        key = args[1]
+        shard = self.keyspace.shard(key)
+        with shard.lock:
+            exists = self.__key_exists(key)
+            deadline = shard.expires.get(key)
+        if not exists:
+            connection.sendall(b":-2\r\n")
+            return
+        if deadline is None:
+            connection.sendall(b":-1\r\n")
+            return
+        remaining = max(0, deadline - current_ms())
+        # Round to the nearest second, as Redis does for TTL
+        remaining = (remaining + unit // 2) // unit
+        connection.reply.integer(remaining)
+
+    def handle_persist(self, connection, args):
+        key = args[1]
+        shard = self.keyspace.shard(key)
+        with shard.lock:
+            persisted = self.__key_exists(key) and shard.expires.remove(key)
+            if persisted:
+                self.propagate(args)
+        connection.sendall(b":1\r\n" if persisted else b":0\r\n")
+
+    def cron(self):
+        """Periodic housekeeping, run config hz times per second"""
+        start = perf_counter_ns()
+        self.__active_expire_cycle()
+        self.__monitor_latency("expire-cycle", start)
+        self.__reap_save_child()
+        self.__reap_rewrite_child()
+        if self.evictor.enabled:
+            self.evictor.clock = time.monotonic()
+            self.__perform_evictions()
+
+    def __active_expire_cycle(self):
+        """Delete keys whose TTL has passed, within a slice of CPU time per run.
+
+        Like Redis' slow expire cycle, one run may use up to a quarter of the
+        cron period; keys still due afterwards wait for the next run. Shards
+        are visited round robin from the one the last run stopped in, one
+        shard lock at a time.
+        """
+        time_limit = time.monotonic() + 0.25 / int(self.config.get("hz"))
+        shards = self.keyspace.shards
+        for _ in range(len(shards)):
+            shard = shards[self.expire_cursor]
+            with shard.lock:
+                for key in shard.expires.pop_expired(current_ms(), time_limit):
+                    self.__delete_key(key)
+                    shard.expired_keys += 1
+            if time.monotonic() >= time_limit:
+                return
+            self.expire_cursor = (self.expire_cursor + 1) % len(shards)
+
+    def __key_exists(self, key):
+        return self.__search_dictionary(key) is not None or self.__search_stream(key) is not None
+
+    def __delete_key(self, key, replacing=False):
+        """Remove key and its TTL from every table of its shard, returning whether it existed.
+
+        A caller replacing the key's value right away passes replacing to
+        keep it registered with SCAN.
+        """
+        return self.__remove_key(key, replacing) is not None
+
+    def __remove_key(self, key, replacing=False):
+        """Like __delete_key, but returning the removed value, or None if there was none"""
+        shard = self.keyspace.shard(key)
+        shard.expires.remove(key)
+        self.__drop_reply(shard, key)
+        value = shard.dictionary.pop(key, None)
         if value is None:
-            return b"$-1\r\n"
-        value_str = str(value)
-        return f"${len(value_str)}\r\n{value_str}\r\n"
+            value = shard.streams.pop(key, None)
+        if value is not None and not replacing:
+            shard.unindex_key(key)
+        if self.evictor.enabled:
+            self.evictor.untrack(key)
+        return value
+
+    # The lookups below expect the caller to hold the key's shard lock
+
+    def __search_dictionary(self, key):
+        shard = self.keyspace.shard(key)
+        value = shard.dictionary.get(key)
+        if value is None:
+            return None
+        # Expired keys are removed lazily on access as well as by the cron
+        if key in shard.expires and shard.expires.is_expired(key):
+            self.__delete_key(key)
+            shard.expired_keys += 1
+            return None
+        if self.evictor.enabled:
+            self.evictor.touch(key)
+        return value
     
-    def handle_xrange(self, connection, data):
-        parts = data.split(b"\r\n")
+    def __search_stream(self, stream_name):
+        shard = self.keyspace.shard(stream_name)
+        stream = shard.streams.get(stream_name)
+        if stream is None:
+            return None
+        if stream_name in shard.expires and shard.expires.is_expired(stream_name):
+            self.__delete_key(stream_name)
+            shard.expired_keys += 1
+            return None
+        if self.evictor.enabled:
+            self.evictor.touch(stream_name)
+        return stream
+
+    def handle_xadd(self, connection, args):
         try:
-            dollar_indices = [i for i, part in enumerate(parts) if part.startswith(b"$")]
-            if len(dollar_indices) < 4:
-                connection.sendall(b"-ERR wrong number of arguments for 'xrange' command\r\n")
-                return
-            
-            stream_index = dollar_indices[1] + 1
-            start_index = dollar_indices[2] + 1
-            end_index = dollar_indices[3] + 1
-            
-            stream_name = parts[stream_index]
-            start = parts[start_index]
-            end = parts[end_index]
-            
-            if stream_name not in self.streams:
-                connection.sendall(b"*0\r\n")
+            stream_name = args[1]
+            nomkstream = False
+            trim = None
+            i = 2
+            while i < len(args):
+                option = args[i].upper()
+                if option == b"NOMKSTREAM":
+                    nomkstream = True
+                    i += 1
+                elif option in (b"MAXLEN", b"MINID"):
+                    parsed = self.__parse_trim(connection, args, i)
+                    if parsed is None:
+                        return
+                    trim, i = parsed
+                else:
+                    break
+            if i >= len(args) or (len(args) - i) % 2 == 0 or len(args) - i < 3:
+                connection.sendall(b"-ERR wrong number of arguments for 'xadd' command\r\n")
                 return
+            entry_id = args[i]
             
-            entries = self.streams[stream_name]
-            result_entries = []
+            # Flat field/value list, kept in the order given
+            fields = args[i + 1:]
             
-            for entry_id, fields in entries:
-                if self.__check_id_in_range(entry_id, start, end):
-                    result_entries.append((entry_id, fields))
+            shard = self.keyspace.shard(stream_name)
+            with shard.lock:
+                if self.__search_dictionary(stream_name) is not None:
+                    connection.sendall(WRONGTYPE_ERROR)
+                    return
+                stream = self.__search_stream(stream_name)
+                if stream is None and nomkstream:
+                    connection.sendall(NULL_BULK)
+                    return
+                last_id = stream.last_id if stream is not None else MIN_ID
+                
+                # Auto-generated ID (full auto-generation)
+                if entry_id == b'*':
+                    final_entry_id = auto_id(last_id, self.__get_current_milliseconds())
+                    if final_entry_id is None:
+                        connection.sendall(b"-ERR The stream has exhausted the last possible ID, unable to add more items\r\n")
+                        return
+                # Semi auto-generated ID (timestamp-*)
+                elif entry_id.endswith(b"-*"):
+                    final_entry_id = self.__validation_semi_auto_generated(connection, last_id, entry_id)
+                    if final_entry_id is None:  # Validation failed
+                        return
+                # Explicit ID
+                else:
+                    final_entry_id = self.__validation_non_auto_generated(connection, last_id, entry_id)
+                    if final_entry_id is None:
+                        return
+                
+                # Initialize stream if it doesn't exist
+                if stream is None:
+                    stream = shard.streams[stream_name] = Stream()
+                    shard.index_key(stream_name)
+                
+                # Store the entry
+                packed = stream.append(final_entry_id, fields)
+                # Logged with the ID it got, so replay builds the same stream
+                self.propagate([b"XADD", stream_name, format_id(final_entry_id)] + fields)
+                if self.evictor.enabled:
+                    self.evictor.track(stream_name, estimate_stream_entry(packed))
+                if trim is not None:
+                    self.__trim_stream(stream_name, stream, trim)
+                # Wake clients blocked in XREAD on this stream
+                self.blocking.wake(stream_name)
             
-            response = b"*" + str(len(result_entries)).encode() + b"\r\n"
-            for entry_id, fields in result_entries:
-                response += b"*2\r\n"
-                response += b"$" + str(len(entry_id)).encode() + b"\r\n" + entry_id + b"\r\n"
-                response += b"*" + str(len(fields) * 2).encode() + b"\r\n"
-                for field, value in fields.items():
-                    response += b"$" + str(len(field)).encode() + b"\r\n" + field + b"\r\n"
-                    response += b"$" + str(len(value)).encode() + b"\r\n" + value + b"\r\n"
+            # Send response with the actual ID that was used
+            connection.reply.bulk(format_id(final_entry_id))
             
-            connection.sendall(response)
         except Exception:
-            connection.sendall(b"-ERR error processing 'xrange' command\r\n")
+            connection.sendall(b"-ERR error processing 'xadd' command\r\n")
 
-    def __check_id_in_range(self, entry_id, start, end):
-        # Handle special cases for start and end
-        if start == b"-":
-            start_ok = True
+    def __parse_trim(self, connection, args, i):
+        """Parse MAXLEN|MINID [=|~] threshold [LIMIT count] at args[i].
+
+        Returns ((strategy, threshold, approx, limit), index after it), or
+        None once an error has been sent.
+        """
+        strategy = args[i].upper()
+        i += 1
+        approx = False
+        if i < len(args) and args[i] in (b"=", b"~"):
+            approx = args[i] == b"~"
+            i += 1
+        if i >= len(args):
+            connection.sendall(b"-ERR syntax error\r\n")
+            return None
+        if strategy == b"MAXLEN":
+            try:
+                threshold = int(args[i])
+            except ValueError:
+                connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+                return None
+            if threshold < 0:
+                connection.sendall(b"-ERR The MAXLEN argument must be >= 0.\r\n")
+                return None
         else:
-            # entry_id >= start (entry_id is greater than or equal to start)
-            start_ok = self.__check_id_greater_than_or_equal(entry_id, start)
-        
-        if end == b"+":
-            end_ok = True
+            try:
+                threshold = parse_id(args[i])
+            except ValueError:
+                connection.sendall(INVALID_STREAM_ID_ERROR)
+                return None
+        i += 1
+        # Like Redis, an approximate trim removes at most 100 nodes at a time by default
+        limit = 100 * STREAM_NODE_MAX_ENTRIES if approx else None
+        if i + 1 < len(args) and args[i].upper() == b"LIMIT":
+            if not approx:
+                connection.sendall(b"-ERR syntax error, LIMIT cannot be used without the special ~ option\r\n")
+                return None
+            try:
+                limit = int(args[i + 1])
+            except ValueError:
+                limit = -1
+            if limit < 0:
+                connection.sendall(b"-ERR The LIMIT argument must be >= 0.\r\n")
+                return None
+            limit = limit or None
+            i += 2
+        return (strategy, threshold, approx, limit), i
+
+    def __trim_stream(self, key, stream, trim):
+        """Apply a parsed trim to stream and return how many entries it removed.
+
+        Approximate trims depend on how the entries are laid out, which
+        differs after a reload, so what was removed is logged as an exact
+        MINID trim. The caller holds the key's shard lock.
+        """
+        strategy, threshold, approx, limit = trim
+        if strategy == b"MAXLEN":
+            removed = stream.trim_maxlen(threshold, approx, limit)
         else:
-            # entry_id <= end (entry_id is less than or equal to end)
-            end_ok = self.__check_id_less_than_or_equal(entry_id, end)
-        
-        return start_ok and end_ok
+            removed = stream.trim_minid(threshold, approx, limit)
+        if not removed:
+            return 0
+        first_id = stream.first_id()
+        if first_id is None:
+            self.propagate([b"XTRIM", key, b"MAXLEN", b"0"])
+        else:
+            self.propagate([b"XTRIM", key, b"MINID", format_id(first_id)])
+        if self.evictor.enabled:
+            self.evictor.track(key, -sum(estimate_stream_entry(packed) for packed in removed))
+        return len(removed)
+
+    def handle_xtrim(self, connection, args):
+        key = args[1]
+        if args[2].upper() not in (b"MAXLEN", b"MINID"):
+            connection.sendall(b"-ERR syntax error\r\n")
+            return
+        parsed = self.__parse_trim(connection, args, 2)
+        if parsed is None:
+            return
+        trim, i = parsed
+        if i != len(args):
+            connection.sendall(b"-ERR syntax error\r\n")
+            return
+        with self.keyspace.shard(key).lock:
+            if self.__search_dictionary(key) is not None:
+                connection.sendall(WRONGTYPE_ERROR)
+                return
+            stream = self.__search_stream(key)
+            removed = self.__trim_stream(key, stream, trim) if stream is not None else 0
+        connection.reply.integer(removed)
 
-    def __check_id_greater_than_or_equal(self, id1, id2):
-        """Check if id1 >= id2"""
-        return self.__check_id_greater_than(id1, id2) or self.__check_id_equal(id1, id2)
+    def handle_xdel(self, connection, args):
+        key = args[1]
+        try:
+            entry_ids = [parse_id(raw) for raw in args[2:]]
+        except ValueError:
+            connection.sendall(INVALID_STREAM_ID_ERROR)
+            return
+        with self.keyspace.shard(key).lock:
+            if self.__search_dictionary(key) is not None:
+                connection.sendall(WRONGTYPE_ERROR)
+                return
+            stream = self.__search_stream(key)
+            removed = stream.delete(entry_ids) if stream is not None else []
+            if removed:
+                self.propagate(args)
+                if self.evictor.enabled:
+                    self.evictor.track(key, -sum(estimate_stream_entry(packed) for packed in removed))
+        connection.reply.integer(len(removed))
 
-    def __check_id_less_than_or_equal(self, id1, id2):
-        """Check if id1 <= id2"""
-        return self.__check_id_greater_than(id2, id1) or self.__check_id_equal(id1, id2)
+    def handle_xlen(self, connection, args):
+        key = args[1]
+        with self.keyspace.shard(key).lock:
+            if self.__search_dictionary(key) is not None:
+                connection.sendall(WRONGTYPE_ERROR)
+                return
+            stream = self.__search_stream(key)
+            length = len(stream) if stream is not None else 0
+        connection.reply.integer(length)
 
-    def __check_id_equal(self, id1, id2):
-        """Check if two IDs are equal"""
-        if not self.__validate_stream_id(id1) or not self.__validate_stream_id(id2):
-            return False
+    def handle_xsetid(self, connection, args):
+        key = args[1]
+        try:
+            last_id = parse_id(args[2])
+        except ValueError:
+            connection.sendall(INVALID_STREAM_ID_ERROR)
+            return
+        with self.keyspace.shard(key).lock:
+            if self.__search_dictionary(key) is not None:
+                connection.sendall(WRONGTYPE_ERROR)
+                return
+            stream = self.__search_stream(key)
+            if stream is None:
+                connection.sendall(b"-ERR no such key\r\n")
+                return
+            top_id = stream.top_id()
+            if top_id is not None and last_id < top_id:
+                connection.sendall(b"-ERR The ID specified in XSETID is smaller than the target stream top item\r\n")
+                return
+            stream.last_id = last_id
+            self.propagate(args)
+        connection.sendall(b"+OK\r\n")
+
+    def __validation_non_auto_generated(self, connection, last_id, entry_id):
+        try:
+            entry_id = parse_id(entry_id)
+        except ValueError:
+            connection.sendall(INVALID_STREAM_ID_ERROR)
+            return None
+        
+        if entry_id == MIN_ID:
+            connection.sendall(b"-ERR The ID specified in XADD must be greater than 0-0\r\n")
+            return None
         
-        t1, s1 = id1.split(b"-", 1)
-        t2, s2 = id2.split(b"-", 1)
+        if entry_id <= last_id:
+            connection.sendall(b"-ERR The ID specified in XADD is equal or smaller than the target stream top item\r\n")
+            return None
         
-        return int(t1) == int(t2) and int(s1) == int(s2)
-    
-    def __upper_bound_xrange(self, ids, start):
-        """Find the index of the first ID greater than start"""
-        low, high = 0, len(ids)
-        while low < high:
-            mid = (low + high) // 2
-            if self.__check_id_greater_than(ids[mid], start):
-                high = mid
-            else:
-                low = mid + 1
-        return low
+        return entry_id
+
+    def __validation_semi_auto_generated(self, connection, last_id, entry_id):
+        timestamp_part = entry_id[:-2]
+        try:
+            timestamp = parse_id(timestamp_part)[0]
+        except ValueError:
+            connection.sendall(INVALID_STREAM_ID_ERROR)
+            return None
+        
+        # The next sequence number comes straight from the cached last ID
+        generated_id = semi_auto_id(last_id, timestamp)
+        if generated_id is None:
+            connection.sendall(b"-ERR The ID specified in XADD is equal or smaller than the target stream top item\r\n")
+        return generated_id
+
+    def __get_current_milliseconds(self):
+        return int(time.time() * 1000)
     
-    def handle_xread(self, connection, data):
-        parts = data.split(b"\r\n")
+    def handle_xrange(self, connection, args):
+        self.__handle_range(connection, args, reverse=False)
+
+    def handle_xrevrange(self, connection, args):
+        self.__handle_range(connection, args, reverse=True)
+
+    def __handle_range(self, connection, args, reverse):
+        command = "xrevrange" if reverse else "xrange"
         try:
-            dollar_indices = [i for i, part in enumerate(parts) if part.startswith(b"$")]
+            stream_name = args[1]
+            # XREVRANGE takes the interval as end, start
+            end_arg, start_arg = (args[2], args[3]) if reverse else (args[3], args[2])
             
-            # Minimum: XREAD, streams, stream_key, start_id (4 arguments)
-            if len(dollar_indices) < 4:
-                connection.sendall(b"-ERR wrong number of arguments for 'xread' command\r\n")
+            count = None
+            if len(args) == 6 and args[4].upper() == b"COUNT":
+                try:
+                    count = max(0, int(args[5]))
+                except ValueError:
+                    connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+                    return
+            elif len(args) != 4:
+                connection.sendall(b"-ERR syntax error\r\n")
                 return
             
-            # Parse command arguments
-            cmd_index = dollar_indices[0] + 1  # Should be "XREAD"
-            cmd = parts[cmd_index]
-            
-            # Validate command format
-            if cmd.upper() != b"XREAD":
-                connection.sendall(b"-ERR unknown command 'xread'\r\n")
+            start = self.__parse_range_bound(start_arg, is_start=True)
+            end = self.__parse_range_bound(end_arg, is_start=False)
+            if start is None or end is None:
+                connection.sendall(INVALID_STREAM_ID_ERROR)
                 return
             
-            # Check for BLOCK option
-            block_timeout = None
-            arg_start_index = 1  # Start parsing from second argument
-            
-            # Check if second argument is "BLOCK"
-            if len(dollar_indices) >= 2:
-                second_arg_index = dollar_indices[1] + 1
-                if parts[second_arg_index].upper() == b"BLOCK":
-                    # BLOCK timeout is the next argument
-                    if len(dollar_indices) < 3:
-                        connection.sendall(b"-ERR wrong number of arguments for 'xread' command\r\n")
-                        return
-                        
-                    timeout_index = dollar_indices[2] + 1
-                    try:
-                        timeout_ms = int(parts[timeout_index])
-                        if timeout_ms == 0:
-                            block_timeout = float('inf')  # Block indefinitely
-                        else:
-                            block_timeout = timeout_ms / 1000.0  # Convert to seconds
-                        arg_start_index = 3  # Skip BLOCK and timeout arguments
-                    except ValueError:
-                        connection.sendall(b"-ERR timeout is not an integer or out of range\r\n")
-                        return
-            
-            # Parse "streams" keyword
-            if len(dollar_indices) <= arg_start_index:
-                connection.sendall(b"-ERR wrong number of arguments for 'xread' command\r\n")
-                return
+            with self.keyspace.shard(stream_name).lock:
+                stream = self.__search_stream(stream_name)
+                if stream is None or start > end:
+                    connection.sendall(EMPTY_ARRAY)
+                    return
                 
-            streams_index = dollar_indices[arg_start_index] + 1
-            streams_keyword = parts[streams_index]
-            
-            if streams_keyword.upper() != b"STREAMS":
-                connection.sendall(b"-ERR wrong number of arguments for 'xread' command\r\n")
+                if reverse:
+                    result_entries = stream.revrange(end, start, count)
+                else:
+                    result_entries = stream.range(start, end, count)
+            self.__write_entries(connection.reply, result_entries)
+        except Exception:
+            connection.sendall(b"-ERR error processing '" + command.encode() + b"' command\r\n")
+
+    def __parse_range_bound(self, raw, is_start):
+        """Parse an XRANGE interval bound into an ID tuple, or None if invalid"""
+        if raw == b"-":
+            return MIN_ID
+        if raw == b"+":
+            return MAX_ID
+        exclusive = raw.startswith(b"(")
+        if exclusive:
+            raw = raw[1:]
+        try:
+            # A bare millisecond time covers every sequence number in it
+            ms, seq = parse_id(raw, missing_seq=0 if is_start else MAX_ID_PART)
+        except ValueError:
+            return None
+        if not exclusive:
+            return ms, seq
+        # Turn an exclusive bound into the next ID inside the interval
+        if is_start:
+            if seq < MAX_ID_PART:
+                return ms, seq + 1
+            return (ms + 1, 0) if ms < MAX_ID_PART else None
+        if seq > 0:
+            return ms, seq - 1
+        return (ms - 1, MAX_ID_PART) if ms > 0 else None
+    
+    def handle_xread(self, connection, args):
+        block_timeout = None
+        count = None
+        
+        # Options come before the STREAMS keyword, in any order
+        i = 1
+        while i < len(args) and args[i].upper() != b"STREAMS":
+            option = args[i].upper()
+            if option not in (b"BLOCK", b"COUNT") or i + 1 >= len(args):
+                connection.sendall(b"-ERR syntax error\r\n")
                 return
-            
-            # Parse multiple streams and their start IDs
-            stream_args = []
-            for i in range(arg_start_index + 1, len(dollar_indices)):
-                arg_index = dollar_indices[i] + 1
-                stream_args.append(parts[arg_index])
-            
-            # Must have even number of arguments (equal streams and IDs)
-            if len(stream_args) % 2 != 0:
-                connection.sendall(b"-ERR wrong number of arguments for 'xread' command\r\n")
+            try:
+                amount = int(args[i + 1])
+            except ValueError:
+                connection.sendall(b"-ERR timeout is not an integer or out of range\r\n")
                 return
-            
-            num_streams = len(stream_args) // 2
-            stream_keys = stream_args[:num_streams]
-            start_ids = stream_args[num_streams:]
-            
-            # If blocking, implement blocking logic
-            if block_timeout is not None:
-                self.__handle_blocking_xread(connection, stream_keys, start_ids, block_timeout)
+            if option == b"BLOCK":
+                if amount < 0:
+                    connection.sendall(b"-ERR timeout is negative\r\n")
+                    return
+                if amount == 0:
+                    block_timeout = float('inf')  # Block indefinitely
+                else:
+                    block_timeout = amount / 1000.0  # Convert to seconds
             else:
-                # Non-blocking read (original logic)
-                self.__handle_non_blocking_xread(connection, stream_keys, start_ids)
-                
-        except Exception as e:
-            connection.sendall(b"-ERR error processing 'xread' command\r\n")
+                count = amount if amount > 0 else None
+            i += 2
+        
+        # Parse "streams" keyword
+        if i >= len(args):
+            connection.sendall(b"-ERR syntax error\r\n")
+            return
+        
+        # Parse multiple streams and their start IDs
+        stream_args = args[i + 1:]
+        
+        # Must have even number of arguments (equal streams and IDs)
+        if not stream_args or len(stream_args) % 2 != 0:
+            connection.sendall(b"-ERR Unbalanced 'xread' list of streams: for each stream key an ID or '$' must be specified.\r\n")
+            return
+        
+        num_streams = len(stream_args) // 2
+        stream_keys = stream_args[:num_streams]
+        start_ids = stream_args[num_streams:]
+        
+        with self.keyspace.lock(stream_keys):
+            # '$' means "entries newer than the latest one right now", so
+            # it is resolved once, before any blocking
+            resolved_ids = []
+            for stream_key, start_id in zip(stream_keys, start_ids):
+                if start_id == b'$':
+                    stream = self.__search_stream(stream_key)
+                    resolved_ids.append(stream.last_id if stream is not None else MIN_ID)
+                    continue
+                try:
+                    resolved_ids.append(parse_id(start_id))
+                except ValueError:
+                    connection.sendall(INVALID_STREAM_ID_ERROR)
+                    return
+            
+            response = self.__read_streams(stream_keys, resolved_ids, count)
+            if response is None and block_timeout is not None:
+                deadline = None if block_timeout == float('inf') else time.time() + block_timeout
+                # A writer wakes the client with just the stream it added to
+                start_of = dict(zip(stream_keys, resolved_ids))
+                waiter = self.blocking.block(
+                    connection, stream_keys, lambda key: self.__read_streams([key], [start_of[key]], count),
+                    deadline, NULL_ARRAY
+                )
+        
+        if response is not None:
+            connection.sendall(response)
+        elif block_timeout is None:
+            # Return null array if no streams have matching entries
+            connection.sendall(NULL_ARRAY)
+        else:
+            self.commit_writes()
+            connection.block(waiter)
 
-    def __handle_non_blocking_xread(self, connection, stream_keys, start_ids):
-        """Handle non-blocking XREAD"""
+    def __read_streams(self, stream_keys, start_ids, count=None):
+        """Build the XREAD reply for entries after start_ids, or None if there are none"""
         result_streams = []
         
-        for i in range(len(stream_keys)):
-            stream_key = stream_keys[i]
-            start_id = start_ids[i]
-            
-            # Check if stream exists
-            if stream_key not in self.streams:
+        for stream_key, start_id in zip(stream_keys, start_ids):
+            stream = self.__search_stream(stream_key)
+            if stream is None:
                 continue  # Skip non-existent streams
             
-            # Find entries with ID greater than start_id (exclusive)
-            matching_entries = []
-            for entry_id, fields in self.streams[stream_key]:
-                if self.__check_id_greater_than(entry_id, start_id):
-                    matching_entries.append((entry_id, fields))
+            # Entries with ID greater than start_id (exclusive)
+            matching_entries = stream.after(start_id, count)
             
             # Only include streams that have matching entries
             if matching_entries:
                 result_streams.append((stream_key, matching_entries))
         
-        # Build response for multiple streams
         if not result_streams:
-            # Return null array if no streams have matching entries
-            connection.sendall(b"*-1\r\n")
-            return
+            return None
         
         # Build XREAD response format for multiple streams
-        response = self.__build_xread_multi_response(result_streams)
-        connection.sendall(response)
+        reply = Reply()
+        reply.array(len(result_streams))
+        for stream_key, entries in result_streams:
+            reply.array(2)
+            reply.bulk(stream_key)
+            self.__write_entries(reply, entries)
+        return reply
 
-    def __handle_blocking_xread(self, connection, stream_keys, start_ids, block_timeout):
-        """Handle blocking XREAD with timeout"""
-        import time
-        
-        start_time = time.time()
-        
-        while True:
-            # Check for new entries (same logic as non-blocking)
-            result_streams = []
-            
-            for i in range(len(stream_keys)):
-                stream_key = stream_keys[i]
-                start_id = start_ids[i]
-                
-                # Special handling for '$' - means "latest entry ID"
-                if start_id == b'$':
-                    # For blocking, '$' means wait for entries newer than current latest
-                    if stream_key in self.streams and self.streams[stream_key]:
-                        # Get the latest entry ID from the stream
-                        latest_entry_id = self.streams[stream_key][-1][0]
-                        start_id = latest_entry_id
-                    else:
-                        # Stream doesn't exist or is empty, use 0-0
-                        start_id = b'0-0'
-                
-                # Check if stream exists
-                if stream_key not in self.streams:
-                    continue  # Skip non-existent streams
-                
-                # Find entries with ID greater than start_id (exclusive)
-                matching_entries = []
-                for entry_id, fields in self.streams[stream_key]:
-                    if self.__check_id_greater_than(entry_id, start_id):
-                        matching_entries.append((entry_id, fields))
-                
-                # Only include streams that have matching entries
-                if matching_entries:
-                    result_streams.append((stream_key, matching_entries))
-            
-            # If we found results, return them
-            if result_streams:
-                response = self.__build_xread_multi_response(result_streams)
-                connection.sendall(response)
+    def __write_entries(self, reply, entries):
+        """Write the RESP array of [id, [field, value, ...]] pairs for stream entries"""
+        reply.array(len(entries))
+        for entry_id, fields in entries:
+            reply.array(2)
+            reply.bulk(format_id(entry_id))
+            # History reads of entries since deleted have no fields
+            reply.write(NULL_ARRAY if fields is None else fields)
+
+    def handle_xgroup(self, connection, args):
+        subcommand = args[1].upper()
+        arity = {b"CREATE": (5, 6), b"SETID": (5,), b"DESTROY": (4,), b"CREATECONSUMER": (5,), b"DELCONSUMER": (5,)}
+        if subcommand not in arity or len(args) not in arity[subcommand]:
+            connection.sendall(b"-ERR unknown subcommand or wrong number of arguments for '" + args[1] + b"'\r\n")
+            return
+        key = args[2]
+        group_name = args[3]
+        mkstream = subcommand == b"CREATE" and len(args) == 6
+        if mkstream and args[5].upper() != b"MKSTREAM":
+            connection.sendall(b"-ERR syntax error\r\n")
+            return
+        shard = self.keyspace.shard(key)
+        with shard.lock:
+            if self.__search_dictionary(key) is not None:
+                connection.sendall(WRONGTYPE_ERROR)
                 return
-            
-            # Check timeout
-            if block_timeout != float('inf'):
-                elapsed = time.time() - start_time
-                if elapsed >= block_timeout:
-                    # Timeout reached, return null
-                    connection.sendall(b"*-1\r\n")
+            stream = self.__search_stream(key)
+            if stream is None and not mkstream:
+                connection.sendall(
+                    b"-ERR The XGROUP subcommand requires the key to exist. Note that for CREATE you may want "
+                    b"to use the MKSTREAM option to create an empty stream automatically.\r\n"
+                )
+                return
+            group = stream.groups.get(group_name) if stream is not None else None
+            if subcommand == b"CREATE":
+                if group is not None:
+                    connection.sendall(b"-BUSYGROUP Consumer Group name already exists\r\n")
                     return
-            
-            # Sleep briefly before checking again
-            time.sleep(0.01)  # 10ms polling interval
+                last_id = self.__parse_group_id(args[4], stream)
+                if last_id is None:
+                    connection.sendall(INVALID_STREAM_ID_ERROR)
+                    return
+                if stream is None:
+                    stream = shard.streams[key] = Stream()
+                    shard.index_key(key)
+                    if self.evictor.enabled:
+                        self.evictor.track(key, estimate_value(stream))
+                stream.groups[group_name] = ConsumerGroup(last_id)
+                self.propagate([b"XGROUP", b"CREATE", key, group_name, format_id(last_id)] + args[5:])
+                connection.sendall(b"+OK\r\n")
+                return
+            if subcommand == b"DESTROY":
+                if group is None:
+                    connection.sendall(b":0\r\n")
+                    return
+                del stream.groups[group_name]
+                self.propagate(args)
+                # Clients blocked in XREADGROUP on it get an error
+                self.blocking.wake(key)
+                connection.sendall(b":1\r\n")
+                return
+            if group is None:
+                connection.sendall(b"-NOGROUP No such consumer group '" + group_name + b"' for key name '" + key + b"'\r\n")
+                return
+            if subcommand == b"SETID":
+                last_id = self.__parse_group_id(args[4], stream)
+                if last_id is None:
+                    connection.sendall(INVALID_STREAM_ID_ERROR)
+                    return
+                group.last_id = last_id
+                self.propagate([b"XGROUP", b"SETID", key, group_name, format_id(last_id)])
+                connection.sendall(b"+OK\r\n")
+            elif subcommand == b"CREATECONSUMER":
+                _, created = group.consumer(args[4], current_ms())
+                if created:
+                    self.propagate(args)
+                connection.sendall(b":1\r\n" if created else b":0\r\n")
+            else:
+                pending = group.delete_consumer(args[4])
+                if pending is not None:
+                    self.propagate(args)
+                connection.reply.integer(pending or 0)
 
-    def __build_xread_multi_response(self, result_streams):
-        """Build RESP response for XREAD command with multiple streams"""
-        response = b"*" + str(len(result_streams)).encode() + b"\r\n"
-        
+    def __parse_group_id(self, raw, stream):
+        """A group's last delivered ID from XGROUP CREATE or SETID, '$' being the stream's last"""
+        if raw == b"$":
+            return stream.last_id if stream is not None else MIN_ID
+        try:
+            return parse_id(raw)
+        except ValueError:
+            return None
+
+    def handle_xreadgroup(self, connection, args):
+        try:
+            if args[1].upper() != b"GROUP":
+                connection.sendall(b"-ERR syntax error\r\n")
+                return
+            group_name = args[2]
+            consumer_name = args[3]
+            block_timeout = None
+            count = None
+            noack = False
+            i = 4
+            while i < len(args) and args[i].upper() != b"STREAMS":
+                option = args[i].upper()
+                if option == b"NOACK":
+                    noack = True
+                    i += 1
+                    continue
+                if option not in (b"BLOCK", b"COUNT") or i + 1 >= len(args):
+                    connection.sendall(b"-ERR syntax error\r\n")
+                    return
+                try:
+                    amount = int(args[i + 1])
+                except ValueError:
+                    connection.sendall(b"-ERR timeout is not an integer or out of range\r\n")
+                    return
+                if option == b"BLOCK":
+                    if amount < 0:
+                        connection.sendall(b"-ERR timeout is negative\r\n")
+                        return
+                    block_timeout = amount / 1000.0 if amount > 0 else float('inf')
+                else:
+                    count = amount if amount > 0 else None
+                i += 2
+            stream_args = args[i + 1:]
+            if not stream_args or len(stream_args) % 2 != 0:
+                connection.sendall(
+                    b"-ERR Unbalanced 'xreadgroup' list of streams: for each stream key an ID or '>' must be specified.\r\n"
+                )
+                return
+            num_streams = len(stream_args) // 2
+            stream_keys = stream_args[:num_streams]
+            start_ids = []
+            for start_id in stream_args[num_streams:]:
+                if start_id == b">":
+                    start_ids.append(None)
+                    continue
+                try:
+                    start_ids.append(parse_id(start_id))
+                except ValueError:
+                    connection.sendall(INVALID_STREAM_ID_ERROR)
+                    return
+
+            with self.keyspace.lock(stream_keys):
+                response = self.__read_group(stream_keys, start_ids, group_name, consumer_name, count, noack)
+                # Only reads of new entries ('>') wait for them
+                block = response is None and block_timeout is not None
+                if block:
+                    deadline = None if block_timeout == float('inf') else time.time() + block_timeout
+                    waiter = self.blocking.block(
+                        connection, stream_keys,
+                        lambda key: self.__read_group([key], [None], group_name, consumer_name, count, noack),
+                        deadline, NULL_ARRAY
+                    )
+            if not block:
+                connection.sendall(NULL_ARRAY if response is None else response)
+                return
+            self.commit_writes()
+            connection.block(waiter)
+        except Exception:
+            connection.sendall(b"-ERR error processing 'xreadgroup' command\r\n")
+
+    def __read_group(self, stream_keys, start_ids, group_name, consumer_name, count, noack):
+        """Build the XREADGROUP reply, an error, or None if no new entries were there to deliver.
+
+        A start ID of None reads new entries ('>'); any other re-reads the
+        consumer's pending entries after it. The caller holds the shard
+        locks of stream_keys.
+        """
+        now = current_ms()
+        groups = []
+        for stream_key in stream_keys:
+            stream = self.__search_stream(stream_key)
+            group = stream.groups.get(group_name) if stream is not None else None
+            if group is None:
+                return (
+                    b"-NOGROUP No such key '" + stream_key + b"' or consumer group '" + group_name
+                    + b"' in XREADGROUP with GROUP option\r\n"
+                )
+            groups.append((stream, group))
+        result_streams = []
+        for stream_key, start_id, (stream, group) in zip(stream_keys, start_ids, groups):
+            consumer, created = group.consumer(consumer_name, now)
+            if created:
+                self.propagate([b"XGROUP", b"CREATECONSUMER", stream_key, group_name, consumer_name])
+            if start_id is not None:
+                # History: the consumer's own pending entries, deleted ones without fields
+                start = increment_id(start_id)
+                entry_ids = itertools.islice(consumer.pending_ids.scan(start), count) if start is not None else []
+                result_streams.append((stream_key, [(entry_id, stream.get(entry_id)) for entry_id in entry_ids]))
+                continue
+            entries = stream.after(group.last_id, count)
+            if not entries:
+                continue
+            entry_ids = [entry_id for entry_id, _ in entries]
+            group.deliver(consumer, entry_ids, now, noack)
+            last_id = format_id(group.last_id)
+            # Replicas and the AOF get the outcome: pending entries and the new last ID
+            if noack:
+                self.propagate([b"XGROUP", b"SETID", stream_key, group_name, last_id])
+            for entry_id in entry_ids if not noack else ():
+                self.propagate([
+                    b"XCLAIM", stream_key, group_name, consumer_name, b"0", format_id(entry_id), b"TIME", b"%d" % now,
+                    b"RETRYCOUNT", b"1", b"FORCE", b"JUSTID", b"LASTID", last_id,
+                ])
+            result_streams.append((stream_key, entries))
+        if not result_streams:
+            return None
+        reply = Reply()
+        reply.array(len(result_streams))
         for stream_key, entries in result_streams:
-            response += b"*2\r\n"
-            
-            # Stream name
-            response += b"$" + str(len(stream_key)).encode() + b"\r\n" + stream_key + b"\r\n"
-            
-            # Entries array
-            response += b"*" + str(len(entries)).encode() + b"\r\n"
-            
-            for entry_id, fields in entries:
-                response += b"*2\r\n"
-                
-                # Entry ID
-                response += b"$" + str(len(entry_id)).encode() + b"\r\n" + entry_id + b"\r\n"
-                
-                # Fields array
-                field_count = len(fields) * 2
-                response += b"*" + str(field_count).encode() + b"\r\n"
-                
-                for field, value in fields.items():
-                    response += b"$" + str(len(field)).encode() + b"\r\n" + field + b"\r\n"
-                    response += b"$" + str(len(value)).encode() + b"\r\n" + value + b"\r\n"
-        
-        return response
+            reply.array(2)
+            reply.bulk(stream_key)
+            self.__write_entries(reply, entries)
+        return reply
+
+    def handle_xack(self, connection, args):
+        key = args[1]
+        try:
+            entry_ids = [parse_id(raw) for raw in args[3:]]
+        except ValueError:
+            connection.sendall(INVALID_STREAM_ID_ERROR)
+            return
+        with self.keyspace.shard(key).lock:
+            stream = self.__search_stream(key)
+            group = stream.groups.get(args[2]) if stream is not None else None
+            acked = group.ack(entry_ids) if group is not None else 0
+            if acked:
+                self.propagate(args)
+        connection.reply.integer(acked)
+
+    def handle_xpending(self, connection, args):
+        key = args[1]
+        group_name = args[2]
+        min_idle = 0
+        rest = args[3:]
+        if rest and rest[0].upper() == b"IDLE":
+            try:
+                min_idle = int(rest[1])
+            except (IndexError, ValueError):
+                connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+                return
+            rest = rest[2:]
+            if not rest:
+                connection.sendall(b"-ERR syntax error\r\n")
+                return
+        if rest and len(rest) not in (3, 4):
+            connection.sendall(b"-ERR syntax error\r\n")
+            return
+        if rest:
+            start = self.__parse_range_bound(rest[0], is_start=True)
+            end = self.__parse_range_bound(rest[1], is_start=False)
+            if start is None or end is None:
+                connection.sendall(INVALID_STREAM_ID_ERROR)
+                return
+            try:
+                count = int(rest[2])
+            except ValueError:
+                connection.sendall(b"-ERR value is not an integer or out of range\r\n")
+                return
+        with self.keyspace.shard(key).lock:
+            stream = self.__search_stream(key)
+            group = stream.groups.get(group_name) if stream is not None else None
+            if group is None:
+                connection.sendall(b"-NOGROUP No such key '" + key + b"' or consumer group '" + group_name + b"'\r\n")
+                return
+            reply = connection.reply
+            if not rest:
+                self.__write_pending_summary(reply, group)
+                return
+            if len(rest) == 4:
+                consumer = group.consumers.get(rest[3])
+                if consumer is None:
+                    reply.write(EMPTY_ARRAY)
+                    return
+                ids = consumer.pending_ids
+            else:
+                ids = group.pending_ids
+            now = current_ms()
+            rows = []
+            for entry_id in ids.scan(start):
+                if entry_id > end or len(rows) >= count:
+                    break
+                entry = group.pending[entry_id]
+                idle = now - entry.delivery_time
+                if idle >= min_idle:
+                    rows.append((entry_id, entry.consumer.name, idle, entry.delivery_count))
+        reply.array(len(rows))
+        for entry_id, consumer_name, idle, delivery_count in rows:
+            reply.array(4)
+            reply.bulk(format_id(entry_id))
+            reply.bulk(consumer_name)
+            reply.integer(idle)
+            reply.integer(delivery_count)
+
+    def __write_pending_summary(self, reply, group):
+        """XPENDING without a range: count, smallest and largest ID, and count per consumer"""
+        if not group.pending:
+            reply.array(4)
+            reply.integer(0)
+            reply.write(NULL_BULK + NULL_BULK + NULL_ARRAY)
+            return
+        reply.array(4)
+        reply.integer(len(group.pending))
+        reply.bulk(format_id(group.pending_ids.first()))
+        reply.bulk(format_id(group.pending_ids.last()))
+        owners = [consumer for consumer in group.consumers.values() if consumer.pending]
+        reply.array(len(owners))
+        for consumer in owners:
+            reply.bulks([consumer.name, b"%d" % len(consumer.pending)])
+
+    def handle_xclaim(self, connection, args):
+        key, group_name, consumer_name = args[1], args[2], args[3]
+        try:
+            min_idle = int(args[4])
+        except ValueError:
+            connection.sendall(b"-ERR Invalid min-idle-time argument for XCLAIM\r\n")
+            return
+        entry_ids = []
+        i = 5
+        while i < len(args):
+            try:
+                entry_ids.append(parse_id(args[i]))
+            except ValueError:
+                break
+            i += 1
+        now = current_ms()
+        delivery_time = now
+        retry_count = None
+        force = justid = False
+        last_id = None
+        while i < len(args):
+            option = args[i].upper()
+            if option in (b"FORCE", b"JUSTID"):
+                force = force or option == b"FORCE"
+                justid = justid or option == b"JUSTID"
+                i += 1
+                continue
+            if option not in (b"IDLE", b"TIME", b"RETRYCOUNT", b"LASTID") or i + 1 >= len(args):
+                connection.sendall(b"-ERR Unrecognized XCLAIM option '" + args[i] + b"'\r\n")
+                return
+            try:
+                if option == b"LASTID":
+                    last_id = parse_id(args[i + 1])
+                else:
+                    value = int(args[i + 1])
+            except ValueError:
+                connection.sendall(INVALID_STREAM_ID_ERROR if option == b"LASTID" else b"-ERR Invalid " + option + b" option argument for XCLAIM\r\n")
+                return
+            if option == b"IDLE":
+                delivery_time = now - value
+            elif option == b"TIME":
+                delivery_time = value
+            elif option == b"RETRYCOUNT":
+                retry_count = value
+            i += 2
+        with self.keyspace.shard(key).lock:
+            stream = self.__search_stream(key)
+            group = stream.groups.get(group_name) if stream is not None else None
+            if group is None:
+                connection.sendall(b"-NOGROUP No such key '" + key + b"' or consumer group '" + group_name + b"'\r\n")
+                return
+            if last_id is not None and last_id > group.last_id:
+                group.last_id = last_id
+            consumer, _ = group.consumer(consumer_name, now)
+            claimed = []
+            for entry_id in entry_ids:
+                entry = group.pending.get(entry_id)
+                fields = stream.get(entry_id)
+                # Entries deleted from the stream can't be claimed and leave
+                # the PEL, except with FORCE JUSTID, which takes the ID as it
+                # is: that is how an AOF rewrite restores every pending entry
+                if fields is None and not (force and justid):
+                    if entry is not None:
+                        group.ack([entry_id])
+                        self.propagate([b"XACK", key, group_name, format_id(entry_id)])
+                    continue
+                if entry is None:
+                    if not force:
+                        continue
+                    delivery_count = 1
+                else:
+                    if now - entry.delivery_time < min_idle:
+                        continue
+                    delivery_count = entry.delivery_count + (0 if justid else 1)
+                if retry_count is not None:
+                    delivery_count = retry_count
+                group.assign(entry_id, consumer, delivery_time, delivery_count)
+                self.__propagate_claim(key, group_name, consumer_name, entry_id, delivery_time, delivery_count, group)
+                claimed.append((entry_id, fields))
+        if justid:
+            connection.reply.bulks([format_id(entry_id) for entry_id, _ in claimed])
+        else:
+            self.__write_entries(connection.reply, claimed)
+
+    def handle_xautoclaim(self, connection, args):
+        key, group_name, consumer_name = args[1], args[2], args[3]
+        try:
+            min_idle = int(args[4])
+        except ValueError:
+            connection.sendall(b"-ERR Invalid min-idle-time argument for XAUTOCLAIM\r\n")
+            return
+        start = self.__parse_range_bound(args[5], is_start=True)
+        if start is None:
+            connection.sendall(INVALID_STREAM_ID_ERROR)
+            return
+        count = 100
+        justid = False
+        i = 6
+        while i < len(args):
+            option = args[i].upper()
+            if option == b"JUSTID":
+                justid = True
+                i += 1
+            elif option == b"COUNT" and i + 1 < len(args):
+                try:
+                    count = int(args[i + 1])
+                except ValueError:
+                    count = 0
+                if count < 1:
+                    connection.sendall(b"-ERR COUNT must be > 0\r\n")
+                    return
+                i += 2
+            else:
+                connection.sendall(b"-ERR syntax error\r\n")
+                return
+        now = current_ms()
+        with self.keyspace.shard(key).lock:
+            stream = self.__search_stream(key)
+            group = stream.groups.get(group_name) if stream is not None else None
+            if group is None:
+                connection.sendall(b"-NOGROUP No such key '" + key + b"' or consumer group '" + group_name + b"'\r\n")
+                return
+            consumer, _ = group.consumer(consumer_name, now)
+            claimed = []
+            deleted = []
+            # Like Redis, look at no more than ten entries per one claimed
+            attempts = count * 10
+            next_id = MIN_ID
+            for entry_id in list(itertools.islice(group.pending_ids.scan(start), attempts + 1)):
+                if attempts == 0 or len(claimed) == count:
+                    next_id = entry_id
+                    break
+                attempts -= 1
+                fields = stream.get(entry_id)
+                if fields is None:
+                    group.ack([entry_id])
+                    self.propagate([b"XACK", key, group_name, format_id(entry_id)])
+                    deleted.append(entry_id)
+                    continue
+                entry = group.pending[entry_id]
+                if now - entry.delivery_time < min_idle:
+                    continue
+                delivery_count = entry.delivery_count + (0 if justid else 1)
+                group.assign(entry_id, consumer, now, delivery_count)
+                self.__propagate_claim(key, group_name, consumer_name, entry_id, now, delivery_count, group)
+                claimed.append((entry_id, fields))
+        reply = connection.reply
+        reply.array(3)
+        reply.bulk(format_id(next_id))
+        if justid:
+            reply.bulks([format_id(entry_id) for entry_id, _ in claimed])
+        else:
+            self.__write_entries(reply, claimed)
+        reply.bulks([format_id(entry_id) for entry_id in deleted])
 
-    def __build_xread_response(self, stream_key, entries):
-        """Build RESP response for XREAD command (single stream - kept for compatibility)"""
-        # This is now just a wrapper around the multi-stream version
-        return self.__build_xread_multi_response([(stream_key, entries)])
\ No newline at end of file
+    def __propagate_claim(self, key, group_name, consumer_name, entry_id, delivery_time, delivery_count, group):
+        """Log a claimed or delivered pending entry as the XCLAIM that recreates it exactly"""
+        self.propagate([
+            b"XCLAIM", key, group_name, consumer_name, b"0", format_id(entry_id), b"TIME", b"%d" % delivery_time,
+            b"RETRYCOUNT", b"%d" % delivery_count, b"FORCE", b"JUSTID", b"LASTID", format_id(group.last_id),
+        ])
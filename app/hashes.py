@@ -0,0 +1,205 @@
+import array
+import struct
+
+from app.resp import CRLF, bulk, decode_bulks
+
+# Hashes stay packed up to this many fields, none of whose names or values
+# is longer than this many bytes: Redis' hash-max-listpack-* defaults
+HASHPACK_MAX_ENTRIES = 128
+HASHPACK_MAX_VALUE = 64
+
+# How HashPack keeps each field's hash
+FIELD_HASH = struct.Struct("q")
+
+# HSCAN cursors on a HashTable keep its compaction count in these low bits
+EPOCH_BITS = 16
+EPOCH_MASK = (1 << EPOCH_BITS) - 1
+
+
+def packable(field, value):
+    return len(field) <= HASHPACK_MAX_VALUE and len(value) <= HASHPACK_MAX_VALUE
+
+
+class HashPack:
+    """Small hash kept as the RESP bulk encodings of its fields and values, alternating, in one bytearray.
+
+    Like ListPack, that is one object per hash instead of a dict and two
+    bytes objects per field. A field is found through two small arrays
+    beside the buffer: where each field starts, and each field's hash,
+    which bytearray.find searches in C. Updating a field splices only its
+    value, and HGETALL replies are the buffer as it is. Hashes that
+    outgrow the limits above are converted to a HashTable by the caller.
+    """
+
+    __slots__ = ("data", "offsets", "hashes")
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array.array("I")
+        # FIELD_HASH-packed hash() of each field, in the order of offsets
+        self.hashes = bytearray()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def fits(self):
+        return len(self.offsets) <= HASHPACK_MAX_ENTRIES
+
+    def get(self, field):
+        found = self.__find(field)
+        if found is None:
+            return None
+        _, value_pos, end = found
+        line_end = self.data.index(CRLF, value_pos)
+        return bytes(self.data[line_end + 2:end - 2])
+
+    def set(self, field, value):
+        """Set field to value, returning whether the field is new"""
+        found = self.__find(field)
+        if found is None:
+            self.offsets.append(len(self.data))
+            self.hashes += FIELD_HASH.pack(hash(field))
+            self.data += bulk(field) + bulk(value)
+            return True
+        i, value_pos, end = found
+        encoded = bulk(value)
+        self.data[value_pos:end] = encoded
+        self.__shift(i + 1, len(encoded) - (end - value_pos))
+        return False
+
+    def delete(self, field):
+        found = self.__find(field)
+        if found is None:
+            return False
+        i, _, end = found
+        field_pos = self.offsets[i]
+        del self.data[field_pos:end]
+        del self.offsets[i]
+        del self.hashes[i * FIELD_HASH.size:(i + 1) * FIELD_HASH.size]
+        self.__shift(i, field_pos - end)
+        return True
+
+    def items(self):
+        flat = decode_bulks(self.data)
+        return list(zip(flat[::2], flat[1::2]))
+
+    def encoded(self):
+        """The fields and values as HGETALL sends them, after the array header"""
+        return bytes(self.data)
+
+    def __find(self, field):
+        """(entry number, value offset, end of value) of field's entry, or None"""
+        hashes = self.hashes
+        packed = FIELD_HASH.pack(hash(field))
+        pos = hashes.find(packed)
+        encoded = None
+        while pos != -1:
+            # A match straddling two slots is no hash at all
+            if not pos % FIELD_HASH.size:
+                i = pos // FIELD_HASH.size
+                offsets = self.offsets
+                if encoded is None:
+                    encoded = bulk(field)
+                if self.data.startswith(encoded, offsets[i]):
+                    end = offsets[i + 1] if i + 1 < len(offsets) else len(self.data)
+                    return i, offsets[i] + len(encoded), end
+            pos = hashes.find(packed, pos + 1)
+        return None
+
+    def __shift(self, start, delta):
+        """Move the entries from start on by delta bytes"""
+        if delta:
+            offsets = self.offsets
+            offsets[start:] = array.array("I", [offset + delta for offset in offsets[start:]])
+
+
+class HashTable:
+    """Hash past the packed limits: a dict whose deleted fields leave None tombstones.
+
+    HSCAN cursors are positions in the dict's insertion order, which order
+    lists so a scan resumes at its cursor directly, and a tombstone keeps
+    every later position where it was, so a field present for a whole
+    scan is never skipped. The tombstones are dropped in one go once they
+    outnumber the live fields, which keeps HDEL amortized O(1); cursors
+    from before that start over, as Redis allows a scan to return a field
+    twice.
+    """
+
+    __slots__ = ("fields", "order", "live", "epoch")
+
+    def __init__(self, items=()):
+        self.fields = dict(items)
+        # The keys of fields, tombstones included, in the same order
+        self.order = list(self.fields)
+        self.live = len(self.fields)
+        # Compactions so far, which change every position
+        self.epoch = 0
+
+    def __len__(self):
+        return self.live
+
+    def get(self, field):
+        return self.fields.get(field)
+
+    def set(self, field, value):
+        """Set field to value, returning whether the field is new"""
+        fields = self.fields
+        size = len(fields)
+        new = fields.get(field) is None
+        fields[field] = value
+        # A field back from a tombstone keeps its slot
+        if len(fields) > size:
+            self.order.append(field)
+        if new:
+            self.live += 1
+        return new
+
+    def delete(self, field):
+        fields = self.fields
+        if fields.get(field) is None:
+            return False
+        fields[field] = None
+        self.live -= 1
+        if len(fields) - self.live > self.live:
+            self.fields = {field: value for field, value in fields.items() if value is not None}
+            self.order = list(self.fields)
+            self.epoch += 1
+        return True
+
+    def items(self):
+        return [(field, value) for field, value in self.fields.items() if value is not None]
+
+    def scan(self, cursor, count):
+        """Up to count (field, value) pairs from cursor on, and the cursor to continue from, 0 at the end"""
+        epoch = self.epoch & EPOCH_MASK
+        position = cursor >> EPOCH_BITS if cursor & EPOCH_MASK == epoch else 0
+        fields = self.fields
+        order = self.order
+        # Bounds the tombstones one call walks past
+        end = min(len(order), position + count * 10)
+        found = []
+        while position < end:
+            field = order[position]
+            position += 1
+            value = fields[field]
+            if value is not None:
+                found.append((field, value))
+                if len(found) >= count:
+                    break
+        if position >= len(order):
+            return found, 0
+        return found, position << EPOCH_BITS | epoch
+
+
+# What a hash value can be held as
+HASH_TYPES = (HashPack, HashTable)
+
+
+def new_hash(items):
+    """A hash holding the (field, value) pairs in items, packed if it is small enough"""
+    if len(items) > HASHPACK_MAX_ENTRIES or not all(packable(field, value) for field, value in items):
+        return HashTable(items)
+    packed = HashPack()
+    for field, value in items:
+        packed.set(field, value)
+    return packed
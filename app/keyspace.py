@@ -0,0 +1,167 @@
+import functools
+import random
+import re
+import threading
+
+from app.expiry import ExpiryIndex
+
+KEYSPACE_SHARDS = 16
+
+# Low bits of a SCAN cursor that hold the compaction count of its shard
+SCAN_EPOCH_BITS = 16
+SCAN_EPOCH_MASK = (1 << SCAN_EPOCH_BITS) - 1
+
+
+@functools.lru_cache(maxsize=64)
+def compile_glob(pattern):
+    """Compile a Redis glob such as b"user:[0-9]*" into a bytes regex.
+
+    Supports *, ?, [...] classes with ^ negation and ranges, and
+    backslash escapes, like Redis' stringmatchlen().
+    """
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i:i + 1]
+        i += 1
+        if c == b"*":
+            out.append(b".*")
+        elif c == b"?":
+            out.append(b".")
+        elif c == b"\\" and i < len(pattern):
+            out.append(re.escape(pattern[i:i + 1]))
+            i += 1
+        elif c == b"[":
+            i = _compile_class(pattern, i, out)
+        else:
+            out.append(re.escape(c))
+    return re.compile(b"".join(out), re.DOTALL)
+
+
+def _compile_class(pattern, i, out):
+    """Add the regex for the [...] class starting at pattern[i], returning the index past it"""
+    negate = pattern[i:i + 1] == b"^"
+    if negate:
+        i += 1
+    parts = []
+    while i < len(pattern) and pattern[i:i + 1] != b"]":
+        c = pattern[i:i + 1]
+        if c == b"\\" and i + 1 < len(pattern):
+            i += 1
+            c = pattern[i:i + 1]
+        if pattern[i + 1:i + 2] == b"-" and i + 2 < len(pattern) and pattern[i + 2:i + 3] != b"]":
+            low, high = sorted((c, pattern[i + 2:i + 3]))
+            parts.append(re.escape(low) + b"-" + re.escape(high))
+            i += 3
+        else:
+            parts.append(re.escape(c))
+            i += 1
+    if not parts:
+        # [] matches nothing and [^] any single byte
+        out.append(b"." if negate else b"(?!)")
+    else:
+        out.append(b"[" + (b"^" if negate else b"") + b"".join(parts) + b"]")
+    # An unterminated class runs to the end of the pattern, as in Redis
+    return i + 1
+
+
+class Shard:
+    """One slice of the keyspace and the lock that guards it"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Strings and lists; streams live in self.streams
+        self.dictionary = {}
+        self.streams = {}
+        # TTLs of keys in either table, in unix ms
+        self.expires = ExpiryIndex()
+        # GET replies already encoded as RESP bulk strings, dropped whenever
+        # the key is deleted or overwritten, or to free memory; their bytes
+        # count toward maxmemory through Evictor.cached
+        self.replies = {}
+        # Keys of both tables in the order they were added, for SCAN. A
+        # deleted key stays until the list is compacted, so the position a
+        # cursor points at holds still, and a key added again after a
+        # delete is listed twice until then
+        self.scan_order = []
+        # Compactions of scan_order so far, which change every position
+        self.scan_epoch = 0
+        # Keys deleted because their TTL passed, for INFO stats
+        self.expired_keys = 0
+
+
+    def index_key(self, key):
+        """Register a key just added to either table with SCAN"""
+        self.scan_order.append(key)
+
+    def unindex_key(self, key):
+        """Called once key is gone from both tables; drops deleted keys from scan_order when they outnumber live ones"""
+        live = len(self.dictionary) + len(self.streams)
+        if len(self.scan_order) > 2 * live + 64:
+            self.scan_order = [*self.dictionary, *self.streams]
+            self.scan_epoch += 1
+
+
+class ShardLocks:
+    """Holds several shard locks at once, taken in shard order"""
+
+    def __init__(self, locks):
+        self.locks = locks
+
+    def __enter__(self):
+        for lock in self.locks:
+            lock.acquire()
+
+    def __exit__(self, *exc_info):
+        for lock in reversed(self.locks):
+            lock.release()
+
+
+class Keyspace:
+    """The keyspace, split into shards by key hash.
+
+    A command only locks the shards of the keys it touches. Commands on
+    several keys take their shard locks in index order, so two of them can
+    never each hold a lock the other is waiting for.
+    """
+
+    def __init__(self, count=KEYSPACE_SHARDS):
+        self.shards = [Shard() for _ in range(count)]
+
+    def shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def lock(self, keys):
+        """Context manager holding the locks of every shard keys fall in"""
+        indexes = sorted({hash(key) % len(self.shards) for key in keys})
+        if len(indexes) == 1:
+            return self.shards[indexes[0]].lock
+        return ShardLocks([self.shards[i].lock for i in indexes])
+
+    def lock_all(self):
+        return ShardLocks([shard.lock for shard in self.shards])
+
+    def items(self):
+        """(key, value) for every key; the caller holds lock_all()"""
+        for shard in self.shards:
+            yield from shard.dictionary.items()
+            yield from shard.streams.items()
+
+    def deadline(self, key):
+        """key's TTL deadline, read without taking its shard lock"""
+        return self.shard(key).expires.get(key)
+
+    def sample_volatile(self, count):
+        """count random keys with a TTL, drawn from random shards, or fewer if there are not that many"""
+        keys = []
+        shards = [shard for shard in self.shards if len(shard.expires)]
+        while len(keys) < count and shards:
+            shard = random.choice(shards)
+            with shard.lock:
+                found = shard.expires.sample(1)
+            if found:
+                keys.extend(found)
+            else:
+                # Its last TTL went since the shards were listed
+                shards.remove(shard)
+        return keys
@@ -0,0 +1,86 @@
+import collections
+import threading
+import time
+
+# Samples kept per event, one per second at most, as in Redis
+LATENCY_TS_LEN = 160
+
+
+class LatencyEvent:
+    def __init__(self):
+        # [unix time, milliseconds], oldest first
+        self.samples = collections.deque(maxlen=LATENCY_TS_LEN)
+        self.max = 0
+
+
+class LatencyMonitor:
+    """Redis' latency monitor: a short history of spikes per event.
+
+    Callers report an event, such as "command" or "expire-cycle", when it
+    took at least latency-monitor-threshold milliseconds; several spikes
+    within the same second keep the worst one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = {}
+
+    def add_sample(self, name, ms):
+        now = int(time.time())
+        with self.lock:
+            event = self.events.get(name)
+            if event is None:
+                event = self.events[name] = LatencyEvent()
+            samples = event.samples
+            if samples and samples[-1][0] == now:
+                samples[-1][1] = max(samples[-1][1], ms)
+            else:
+                samples.append([now, ms])
+            event.max = max(event.max, ms)
+
+    def latest(self):
+        """(event, time, latest ms, max ms) per event"""
+        with self.lock:
+            return [
+                (name, event.samples[-1][0], event.samples[-1][1], event.max)
+                for name, event in self.events.items()
+            ]
+
+    def history(self, name):
+        with self.lock:
+            event = self.events.get(name)
+            return [] if event is None else [tuple(sample) for sample in event.samples]
+
+    def reset(self, names=None):
+        """Forget the named events, or all of them; returns how many were dropped"""
+        with self.lock:
+            if not names:
+                count = len(self.events)
+                self.events.clear()
+                return count
+            return sum(self.events.pop(name, None) is not None for name in names)
+
+
+def cumulative_histogram(histogram):
+    """(microseconds, calls at or under it) for each power of two from the first used slot to the last"""
+    used = [i for i, count in enumerate(histogram) if count]
+    if not used:
+        return []
+    buckets = []
+    total = 0
+    for i in range(used[0], used[-1] + 1):
+        total += histogram[i]
+        buckets.append((1 << i, total))
+    return buckets
+
+
+def histogram_percentile(histogram, fraction):
+    """Upper bound in microseconds of the slot the given fraction of calls fits under"""
+    calls = sum(histogram)
+    target = max(1, fraction * calls)
+    total = 0
+    for i, count in enumerate(histogram):
+        total += count
+        if total >= target:
+            return 1 << i
+    return 0
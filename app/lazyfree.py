@@ -0,0 +1,70 @@
+import collections
+import queue
+import threading
+
+from app.hashes import HashTable
+from app.stream import Stream
+
+# Like Redis' LAZYFREE_THRESHOLD: values with more items than this are freed in the background
+LAZYFREE_THRESHOLD = 64
+# Stream entries or hash fields released per step of the background thread
+FREE_BATCH = 1024
+
+
+def free_effort(value):
+    """Roughly how many objects freeing value releases"""
+    if isinstance(value, (collections.deque, Stream, HashTable)):
+        return len(value)
+    # Strings, ints and listpacks are each a single buffer
+    return 1
+
+
+class LazyFree:
+    """Frees large unlinked values in a background thread, as UNLINK does in Redis.
+
+    Dropping the last reference to a deque, stream or hash table releases
+    every item in one C call that holds the GIL until it is done, stalling
+    every client. The thread empties them a little at a time instead, so
+    other threads get the GIL in between. A value handed over is no longer
+    reachable from the keyspace, so nothing else can be reading it.
+    """
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        # Guards pending and the lazy start of the thread
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.thread = None
+
+    def free(self, value):
+        """Take over value if it is worth freeing in the background; small ones are left to the caller"""
+        if free_effort(value) <= LAZYFREE_THRESHOLD:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run, daemon=True)
+                self.thread.start()
+            self.pending += 1
+        self.queue.put(value)
+
+    def __run(self):
+        while True:
+            value = self.queue.get()
+            if isinstance(value, Stream):
+                fields = value.fields
+                while fields:
+                    del fields[-FREE_BATCH:]
+            elif isinstance(value, HashTable):
+                popitem = value.fields.popitem
+                while value.fields:
+                    popitem()
+                order = value.order
+                while order:
+                    del order[-FREE_BATCH:]
+            else:
+                pop = value.pop
+                while value:
+                    pop()
+            value = None
+            with self.lock:
+                self.pending -= 1
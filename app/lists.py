@@ -0,0 +1,116 @@
+import itertools
+from collections import deque
+
+from app.resp import CRLF, bulk, decode_bulks
+
+# Lists stay packed up to this many items or bytes of encoded items, Redis'
+# list-max-listpack-size default of -2 (8 kb) plus a cap on the count
+LISTPACK_MAX_ENTRIES = 128
+LISTPACK_MAX_BYTES = 8192
+
+
+class ListPack:
+    """Small list kept as the RESP bulk encodings of its items in one bytearray.
+
+    That is one object per list instead of a bytes object and a deque
+    slot per item, and LRANGE replies are slices of the buffer. Lists that
+    outgrow the limits above are converted to a deque by the caller.
+    """
+
+    __slots__ = ("data", "count")
+
+    def __init__(self, items=()):
+        self.data = bytearray()
+        self.count = 0
+        self.extend(items)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(decode_bulks(self.data))
+
+    def __reversed__(self):
+        return reversed(decode_bulks(self.data))
+
+    def fits(self):
+        return self.count <= LISTPACK_MAX_ENTRIES and len(self.data) <= LISTPACK_MAX_BYTES
+
+    def extend(self, items):
+        self.data += b"".join([bulk(item) for item in items])
+        self.count += len(items)
+
+    def extendleft(self, items):
+        """Push items to the head one at a time, so the last ends up first, as deque does"""
+        self.data[0:0] = b"".join([bulk(item) for item in reversed(items)])
+        self.count += len(items)
+
+    def popleft(self):
+        data = self.data
+        line_end = data.index(CRLF)
+        end = line_end + 2 + int(data[1:line_end])
+        item = bytes(data[line_end + 2:end])
+        del data[:end + 2]
+        self.count -= 1
+        return item
+
+    def encoded_range(self, start, end):
+        """(count, RESP encoding) of the items LRANGE start end returns"""
+        window = clamp_range(self.count, start, end)
+        if window is None:
+            return 0, b""
+        start, end = window
+        first = self.__skip(0, start)
+        return end - start + 1, bytes(self.data[first:self.__skip(first, end - start + 1)])
+
+    def __skip(self, pos, count):
+        """Offset of the item count items after the one at pos"""
+        data = self.data
+        for _ in range(count):
+            line_end = data.index(CRLF, pos)
+            pos = line_end + 4 + int(data[pos + 1:line_end])
+        return pos
+
+
+# What a list value can be held as
+LIST_TYPES = (deque, ListPack)
+
+
+def new_list(items):
+    """A list holding items, packed if it is small enough"""
+    if len(items) > LISTPACK_MAX_ENTRIES:
+        return deque(items)
+    packed = ListPack(items)
+    return packed if packed.fits() else deque(items)
+
+
+def clamp_range(length, start, end):
+    """LRANGE start and end as indexes into a list of length, or None if the window is empty"""
+    if start < 0:
+        start += length
+    if end < 0:
+        end += length
+    start = max(0, start)
+    end = min(length - 1, end)
+    if start > end:
+        return None
+    return start, end
+
+
+def list_range(lst, start, end):
+    """Return the items of lst from start to end inclusive, LRANGE style.
+
+    Negative indices count from the tail. Only the requested window is
+    walked: from the head when it sits nearer the head, otherwise
+    backwards from the tail.
+    """
+    length = len(lst)
+    window = clamp_range(length, start, end)
+    if window is None:
+        return []
+    start, end = window
+    if start <= length - 1 - end:
+        return list(itertools.islice(lst, start, end + 1))
+    window = list(itertools.islice(reversed(lst), length - 1 - end, length - start))
+    window.reverse()
+    return window
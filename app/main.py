@@ -1,20 +1,65 @@
 import socket
-import threading
+import sys
 
+from app.config import Config, ConfigError
 from app.handler import Handler
+from app.rdb import RdbError
+from app.resp import ProtocolError
+from app.server import serve_event_loop, serve_threads
+from app.workers import serve_workers
 
 def main():
+    try:
+        config = Config.from_args(sys.argv[1:])
+    except ConfigError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
     # You can use print statements as follows for debugging, they'll be visible when running tests.
     print("Logs from your program will appear here!")
 
-    # Uncomment this to pass the first stage
-    #
-    server_socket = socket.create_server(("localhost", 6379), reuse_port=True)
-    handler = Handler()
-    while True:
-        connection, _ = server_socket.accept() # wait for client
-        client_thread = threading.Thread(target=handler.handle, args=(connection,))
-        client_thread.start()
+    if int(config.get("workers")) > 1:
+        # Forwarding between workers runs in the connection's own thread
+        if config.get("io-mode") != "thread":
+            print("Error: --workers needs --io-mode thread", file=sys.stderr)
+            sys.exit(1)
+        if config.get("appendonly") == "yes":
+            print("Error: --appendonly yes is not supported with --workers", file=sys.stderr)
+            sys.exit(1)
+        if config.get("replicaof"):
+            print("Error: --replicaof is not supported with --workers", file=sys.stderr)
+            sys.exit(1)
+        serve_workers(config)
+        return
+
+    server_socket = socket.create_server(("localhost", int(config.get("port"))), reuse_port=True)
+    handler = Handler(config)
+    if config.get("appendonly") == "yes":
+        # The AOF has every write, so it takes precedence over the snapshot
+        try:
+            replayed = handler.load_aof()
+        except (OSError, RdbError, ProtocolError) as e:
+            print(f"Error loading the AOF: {e}", file=sys.stderr)
+            sys.exit(1)
+        if replayed:
+            print(f"Replayed {replayed} commands from the AOF")
+    else:
+        try:
+            loaded = handler.load_snapshot()
+        except (OSError, RdbError) as e:
+            print(f"Error loading the RDB snapshot: {e}", file=sys.stderr)
+            sys.exit(1)
+        if loaded:
+            print(f"Loaded {loaded} keys from the RDB snapshot")
+    try:
+        handler.follow_master()
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    if config.get("io-mode") == "eventloop":
+        serve_event_loop(handler, server_socket)
+    else:
+        serve_threads(handler, server_socket)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,423 @@
+"""RDB snapshot files (version 11).
+
+Strings, lists and hashes are written with the standard Redis encodings,
+so a snapshot holding only those loads in Redis as well; strings stored as
+integers use Redis' integer string encoding. Streams are kept
+as plain entry arrays rather than radix trees of listpacks here, so
+they are written under private value types, one without consumer groups
+and one followed by them. The loader also reads the
+encodings Redis itself writes for strings and lists (integer and LZF
+encoded strings, quicklists of listpacks, listpack hashes), so a
+dump.rdb from Redis can seed the server.
+"""
+import os
+import struct
+
+from app.groups import ConsumerGroup
+from app.hashes import HASH_TYPES, new_hash
+from app.lists import LIST_TYPES, new_list
+from app.stream import Stream
+from app.strings import compact_string
+
+RDB_VERSION = 11
+
+TYPE_STRING = 0
+TYPE_LIST = 1
+TYPE_HASH = 4
+TYPE_HASH_LISTPACK = 16
+TYPE_LIST_QUICKLIST_2 = 18
+# Not a Redis type: a stream as its last ID and entries, in ID order
+TYPE_STREAM_ENTRIES = 200
+# Not a Redis type either: the same, then its consumer groups and their pending entries
+TYPE_STREAM_GROUPS = 201
+
+OPCODE_IDLE = 0xF8
+OPCODE_FREQ = 0xF9
+OPCODE_AUX = 0xFA
+OPCODE_RESIZEDB = 0xFB
+OPCODE_EXPIRETIME_MS = 0xFC
+OPCODE_EXPIRETIME = 0xFD
+OPCODE_SELECTDB = 0xFE
+OPCODE_EOF = 0xFF
+
+# Special string encodings, flagged by the top two bits of a length byte
+ENC_INT8 = 0
+ENC_INT16 = 1
+ENC_INT32 = 2
+ENC_LZF = 3
+
+QUICKLIST_NODE_PLAIN = 1
+QUICKLIST_NODE_PACKED = 2
+
+# Large buffers keep file I/O out of the per-key path on both sides
+WRITE_BUFFER = 1 << 20
+READ_CHUNK = 4 << 20
+
+SMALL_LENGTHS = [bytes((n,)) for n in range(64)]
+
+
+class RdbError(Exception):
+    pass
+
+
+def encode_length(n):
+    if n < 64:
+        return SMALL_LENGTHS[n]
+    if n < 16384:
+        return bytes((0x40 | n >> 8, n & 0xFF))
+    if n <= 0xFFFFFFFF:
+        return b"\x80" + struct.pack(">I", n)
+    return b"\x81" + struct.pack(">Q", n)
+
+
+def encode_string(value):
+    return encode_length(len(value)) + value
+
+
+def encode_integer_string(value):
+    if -(1 << 7) <= value < 1 << 7:
+        return bytes((0xC0 | ENC_INT8,)) + struct.pack("b", value)
+    if -(1 << 15) <= value < 1 << 15:
+        return bytes((0xC0 | ENC_INT16,)) + struct.pack("<h", value)
+    if -(1 << 31) <= value < 1 << 31:
+        return bytes((0xC0 | ENC_INT32,)) + struct.pack("<i", value)
+    return encode_string(b"%d" % value)
+
+
+def save_rdb(path, entries, key_count, expires_count, aux=()):
+    """Write a snapshot of entries, (key, value, expire ms or None) tuples, to path.
+
+    The file is written next to path and renamed over it once complete, so
+    a crash mid-save never leaves a truncated snapshot behind.
+    """
+    temp_path = os.path.join(os.path.dirname(path) or ".", f"temp-{os.getpid()}.rdb")
+    try:
+        with open(temp_path, "wb", buffering=WRITE_BUFFER) as file:
+            write_snapshot(file, entries, key_count, expires_count, aux)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def write_snapshot(file, entries, key_count, expires_count, aux):
+    write = file.write
+    write(b"REDIS%04d" % RDB_VERSION)
+    for name, value in aux:
+        write(bytes((OPCODE_AUX,)) + encode_string(name) + encode_string(value))
+    write(bytes((OPCODE_SELECTDB,)) + encode_length(0))
+    write(bytes((OPCODE_RESIZEDB,)) + encode_length(key_count) + encode_length(expires_count))
+    for key, value, expire in entries:
+        if expire is not None:
+            write(bytes((OPCODE_EXPIRETIME_MS,)) + struct.pack("<Q", expire))
+        if isinstance(value, LIST_TYPES):
+            write(bytes((TYPE_LIST,)) + encode_string(key) + encode_length(len(value)))
+            write(b"".join([encode_length(len(item)) + item for item in value]))
+        elif isinstance(value, HASH_TYPES):
+            items = value.items()
+            write(bytes((TYPE_HASH,)) + encode_string(key) + encode_length(len(items)))
+            write(b"".join([encode_string(field) + encode_string(item) for field, item in items]))
+        elif isinstance(value, Stream):
+            write(bytes((TYPE_STREAM_GROUPS if value.groups else TYPE_STREAM_ENTRIES,)) + encode_string(key))
+            write_stream(write, value)
+            if value.groups:
+                write_groups(write, value.groups)
+        elif value.__class__ is int:
+            write(bytes((TYPE_STRING,)) + encode_string(key) + encode_integer_string(value))
+        else:
+            write(bytes((TYPE_STRING,)) + encode_length(len(key)) + key + encode_length(len(value)) + value)
+    # A zero checksum tells loaders that checksumming was turned off
+    write(bytes((OPCODE_EOF,)) + bytes(8))
+
+
+def write_stream(write, stream):
+    write(encode_length(stream.last_id[0]) + encode_length(stream.last_id[1]) + encode_length(len(stream)))
+    parts = []
+    for (ms, seq), fields in stream.entries():
+        parts.append(encode_length(ms) + encode_length(seq) + encode_length(len(fields)))
+        parts += [encode_length(len(item)) + item for item in fields]
+    write(b"".join(parts))
+
+
+def write_groups(write, groups):
+    parts = [encode_length(len(groups))]
+    for name, group in groups.items():
+        parts.append(encode_string(name) + encode_length(group.last_id[0]) + encode_length(group.last_id[1]))
+        parts.append(encode_length(len(group.consumers)))
+        for consumer in group.consumers.values():
+            parts.append(encode_string(consumer.name) + encode_length(consumer.seen_time))
+            parts.append(encode_length(len(consumer.pending)))
+            for entry_id in consumer.pending_ids.scan():
+                entry = consumer.pending[entry_id]
+                parts.append(
+                    encode_length(entry_id[0]) + encode_length(entry_id[1])
+                    + encode_length(entry.delivery_time) + encode_length(entry.delivery_count)
+                )
+    write(b"".join(parts))
+
+
+class Reader:
+    """Reads an RDB file through one large buffer instead of a call per field"""
+
+    def __init__(self, file):
+        self.file = file
+        self.buffer = b""
+        self.pos = 0
+
+    def read(self, n):
+        pos = self.pos
+        end = pos + n
+        if end > len(self.buffer):
+            self.__refill(n)
+            pos, end = 0, n
+        self.pos = end
+        return self.buffer[pos:end]
+
+    def byte(self):
+        if self.pos >= len(self.buffer):
+            self.__refill(1)
+        value = self.buffer[self.pos]
+        self.pos += 1
+        return value
+
+    def length(self):
+        """Read a length, returning (value, is_special_encoding)"""
+        first = self.byte()
+        kind = first >> 6
+        if kind == 0:
+            return first, False
+        if kind == 1:
+            return (first & 0x3F) << 8 | self.byte(), False
+        if kind == 3:
+            return first & 0x3F, True
+        if first == 0x80:
+            return struct.unpack(">I", self.read(4))[0], False
+        if first == 0x81:
+            return struct.unpack(">Q", self.read(8))[0], False
+        raise RdbError(f"unknown length encoding 0x{first:02x}")
+
+    def integer(self):
+        value, special = self.length()
+        if special:
+            raise RdbError("expected a length, got an encoded string")
+        return value
+
+    def string(self):
+        # Short strings that are already buffered skip the general length decoding
+        buffer = self.buffer
+        pos = self.pos
+        if pos < len(buffer):
+            length = buffer[pos]
+            end = pos + 1 + length
+            if length < 64 and end <= len(buffer):
+                self.pos = end
+                return buffer[pos + 1:end]
+        length, special = self.length()
+        if not special:
+            return self.read(length)
+        if length == ENC_INT8:
+            return b"%d" % struct.unpack("b", self.read(1))[0]
+        if length == ENC_INT16:
+            return b"%d" % struct.unpack("<h", self.read(2))[0]
+        if length == ENC_INT32:
+            return b"%d" % struct.unpack("<i", self.read(4))[0]
+        if length == ENC_LZF:
+            compressed_length = self.integer()
+            length = self.integer()
+            return lzf_decompress(self.read(compressed_length), length)
+        raise RdbError(f"unknown string encoding {length}")
+
+    def __refill(self, n):
+        rest = self.buffer[self.pos:]
+        data = self.file.read(max(READ_CHUNK, n - len(rest)))
+        self.buffer = rest + data
+        self.pos = 0
+        if len(self.buffer) < n:
+            raise RdbError("unexpected end of file")
+
+
+def load_rdb(path):
+    """Yield (key, value, expire ms or None) for every key in the snapshot at path"""
+    with open(path, "rb", buffering=0) as file:
+        yield from read_rdb(file)
+
+
+def read_rdb(file):
+    """Yield the keys of the snapshot read from a binary file object, as load_rdb() does"""
+    reader = Reader(file)
+    magic = reader.read(9)
+    if magic[:5] != b"REDIS" or not magic[5:].isdigit():
+        raise RdbError("not an RDB file")
+    if int(magic[5:]) > RDB_VERSION:
+        raise RdbError(f"can't handle RDB format version {int(magic[5:])}")
+    byte = reader.byte
+    string = reader.string
+    expire = None
+    while True:
+        kind = byte()
+        # Value types all sort below the opcodes, and strings come first
+        if kind < OPCODE_IDLE:
+            key = string()
+            yield key, compact_string(string()) if kind == TYPE_STRING else read_value(reader, kind), expire
+            expire = None
+            continue
+        if kind == OPCODE_EOF:
+            return
+        if kind == OPCODE_EXPIRETIME_MS:
+            expire = struct.unpack("<Q", reader.read(8))[0]
+            continue
+        if kind == OPCODE_EXPIRETIME:
+            expire = struct.unpack("<I", reader.read(4))[0] * 1000
+            continue
+        if kind == OPCODE_AUX:
+            reader.string()
+            reader.string()
+            continue
+        if kind == OPCODE_SELECTDB:
+            reader.integer()
+            continue
+        if kind == OPCODE_RESIZEDB:
+            reader.integer()
+            reader.integer()
+            continue
+        if kind == OPCODE_IDLE:
+            reader.integer()
+            continue
+        if kind == OPCODE_FREQ:
+            reader.byte()
+            continue
+        raise RdbError(f"unknown opcode 0x{kind:02x}")
+
+
+def read_value(reader, kind):
+    if kind == TYPE_STRING:
+        return compact_string(reader.string())
+    if kind == TYPE_LIST:
+        string = reader.string
+        return new_list([string() for _ in range(reader.integer())])
+    if kind == TYPE_LIST_QUICKLIST_2:
+        items = []
+        for _ in range(reader.integer()):
+            container = reader.integer()
+            node = reader.string()
+            if container == QUICKLIST_NODE_PLAIN:
+                items.append(node)
+            else:
+                items.extend(listpack_entries(node))
+        return new_list(items)
+    if kind == TYPE_HASH:
+        string = reader.string
+        return new_hash([(string(), string()) for _ in range(reader.integer())])
+    if kind == TYPE_HASH_LISTPACK:
+        flat = listpack_entries(reader.string())
+        return new_hash(list(zip(flat[::2], flat[1::2])))
+    if kind == TYPE_STREAM_ENTRIES:
+        return read_stream(reader)
+    if kind == TYPE_STREAM_GROUPS:
+        stream = read_stream(reader)
+        read_groups(reader, stream)
+        return stream
+    raise RdbError(f"unsupported value type {kind}")
+
+
+def read_stream(reader):
+    integer = reader.integer
+    string = reader.string
+    stream = Stream()
+    last_id = (integer(), integer())
+    for _ in range(integer()):
+        entry_id = (integer(), integer())
+        stream.append(entry_id, [string() for _ in range(integer())])
+    stream.last_id = last_id
+    return stream
+
+
+def read_groups(reader, stream):
+    integer = reader.integer
+    string = reader.string
+    for _ in range(integer()):
+        name = string()
+        group = stream.groups[name] = ConsumerGroup((integer(), integer()))
+        for _ in range(integer()):
+            consumer, _ = group.consumer(string(), integer())
+            for _ in range(integer()):
+                entry_id = (integer(), integer())
+                group.assign(entry_id, consumer, integer(), integer())
+
+
+def lzf_decompress(data, length):
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        ctrl = data[i]
+        i += 1
+        if ctrl < 32:
+            # Literal run of ctrl + 1 bytes
+            out += data[i:i + ctrl + 1]
+            i += ctrl + 1
+            continue
+        # Back reference: copy run bytes from earlier output, possibly overlapping
+        run = ctrl >> 5
+        if run == 7:
+            run += data[i]
+            i += 1
+        start = len(out) - ((ctrl & 0x1F) << 8) - data[i] - 1
+        i += 1
+        run += 2
+        if start < 0:
+            raise RdbError("invalid LZF back reference")
+        if start + run <= len(out):
+            out += out[start:start + run]
+        else:
+            for offset in range(run):
+                out.append(out[start + offset])
+    if len(out) != length:
+        raise RdbError("LZF data does not match its length")
+    return bytes(out)
+
+
+def listpack_entries(lp):
+    """Decode the elements of a listpack blob; integers come back as their decimal bytes"""
+    items = []
+    pos = 6  # total bytes (4) and element count (2)
+    while lp[pos] != 0xFF:
+        first = lp[pos]
+        if first < 0x80:
+            item, size = b"%d" % first, 1
+        elif first < 0xC0:
+            length = first & 0x3F
+            item, size = lp[pos + 1:pos + 1 + length], 1 + length
+        elif first < 0xE0:
+            value = (first & 0x1F) << 8 | lp[pos + 1]
+            item, size = b"%d" % (value - (1 << 13) if value >= 1 << 12 else value), 2
+        elif first < 0xF0:
+            length = (first & 0x0F) << 8 | lp[pos + 1]
+            item, size = lp[pos + 2:pos + 2 + length], 2 + length
+        elif first == 0xF0:
+            length = int.from_bytes(lp[pos + 1:pos + 5], "little")
+            item, size = lp[pos + 5:pos + 5 + length], 5 + length
+        elif 0xF1 <= first <= 0xF4:
+            width = (2, 3, 4, 8)[first - 0xF1]
+            value = int.from_bytes(lp[pos + 1:pos + 1 + width], "little", signed=True)
+            item, size = b"%d" % value, 1 + width
+        else:
+            raise RdbError(f"unknown listpack encoding 0x{first:02x}")
+        items.append(bytes(item))
+        pos += size + backlen_size(size)
+    return items
+
+
+def backlen_size(size):
+    """Bytes taken by the backwards length that follows a listpack element"""
+    if size <= 127:
+        return 1
+    if size < 16383:
+        return 2
+    if size < 2097151:
+        return 3
+    if size < 268435455:
+        return 4
+    return 5
@@ -0,0 +1,359 @@
+"""Master/replica replication.
+
+A master keeps the write commands it propagates in a fixed-size circular
+backlog; every replica is streamed from its own position in it. A
+reconnecting replica asks to continue from the replication ID and offset
+it reached (PSYNC), which works as long as that offset is still in the
+backlog; otherwise it gets a full resync, an RDB snapshot followed by the
+stream from the offset the snapshot was taken at.
+
+A replica applies the stream like a client whose replies go nowhere, and
+feeds its own backlog with exactly the bytes it applied, so its offset is
+the master's and its own replicas can continue from it after a failover.
+"""
+import socket
+import threading
+import time
+import uuid
+
+from app.connection import Connection
+from app.resp import ProtocolError, RequestParser, encode_command
+
+# Blocking registry key WAIT clients block on; woken by each replica ACK
+REPLICA_ACKS = object()
+
+NO_REPLID = "0" * 40
+
+RECONNECT_DELAY = 1
+
+
+class ReplicationError(Exception):
+    pass
+
+
+def new_replid():
+    return uuid.uuid4().hex + uuid.uuid4().hex[:8]
+
+
+class Backlog:
+    """The last size bytes of the replication stream.
+
+    offset counts every byte ever written, so stream positions stay valid
+    as the buffer wraps around.
+    """
+
+    def __init__(self, size, offset=0):
+        self.buffer = bytearray(size)
+        self.offset = offset
+        self.histlen = 0
+
+    def write(self, data):
+        size = len(self.buffer)
+        self.offset += len(data)
+        if len(data) > size:
+            data = data[-size:]
+        start = (self.offset - len(data)) % size
+        first = min(len(data), size - start)
+        self.buffer[start:start + first] = data[:first]
+        self.buffer[:len(data) - first] = data[first:]
+        self.histlen = min(size, self.histlen + len(data))
+
+    def first_offset(self):
+        return self.offset - self.histlen
+
+    def read(self, start):
+        """The stream from position start on, or None if it is no longer buffered"""
+        if not self.first_offset() <= start <= self.offset:
+            return None
+        size = len(self.buffer)
+        begin = start % size
+        length = self.offset - start
+        if begin + length <= size:
+            return bytes(self.buffer[begin:begin + length])
+        return bytes(self.buffer[begin:] + self.buffer[:length - (size - begin)])
+
+    def resized(self, size):
+        backlog = Backlog(size, self.first_offset())
+        backlog.write(self.read(self.first_offset()))
+        return backlog
+
+
+class Replication:
+    """Replication ID, offset and backlog of this server, and the replicas streamed from it.
+
+    feed() is called with the key's shard lock held, so lock is taken
+    after shard locks, never before.
+    """
+
+    def __init__(self, backlog_size):
+        self.replid = new_replid()
+        # The ID this server's history went by before, and up to which offset
+        self.replid2 = NO_REPLID
+        self.second_offset = -1
+        self.backlog_size = backlog_size
+        # Created when the first replica attaches; until then nothing is kept
+        self.backlog = None
+        self.replicas = []
+        self.lock = threading.Lock()
+        self.fed = threading.Condition(self.lock)
+
+    def offset(self):
+        backlog = self.backlog
+        return backlog.offset if backlog is not None else 0
+
+    def feed(self, args):
+        if self.backlog is None:
+            return
+        self.feed_raw(encode_command(args))
+
+    def feed_raw(self, data):
+        with self.lock:
+            self.backlog.write(data)
+            self.fed.notify_all()
+
+    def resize(self, size):
+        with self.lock:
+            self.backlog_size = size
+            if self.backlog is not None:
+                self.backlog = self.backlog.resized(size)
+
+    def continue_position(self, replid, offset):
+        """Stream position a PSYNC for replid at offset can continue from, or None"""
+        start = offset - 1
+        with self.lock:
+            if self.backlog is None:
+                return None
+            if replid != self.replid and (replid != self.replid2 or start > self.second_offset):
+                return None
+            if self.backlog.read(start) is None:
+                return None
+        return start
+
+    def full_sync_position(self):
+        """Start keeping a backlog if there is none and return the current offset"""
+        with self.lock:
+            if self.backlog is None:
+                self.backlog = Backlog(self.backlog_size)
+            return self.backlog.offset
+
+    def attach(self, sock, listening_port, start, preamble, on_ack):
+        """Stream to a replica from position start, after preamble(sock) has run"""
+        replica = Replica(self, sock, listening_port, start, on_ack)
+        with self.lock:
+            self.replicas.append(replica)
+        replica.start(preamble)
+
+    def detach(self, replica):
+        with self.lock:
+            if replica in self.replicas:
+                self.replicas.remove(replica)
+            self.fed.notify_all()
+
+    def acked(self, offset):
+        """How many replicas have acknowledged the stream up to offset"""
+        return sum(1 for replica in list(self.replicas) if replica.ack >= offset)
+
+    def request_acks(self):
+        if self.replicas:
+            self.feed([b"REPLCONF", b"GETACK", b"*"])
+
+    def promote(self):
+        """Start a history of our own; replicas of the old master can still continue"""
+        with self.lock:
+            self.replid2 = self.replid
+            self.second_offset = self.offset()
+            self.replid = new_replid()
+
+    def reset(self, replid, offset):
+        """Take over a master's history after a full resync; our own replicas must resync"""
+        with self.lock:
+            self.replid = replid
+            self.replid2 = NO_REPLID
+            self.second_offset = -1
+            self.backlog = Backlog(self.backlog_size, offset)
+            replicas = list(self.replicas)
+        for replica in replicas:
+            replica.close()
+
+    def switch_id(self, replid):
+        """The master continued under a new ID after a failover"""
+        with self.lock:
+            if replid == self.replid:
+                return
+            self.replid2 = self.replid
+            self.second_offset = self.offset()
+            self.replid = replid
+
+
+class Replica:
+    """A replica attached to this server: one thread streams to it, one reads its ACKs"""
+
+    def __init__(self, replication, sock, listening_port, start, on_ack):
+        self.replication = replication
+        self.sock = sock
+        self.ip = sock.getpeername()[0]
+        self.port = listening_port
+        # Stream position sent up to, and the last offset it acknowledged
+        self.sent = start
+        self.ack = 0
+        self.ack_time = time.time()
+        self.on_ack = on_ack
+        self.online = False
+        self.closed = False
+
+    def start(self, preamble):
+        threading.Thread(target=self.__stream, args=(preamble,), daemon=True).start()
+        threading.Thread(target=self.__read_acks, daemon=True).start()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.replication.detach(self)
+
+    def __stream(self, preamble):
+        replication = self.replication
+        try:
+            preamble(self.sock)
+            self.online = True
+            while True:
+                with replication.lock:
+                    while not self.closed and replication.backlog.offset == self.sent:
+                        replication.fed.wait()
+                    if self.closed:
+                        return
+                    data = replication.backlog.read(self.sent)
+                    if data is None:
+                        print(f"Replica {self.ip}:{self.port} fell behind the backlog, dropping it")
+                        break
+                    self.sent = replication.backlog.offset
+                self.sock.sendall(data)
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def __read_acks(self):
+        parser = RequestParser()
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                parser.feed(data)
+                for args in parser.commands():
+                    if len(args) == 3 and args[0].upper() == b"REPLCONF" and args[1].upper() == b"ACK":
+                        self.ack = int(args[2])
+                        self.ack_time = time.time()
+                        self.on_ack()
+        except (OSError, ValueError, ProtocolError):
+            pass
+        finally:
+            self.close()
+
+
+class MasterLink:
+    """A replica's connection to its master, resynced and restarted as long as it runs"""
+
+    def __init__(self, handler, host, port):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        # Commands from the master run on this connection; their replies are dropped
+        self.connection = Connection(None)
+        self.state = "connect"
+        self.last_io = time.time()
+        self.sock = None
+        self.stopped = False
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def stop(self):
+        self.stopped = True
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __run(self):
+        while not self.stopped:
+            try:
+                self.sock = socket.create_connection((self.host, self.port))
+                self.__sync()
+                self.__apply_stream()
+            except (OSError, ProtocolError, ReplicationError, ValueError) as e:
+                if not self.stopped:
+                    print(f"Replication link to {self.host}:{self.port} failed: {e}")
+            finally:
+                self.state = "connect"
+                if self.sock is not None:
+                    self.sock.close()
+            if not self.stopped:
+                time.sleep(RECONNECT_DELAY)
+
+    def __sync(self):
+        self.state = "handshake"
+        self.file = self.sock.makefile("rb")
+        self.__command(b"PING")
+        self.__command(b"REPLCONF", b"listening-port", self.handler.config.get("port").encode())
+        self.__command(b"REPLCONF", b"capa", b"psync2")
+        replication = self.handler.replication
+        if replication.backlog is not None:
+            # Continue from where our copy of the stream ends
+            psync = [b"PSYNC", replication.replid.encode(), b"%d" % (replication.offset() + 1)]
+        else:
+            psync = [b"PSYNC", b"?", b"-1"]
+        self.sock.sendall(encode_command(psync))
+        line = self.__line()
+        if line.startswith(b"+FULLRESYNC"):
+            _, replid, offset = line.split()
+            self.state = "sync"
+            header = self.__line()
+            if not header.startswith(b"$"):
+                raise ReplicationError(f"expected the RDB payload, got {header!r}")
+            payload = self.file.read(int(header[1:]))
+            self.handler.load_full_sync(payload, replid.decode(), int(offset))
+        elif line.startswith(b"+CONTINUE"):
+            parts = line.split()
+            if len(parts) > 1:
+                replication.switch_id(parts[1].decode())
+        else:
+            raise ReplicationError(f"unexpected PSYNC reply {line!r}")
+        self.state = "connected"
+
+    def __apply_stream(self):
+        handler = self.handler
+        replication = handler.replication
+        connection = self.connection
+        parser = RequestParser()
+        while True:
+            data = self.file.read1(65536)
+            if not data:
+                raise ReplicationError("master closed the connection")
+            self.last_io = time.time()
+            parser.feed(data)
+            for args in parser.commands():
+                if args[0].upper() == b"REPLCONF" and len(args) > 1 and args[1].upper() == b"GETACK":
+                    # The ACK covers what came before the GETACK itself
+                    self.sock.sendall(encode_command([b"REPLCONF", b"ACK", b"%d" % replication.offset()]))
+                else:
+                    handler.dispatch(connection, args)
+                    connection.reply.take()
+                replication.feed_raw(encode_command(args))
+
+    def __command(self, *args):
+        self.sock.sendall(encode_command(list(args)))
+        reply = self.__line()
+        if reply.startswith(b"-"):
+            raise ReplicationError(f"master replied {reply.decode(errors='replace')} to {args[0].decode()}")
+
+    def __line(self):
+        line = self.file.readline()
+        if not line:
+            raise ReplicationError("master closed the connection")
+        return line.rstrip(b"\r\n")
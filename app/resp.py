@@ -0,0 +1,268 @@
+class ProtocolError(Exception):
+    pass
+
+
+# Same limits as Redis' proto-max-bulk-len and multibulk length checks
+MAX_BULK_LENGTH = 512 * 1024 * 1024
+MAX_MULTIBULK_LENGTH = 1024 * 1024
+MAX_HEADER_LENGTH = 64 * 1024
+
+
+class RequestParser:
+    """Incremental RESP2 request parser.
+
+    Bytes read from the socket are fed in as they arrive. Every complete
+    command is handed out as its list of arguments, and a partially read
+    command keeps its parsed arguments and bulk count between reads so a
+    large multibulk is never rescanned from the start.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # Arguments of the multibulk currently being read and how many are left
+        self.args = None
+        self.remaining = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def commands(self):
+        """Return the list of complete commands currently buffered"""
+        buffer = self.buffer
+        commands = []
+        pos = 0
+        while pos < len(buffer):
+            if self.args is None:
+                if buffer[pos] != ord("*"):
+                    line_end = buffer.find(b"\n", pos)
+                    if line_end == -1:
+                        if len(buffer) - pos > MAX_HEADER_LENGTH:
+                            raise ProtocolError("too big inline request")
+                        break
+                    # Inline command, as typed into telnet
+                    args = bytes(buffer[pos:line_end]).split()
+                    pos = line_end + 1
+                    if args:
+                        commands.append(args)
+                    continue
+                line_end = self.__find_line_end(buffer, pos)
+                if line_end == -1:
+                    break
+                count = self.__parse_length(buffer[pos + 1:line_end], MAX_MULTIBULK_LENGTH, "multibulk")
+                pos = line_end + 2
+                if count == 0:
+                    continue
+                self.args = []
+                self.remaining = count
+            pos = self.__read_bulks(buffer, pos)
+            if self.remaining:
+                break
+            commands.append(self.args)
+            self.args = None
+        if pos:
+            del buffer[:pos]
+        return commands
+
+    def __read_bulks(self, buffer, pos):
+        """Read as many bulk arguments of the current multibulk as are complete"""
+        args = self.args
+        while self.remaining and pos < len(buffer):
+            if buffer[pos] != ord("$"):
+                raise ProtocolError(f"expected '$', got '{chr(buffer[pos])}'")
+            line_end = self.__find_line_end(buffer, pos)
+            if line_end == -1:
+                break
+            length = self.__parse_length(buffer[pos + 1:line_end], MAX_BULK_LENGTH, "bulk")
+            start = line_end + 2
+            if start + length + 2 > len(buffer):
+                break
+            args.append(bytes(buffer[start:start + length]))
+            pos = start + length + 2
+            self.remaining -= 1
+        return pos
+
+    def __find_line_end(self, buffer, pos):
+        line_end = buffer.find(b"\r\n", pos)
+        if line_end == -1 and len(buffer) - pos > MAX_HEADER_LENGTH:
+            raise ProtocolError("too big header line")
+        return line_end
+
+    def __parse_length(self, raw, limit, kind):
+        try:
+            length = int(raw)
+        except ValueError:
+            raise ProtocolError(f"invalid {kind} length")
+        if length < 0 or length > limit:
+            raise ProtocolError(f"invalid {kind} length")
+        return length
+
+
+CRLF = b"\r\n"
+NULL_BULK = b"$-1\r\n"
+NULL_ARRAY = b"*-1\r\n"
+EMPTY_ARRAY = b"*0\r\n"
+
+# Headers for small lengths and integers are built once and shared, like
+# Redis' shared.mbulkhdr, shared.bulkhdr and shared.integers
+SHARED_HEADERS = 1024
+SHARED_INTEGERS = 10000
+ARRAY_HEADERS = [b"*%d\r\n" % n for n in range(SHARED_HEADERS)]
+BULK_HEADERS = [b"$%d\r\n" % n for n in range(SHARED_HEADERS)]
+INTEGERS = [b":%d\r\n" % n for n in range(SHARED_INTEGERS)]
+
+# Bulk payloads at least this big are passed to the socket as they are
+# instead of being copied into the reply buffer
+LARGE_BULK = 16 * 1024
+
+
+def array_header(length):
+    return ARRAY_HEADERS[length] if length < SHARED_HEADERS else b"*%d\r\n" % length
+
+
+def bulk_header(length):
+    return BULK_HEADERS[length] if length < SHARED_HEADERS else b"$%d\r\n" % length
+
+
+def integer(value):
+    return INTEGERS[value] if 0 <= value < SHARED_INTEGERS else b":%d\r\n" % value
+
+
+def bulk(value):
+    return bulk_header(len(value)) + value + CRLF
+
+
+class Reply:
+    """RESP reply encoder writing into a list of buffers.
+
+    Headers and small payloads are appended to the current bytearray
+    chunk; large bulk payloads are referenced as separate buffers. take()
+    hands the buffers over in order for a scatter-gather sendmsg, so no
+    reply is ever copied into one big bytes object.
+    """
+
+    def __init__(self):
+        self.buffers = []
+        self.chunk = bytearray()
+
+    def write(self, data):
+        """Append already encoded RESP"""
+        if len(data) >= LARGE_BULK:
+            self.__seal()
+            self.buffers.append(data)
+        else:
+            self.chunk += data
+
+    def extend(self, other):
+        """Append everything written to another Reply"""
+        self.__seal()
+        self.buffers.extend(other.take())
+
+    def array(self, length):
+        self.chunk += array_header(length)
+
+    def integer(self, value):
+        self.chunk += integer(value)
+
+    def bulk(self, value):
+        chunk = self.chunk
+        chunk += bulk_header(len(value))
+        if len(value) >= LARGE_BULK:
+            self.__seal()
+            self.buffers.append(value)
+            self.chunk += CRLF
+        else:
+            chunk += value
+            chunk += CRLF
+
+    def bulks(self, values):
+        """Array of bulk strings"""
+        self.chunk += array_header(len(values))
+        for value in values:
+            self.bulk(value)
+
+    def take(self):
+        """Return the buffers written so far and start over"""
+        self.__seal()
+        buffers, self.buffers = self.buffers, []
+        return buffers
+
+    def __seal(self):
+        if self.chunk:
+            self.buffers.append(self.chunk)
+            self.chunk = bytearray()
+
+
+def encode_command(args):
+    """Encode a command as the RESP multibulk a client would send"""
+    parts = [array_header(len(args))]
+    for arg in args:
+        parts += (bulk_header(len(arg)), arg, CRLF)
+    return b"".join(parts)
+
+
+def decode_bulks(data, pos=0):
+    """The bulk strings encoded back to back in data from pos on, as encode_command writes them"""
+    items = []
+    end = len(data)
+    while pos < end:
+        line_end = data.index(CRLF, pos)
+        length = int(data[pos + 1:line_end])
+        pos = line_end + 2
+        items.append(bytes(data[pos:pos + length]))
+        pos += length + 2
+    return items
+
+
+class ReplyReader:
+    """Splits the RESP replies read from a server into whole replies.
+
+    Each reply is handed out as its raw bytes, so it can be relayed to a
+    client unchanged.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def replies(self):
+        """Return the list of complete replies currently buffered"""
+        buffer = self.buffer
+        replies = []
+        pos = 0
+        while pos < len(buffer):
+            end = self.__reply_end(buffer, pos)
+            if end == -1:
+                break
+            replies.append(bytes(buffer[pos:end]))
+            pos = end
+        if pos:
+            del buffer[:pos]
+        return replies
+
+    def __reply_end(self, buffer, pos):
+        """Offset just past the reply starting at pos, or -1 if it is incomplete"""
+        # Values still to read, counting the elements of open arrays
+        pending = 1
+        while pending:
+            line_end = buffer.find(b"\r\n", pos)
+            if line_end == -1:
+                return -1
+            kind = buffer[pos]
+            if kind == ord("$"):
+                length = int(buffer[pos + 1:line_end])
+                pos = line_end + 2
+                if length >= 0:
+                    pos += length + 2
+                    if pos > len(buffer):
+                        return -1
+            elif kind == ord("*"):
+                pending += max(0, int(buffer[pos + 1:line_end]))
+                pos = line_end + 2
+            elif kind in b"+-:":
+                pos = line_end + 2
+            else:
+                raise ProtocolError(f"unexpected reply type '{chr(kind)}'")
+            pending -= 1
+        return pos
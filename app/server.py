@@ -0,0 +1,239 @@
+import collections
+import selectors
+import socket
+import threading
+import time
+
+from app.connection import Connection, send_buffers
+from app.resp import ProtocolError, RequestParser
+
+
+def serve_threads(handler, server_socket):
+    """Thread-per-connection server: every client gets its own blocking socket and thread"""
+    threading.Thread(target=handler.blocking.run_timers, daemon=True).start()
+    threading.Thread(target=run_cron, args=(handler,), daemon=True).start()
+    accept_forever(handler, server_socket)
+
+
+def accept_forever(handler, server_socket):
+    """Serve every client accepted on server_socket in a thread of its own"""
+    while True:
+        connection, _ = server_socket.accept() # wait for client
+        client_thread = threading.Thread(target=handler.handle, args=(connection,), daemon=True)
+        client_thread.start()
+
+
+def run_cron(handler):
+    """Cron thread body for the thread-per-connection server"""
+    while True:
+        time.sleep(1 / int(handler.config.get("hz")))
+        handler.cron()
+
+
+class LoopConnection(Connection):
+    """Connection served by the event loop on a non-blocking socket.
+
+    Replies that the kernel does not accept right away stay in outbuf until
+    the socket becomes writable again. A blocked client stays registered
+    with the loop; the commands it pipelined wait in queue until a writer
+    or the timer heap unblocks it.
+    """
+
+    def __init__(self, sock, loop):
+        super().__init__(sock)
+        self.loop = loop
+        self.parser = RequestParser()
+        # Commands parsed but not yet executed, e.g. pipelined behind a BLPOP
+        self.queue = collections.deque()
+        self.blocked = None
+        self.closing = False
+        self.closed = False
+
+    def flush(self):
+        self.outbuf.extend(self.reply.take())
+        if not self.outbuf or self.closed:
+            return
+        try:
+            while self.outbuf:
+                send_buffers(self.sock, self.outbuf)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.loop.drop(self)
+            return
+        self.loop.want_write(self, bool(self.outbuf))
+
+    def detach(self):
+        # The loop forgets the socket, which goes back to blocking mode
+        self.loop.selector.unregister(self.sock)
+        self.closed = True
+        self.sock.setblocking(True)
+        Connection.flush(self)
+        self.detached = True
+        # Like Redis, connected_clients leaves replicas out
+        self.loop.handler.client_disconnected()
+        return self.sock
+
+    def block(self, waiter):
+        # A writer or ACK on another thread can serve waiter between its
+        # registration and here; its reply is then already handed over
+        with self.loop.handler.blocking.lock:
+            done = waiter.done
+        if done:
+            self.loop.resume_unblocked()
+            return
+        self.blocked = waiter
+
+    def unblock(self, response):
+        # Called from any thread: only the loop thread touches blocked and reply
+        self.loop.unblocked.append((self, response))
+        self.loop.wake()
+
+
+class EventLoop:
+    """Single-threaded server running every connection on one selectors loop"""
+
+    def __init__(self, handler, server_socket):
+        self.handler = handler
+        self.server_socket = server_socket
+        self.selector = selectors.DefaultSelector()
+        # Clients unblocked since the last iteration, resumed after the
+        # current batch of events
+        self.ready = collections.deque()
+        # (connection, reply) of waiters served, by any thread, and not yet
+        # resumed; only the loop thread takes them off
+        self.unblocked = collections.deque()
+        # Written to by other threads to interrupt select(), e.g. when a
+        # replica ACK unblocks a WAIT
+        self.waker, self.waker_writer = socket.socketpair()
+        self.waker.setblocking(False)
+        self.waker_writer.setblocking(False)
+        self.thread_id = None
+        # Connections with replies to send at the end of the iteration, in
+        # order; dict keys so each is flushed once
+        self.replying = {}
+
+    def serve_forever(self):
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        self.selector.register(self.waker, selectors.EVENT_READ, self)
+        self.thread_id = threading.get_ident()
+        next_cron = time.time()
+        while True:
+            deadline = self.handler.blocking.next_deadline()
+            wake_at = next_cron if deadline is None else min(deadline, next_cron)
+            timeout = max(0, wake_at - time.time())
+            for key, events in self.selector.select(timeout):
+                if key.data is None:
+                    self.__accept()
+                    continue
+                if key.data is self:
+                    self.__drain_waker()
+                    continue
+                connection = key.data
+                if events & selectors.EVENT_WRITE:
+                    connection.flush()
+                if events & selectors.EVENT_READ and not connection.closed:
+                    self.__read(connection)
+            now = time.time()
+            if deadline is not None:
+                self.handler.blocking.expire(now)
+            if now >= next_cron:
+                self.handler.cron()
+                next_cron = now + 1 / int(self.handler.config.get("hz"))
+            self.resume_unblocked()
+            while self.ready:
+                self.__run(self.ready.popleft())
+            if self.replying:
+                # One AOF commit covers the writes of every client served
+                # in this iteration, before any of them gets a reply
+                self.handler.commit_writes()
+                replying, self.replying = self.replying, {}
+                for connection in replying:
+                    connection.flush()
+
+    def resume_unblocked(self):
+        """Send the replies of served waiters and queue their clients to run again"""
+        unblocked = self.unblocked
+        while unblocked:
+            connection, response = unblocked.popleft()
+            if connection.closed:
+                continue
+            connection.blocked = None
+            connection.sendall(response)
+            self.ready.append(connection)
+
+    def wake(self):
+        """Interrupt select() if called from another thread"""
+        if threading.get_ident() == self.thread_id:
+            return
+        try:
+            self.waker_writer.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def __drain_waker(self):
+        try:
+            while self.waker.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def want_write(self, connection, enabled):
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if enabled else 0)
+        if self.selector.get_key(connection.sock).events != events:
+            self.selector.modify(connection.sock, events, connection)
+        if not enabled and connection.closing:
+            self.drop(connection)
+
+    def __accept(self):
+        while True:
+            try:
+                sock, _ = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = LoopConnection(sock, self)
+            self.selector.register(sock, selectors.EVENT_READ, connection)
+            self.handler.client_connected()
+
+    def __read(self, connection):
+        try:
+            data = connection.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.drop(connection)
+            return
+        connection.parser.feed(data)
+        try:
+            connection.queue.extend(connection.parser.commands())
+        except ProtocolError as e:
+            connection.sendall(b"-ERR Protocol error: " + str(e).encode() + b"\r\n")
+            connection.closing = True
+            self.replying[connection] = None
+            return
+        self.__run(connection)
+
+    def __run(self, connection):
+        """Execute queued commands until the queue drains or the client blocks"""
+        while connection.queue and connection.blocked is None and not connection.closed:
+            self.handler.dispatch(connection, connection.queue.popleft())
+        self.replying[connection] = None
+
+    def drop(self, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        if connection.blocked is not None:
+            self.handler.blocking.cancel(connection.blocked)
+        self.selector.unregister(connection.sock)
+        connection.close()
+        self.handler.client_disconnected()
+
+
+def serve_event_loop(handler, server_socket):
+    EventLoop(handler, server_socket).serve_forever()
@@ -0,0 +1,59 @@
+import collections
+import itertools
+import time
+
+# Like Redis, an entry keeps at most this many arguments, each cut to this many bytes
+SLOWLOG_ENTRY_MAX_ARGC = 32
+SLOWLOG_ENTRY_MAX_STRING = 128
+
+
+class SlowLogEntry:
+    def __init__(self, entry_id, args, duration_us, client):
+        self.id = entry_id
+        self.timestamp = int(time.time())
+        self.duration_us = duration_us
+        self.args = self.__shorten(args)
+        self.client = client
+
+    @staticmethod
+    def __shorten(args):
+        kept = args[:SLOWLOG_ENTRY_MAX_ARGC]
+        if len(args) > SLOWLOG_ENTRY_MAX_ARGC:
+            # The last slot says how many were left out
+            kept = kept[:-1] + [b"... (%d more arguments)" % (len(args) - SLOWLOG_ENTRY_MAX_ARGC + 1)]
+        return [
+            arg if len(arg) <= SLOWLOG_ENTRY_MAX_STRING
+            else arg[:SLOWLOG_ENTRY_MAX_STRING] + b"... (%d more bytes)" % (len(arg) - SLOWLOG_ENTRY_MAX_STRING)
+            for arg in kept
+        ]
+
+
+class SlowLog:
+    """Ring buffer of the most recent commands that ran longer than the threshold.
+
+    Entries are only built for slow commands, so the cost on the hot path is
+    the duration comparison Handler.dispatch makes. Appending to and
+    clearing the deque are atomic, which is all the locking thread mode needs.
+    """
+
+    def __init__(self, max_len=128):
+        self.entries = collections.deque(maxlen=max_len)
+        self.ids = itertools.count()
+
+    def resize(self, max_len):
+        if max_len != self.entries.maxlen:
+            self.entries = collections.deque(self.entries, maxlen=max_len)
+
+    def add(self, args, duration_us, client):
+        self.entries.appendleft(SlowLogEntry(next(self.ids), args, duration_us, client))
+
+    def latest(self, count):
+        """Up to count entries, newest first; a negative count means all of them"""
+        entries = list(self.entries)
+        return entries if count < 0 else entries[:count]
+
+    def reset(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
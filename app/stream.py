@@ -0,0 +1,251 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+from app.resp import decode_bulks, encode_command
+
+MAX_ID_PART = 2 ** 64 - 1
+MIN_ID = (0, 0)
+MAX_ID = (MAX_ID_PART, MAX_ID_PART)
+
+# Entries per node in Redis' stream radix tree; approximate trims remove whole nodes
+STREAM_NODE_MAX_ENTRIES = 100
+
+
+def parse_id(raw, missing_seq=0):
+    """Parse b"ms-seq" into an (ms, seq) tuple; a bare b"ms" gets missing_seq.
+
+    Raises ValueError for anything that is not a valid stream ID.
+    """
+    ms, sep, seq = raw.partition(b"-")
+    ms = int(ms)
+    seq = int(seq) if sep else missing_seq
+    if not 0 <= ms <= MAX_ID_PART or not 0 <= seq <= MAX_ID_PART:
+        raise ValueError("stream ID out of range")
+    return ms, seq
+
+
+def format_id(entry_id):
+    return b"%d-%d" % entry_id
+
+
+def increment_id(entry_id):
+    """The smallest ID greater than entry_id, or None past the last possible ID"""
+    ms, seq = entry_id
+    if seq < MAX_ID_PART:
+        return ms, seq + 1
+    if ms < MAX_ID_PART:
+        return ms + 1, 0
+    return None
+
+
+def auto_id(last_id, now_ms):
+    """ID for XADD '*': the current time, but never at or below last_id.
+
+    Several entries in the same millisecond, or a clock that went
+    backwards, continue from last_id's sequence number as Redis does.
+    """
+    if now_ms > last_id[0]:
+        return now_ms, 0
+    return increment_id(last_id)
+
+
+def semi_auto_id(last_id, ms):
+    """ID for XADD 'ms-*', or None if ms is behind last_id's time"""
+    if ms > last_id[0]:
+        return ms, 0
+    if ms == last_id[0] and last_id[1] < MAX_ID_PART:
+        # Also turns 0-* on an empty stream into 0-1
+        return ms, last_id[1] + 1
+    return None
+
+
+def unpack_fields(packed):
+    """The field/value list of an entry's packed fields"""
+    return decode_bulks(packed, packed.index(b"\n") + 1)
+
+
+class Stream:
+    """Stream with IDs kept as integers in parallel arrays.
+
+    Entry i has ID (ms[i], seq[i]), and its flat field/value list is
+    packed into fields[i] as one RESP array: a single bytes object per
+    entry, written to replies as it is. IDs only ever grow, so both arrays stay sorted by ID and
+    every lookup is a bisect followed by a walk over the requested window.
+
+    Trimming only moves head past the removed entries and XDEL leaves a
+    None tombstone in fields, so neither shifts the arrays. The dead space
+    is reclaimed in one go once it makes up half of them, which keeps
+    both amortized O(1) per entry removed.
+    """
+
+    def __init__(self):
+        self.ms = array("Q")
+        self.seq = array("Q")
+        self.fields = []
+        self.last_id = MIN_ID
+        # Entries before head are trimmed; deleted counts tombstones from head on
+        self.head = 0
+        self.deleted = 0
+        # Consumer groups by name
+        self.groups = {}
+
+    def __len__(self):
+        return len(self.fields) - self.head - self.deleted
+
+    def append(self, entry_id, fields):
+        """Add an entry and return its packed fields; the caller has checked entry_id > last_id"""
+        packed = encode_command(fields)
+        self.ms.append(entry_id[0])
+        self.seq.append(entry_id[1])
+        self.fields.append(packed)
+        self.last_id = entry_id
+        return packed
+
+    def entries(self):
+        """Every entry with its field/value list unpacked, oldest first"""
+        ms, seq, fields = self.ms, self.seq, self.fields
+        for i in range(self.head, len(fields)):
+            if fields[i] is not None:
+                yield (ms[i], seq[i]), unpack_fields(fields[i])
+
+    def packed(self):
+        """The packed fields of every entry"""
+        return [packed for packed in self.fields[self.head:] if packed is not None]
+
+    def first_id(self):
+        """ID of the oldest entry, or None if the stream is empty"""
+        fields = self.fields
+        for i in range(self.head, len(fields)):
+            if fields[i] is not None:
+                return self.ms[i], self.seq[i]
+        return None
+
+    def top_id(self):
+        """ID of the newest entry, which last_id may be past, or None if the stream is empty"""
+        fields = self.fields
+        for i in range(len(fields) - 1, self.head - 1, -1):
+            if fields[i] is not None:
+                return self.ms[i], self.seq[i]
+        return None
+
+    def get(self, entry_id):
+        """Packed fields of the entry with entry_id, or None if there is none"""
+        i = self.__bisect_left(entry_id)
+        if i < len(self.fields) and self.ms[i] == entry_id[0] and self.seq[i] == entry_id[1]:
+            return self.fields[i]
+        return None
+
+    def delete(self, entry_ids):
+        """Remove the entries with entry_ids, returning their packed fields"""
+        removed = []
+        fields = self.fields
+        for entry_id in entry_ids:
+            i = self.__bisect_left(entry_id)
+            if i < len(fields) and fields[i] is not None and self.ms[i] == entry_id[0] and self.seq[i] == entry_id[1]:
+                removed.append(fields[i])
+                fields[i] = None
+                self.deleted += 1
+        if self.deleted > len(self) and self.deleted >= STREAM_NODE_MAX_ENTRIES:
+            self.__drop_tombstones()
+        return removed
+
+    def trim_maxlen(self, maxlen, approx=False, limit=None):
+        """Remove the oldest entries past the newest maxlen, returning their packed fields"""
+        fields = self.fields
+        excess = len(self) - maxlen
+        end = self.head
+        while excess > 0:
+            if fields[end] is not None:
+                excess -= 1
+            end += 1
+        return self.__trim(end, approx, limit)
+
+    def trim_minid(self, minid, approx=False, limit=None):
+        """Remove the entries with IDs below minid, returning their packed fields"""
+        return self.__trim(self.__bisect_left(minid), approx, limit)
+
+    def __trim(self, end, approx, limit):
+        """Drop the entries from head up to index end.
+
+        An approximate trim keeps whatever is needed to end on a multiple
+        of STREAM_NODE_MAX_ENTRIES and removes at most limit entries, so a
+        capped stream is trimmed a whole node at a time, as Redis drops
+        whole radix tree nodes, rather than on every append.
+        """
+        if approx:
+            if limit is not None:
+                end = min(end, self.head + limit)
+            end -= end % STREAM_NODE_MAX_ENTRIES
+        if end <= self.head:
+            return []
+        removed = self.fields[self.head:end]
+        tombstones = removed.count(None)
+        if tombstones:
+            self.deleted -= tombstones
+            removed = [fields for fields in removed if fields is not None]
+        self.head = end
+        if end * 2 >= len(self.fields):
+            self.__compact()
+        return removed
+
+    def __compact(self):
+        """Free the trimmed entries before head"""
+        head = self.head
+        del self.ms[:head]
+        del self.seq[:head]
+        del self.fields[:head]
+        self.head = 0
+
+    def __drop_tombstones(self):
+        live = [i for i in range(self.head, len(self.fields)) if self.fields[i] is not None]
+        self.ms = array("Q", [self.ms[i] for i in live])
+        self.seq = array("Q", [self.seq[i] for i in live])
+        self.fields = [self.fields[i] for i in live]
+        self.head = 0
+        self.deleted = 0
+
+    def range(self, start, end, count=None):
+        """Entries with start <= ID <= end, oldest first"""
+        return self.__collect(range(self.__bisect_left(start), self.__bisect_right(end)), count)
+
+    def revrange(self, end, start, count=None):
+        """Entries with start <= ID <= end, newest first"""
+        return self.__collect(range(self.__bisect_right(end) - 1, self.__bisect_left(start) - 1, -1), count)
+
+    def after(self, entry_id, count=None):
+        """Entries with an ID strictly greater than entry_id, as XREAD wants"""
+        if entry_id >= self.last_id:
+            return []
+        return self.__collect(range(self.__bisect_right(entry_id), len(self.fields)), count)
+
+    def __collect(self, indexes, count):
+        """The entries at indexes, skipping tombstones, up to count of them"""
+        if not self.deleted:
+            if count is not None:
+                indexes = indexes[:count]
+            return [self.__entry(i) for i in indexes]
+        entries = []
+        fields = self.fields
+        for i in indexes:
+            if fields[i] is not None:
+                entries.append(self.__entry(i))
+                if len(entries) == count:
+                    break
+        return entries
+
+    def __entry(self, i):
+        return (self.ms[i], self.seq[i]), self.fields[i]
+
+    def __bisect_left(self, entry_id):
+        """Index of the first entry with ID >= entry_id"""
+        ms, seq = entry_id
+        lo = bisect_left(self.ms, ms, self.head)
+        hi = bisect_right(self.ms, ms, lo)
+        return bisect_left(self.seq, seq, lo, hi)
+
+    def __bisect_right(self, entry_id):
+        """Index of the first entry with ID > entry_id"""
+        ms, seq = entry_id
+        lo = bisect_left(self.ms, ms, self.head)
+        hi = bisect_right(self.ms, ms, lo)
+        return bisect_right(self.seq, seq, lo, hi)
@@ -0,0 +1,59 @@
+import math
+
+# Integers in this range are stored as one shared int object each, like
+# Redis' shared integers; larger ones still take less room as ints than as bytes
+SHARED_INTEGERS = 10000
+SHARED = list(range(SHARED_INTEGERS))
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def compact_string(value):
+    """The representation a string value is stored as: an int if it reads as one, as Redis' int encoding"""
+    number = parse_int64(value)
+    return value if number is None else stored_integer(number)
+
+
+def parse_int64(value):
+    """value as an int if it is the canonical spelling of a 64-bit integer, else None"""
+    if 0 < len(value) <= 20 and 48 <= value[-1] <= 57:
+        try:
+            number = int(value)
+        except ValueError:
+            return None
+        # Only the canonical spelling round-trips: no sign, zero padding, spaces or underscores
+        if INT64_MIN <= number <= INT64_MAX and b"%d" % number == value:
+            return number
+    return None
+
+
+def stored_integer(number):
+    """The object an integer value is stored as, shared for small ones"""
+    return SHARED[number] if 0 <= number < SHARED_INTEGERS else number
+
+
+def parse_float(value):
+    """value as a finite float, or None; unlike float(), spaces and underscores are refused"""
+    if not value or value[0] in b" \t\r\n" or value[-1] in b" \t\r\n" or b"_" in value:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return number if math.isfinite(number) else None
+
+
+def format_float(value):
+    """A float as INCRBYFLOAT replies it: plain decimal notation, no trailing zeros"""
+    text = repr(value)
+    if "e" in text:
+        text = f"{value:.17f}"
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    return text.encode()
+
+
+def string_bytes(value):
+    """A stored string value as bytes"""
+    return value if value.__class__ is bytes else b"%d" % value
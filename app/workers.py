@@ -0,0 +1,159 @@
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import zlib
+
+from app.handler import Handler
+from app.resp import ReplyReader, encode_command
+from app.server import accept_forever, serve_threads
+
+CROSSSLOT_ERROR = b"-CROSSSLOT Keys in request don't hash to the same slot\r\n"
+
+# Router.owner() result for a command whose keys live in different workers
+CROSS_WORKER = -1
+
+
+def partition(key, count):
+    """Index of the worker that owns key; crc32 gives every process the same answer"""
+    return zlib.crc32(key) % count
+
+
+class Peer:
+    """One client connection's link to another worker, over its Unix socket"""
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.reader = ReplyReader()
+
+    def request(self, commands):
+        """Send a batch of commands and return their raw replies, in order"""
+        self.sock.sendall(b"".join(encode_command(args) for args in commands))
+        replies = []
+        while len(replies) < len(commands):
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("worker closed the connection")
+            self.reader.feed(data)
+            replies += self.reader.replies()
+        return replies
+
+    def close(self):
+        self.sock.close()
+
+
+class Router:
+    """Runs each command in the worker that owns its keys.
+
+    Commands on this worker's keys and commands without keys are
+    dispatched locally. Consecutive commands owned by the same other
+    worker are forwarded to it as one pipelined batch and their replies
+    relayed in order. As in Redis Cluster, a command whose keys belong to
+    different workers is refused.
+    """
+
+    def __init__(self, handler, index, paths):
+        self.handler = handler
+        self.index = index
+        self.paths = paths
+
+    def owner(self, args):
+        """Worker that must run a command, None if any worker can"""
+        command = self.handler.commands.get(args[0].lower())
+        # Unknown commands and arity errors are answered locally
+        if command is None or not command.check_arity(len(args)):
+            return None
+        owners = {partition(key, len(self.paths)) for key in command.keys(args)}
+        if not owners:
+            return None
+        if len(owners) > 1:
+            return CROSS_WORKER
+        return owners.pop()
+
+    def execute(self, connection, commands, peers):
+        """Run a batch of commands from connection; peers holds its links to other workers"""
+        batch = []
+        batch_owner = None
+        for args in commands:
+            owner = self.owner(args)
+            if owner not in (None, CROSS_WORKER, self.index):
+                if owner != batch_owner:
+                    self.__forward(connection, batch_owner, batch, peers)
+                    batch, batch_owner = [], owner
+                batch.append(args)
+                continue
+            self.__forward(connection, batch_owner, batch, peers)
+            batch, batch_owner = [], None
+            if owner == CROSS_WORKER:
+                connection.sendall(CROSSSLOT_ERROR)
+            else:
+                self.handler.dispatch(connection, args)
+        self.__forward(connection, batch_owner, batch, peers)
+
+    def __forward(self, connection, owner, batch, peers):
+        if not batch:
+            return
+        peer = peers.get(owner)
+        if peer is None:
+            peer = peers[owner] = Peer(self.paths[owner])
+        for reply in peer.request(batch):
+            connection.sendall(reply)
+
+
+def serve_workers(config):
+    """Fork the configured number of workers, all accepting on the same port.
+
+    Each worker binds its own SO_REUSEPORT socket so the kernel spreads
+    new connections across them, and listens on a Unix socket for
+    commands forwarded by the others. The parent only waits: once one
+    worker exits the keys it owned are gone, so the rest are stopped too.
+    """
+    count = int(config.get("workers"))
+    socket_dir = tempfile.mkdtemp(prefix="redis-workers-")
+    paths = [os.path.join(socket_dir, f"worker-{index}.sock") for index in range(count)]
+    # Every forwarding socket exists before any worker can forward to it
+    listeners = []
+    for path in paths:
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen()
+        listeners.append(listener)
+    children = []
+    try:
+        for index in range(count):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    run_worker(config, index, paths, listeners)
+                finally:
+                    os._exit(1)
+            children.append(pid)
+        for listener in listeners:
+            listener.close()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        os.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+def run_worker(config, index, paths, listeners):
+    for other, listener in enumerate(listeners):
+        if other != index:
+            listener.close()
+    server_socket = socket.create_server(("localhost", int(config.get("port"))), reuse_port=True)
+    handler = Handler(config)
+    handler.router = Router(handler, index, paths)
+    handler.load_snapshot(owns=lambda key: partition(key, len(paths)) == index)
+    threading.Thread(target=accept_forever, args=(handler, listeners[index]), daemon=True).start()
+    serve_threads(handler, server_socket)
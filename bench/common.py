@@ -0,0 +1,91 @@
+"""RESP client helpers shared by the benchmarks"""
+import json
+import os
+import platform
+import socket
+import subprocess
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def encode(*args):
+    out = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(out)
+
+
+def reply_end(buffer, pos):
+    """End of the reply at pos, arrays included, or -1 if it is incomplete"""
+    if pos >= len(buffer):
+        return -1
+    line_end = buffer.find(b"\r\n", pos)
+    if line_end == -1:
+        return -1
+    kind = buffer[pos]
+    if kind == ord("$"):
+        length = int(buffer[pos + 1:line_end])
+        end = line_end + 2 + (length + 2 if length >= 0 else 0)
+        return end if end <= len(buffer) else -1
+    if kind == ord("*"):
+        count = int(buffer[pos + 1:line_end])
+        pos = line_end + 2
+        for _ in range(count):
+            pos = reply_end(buffer, pos)
+            if pos == -1:
+                return -1
+        return pos
+    return line_end + 2
+
+
+def read_replies(sock, count, buffer):
+    """Read count replies off sock, keeping any extra bytes in buffer"""
+    pos = 0
+    while count:
+        end = reply_end(buffer, pos)
+        if end == -1:
+            del buffer[:pos]
+            pos = 0
+            data = sock.recv(1 << 20)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            buffer += data
+            continue
+        pos = end
+        count -= 1
+    del buffer[:pos]
+
+
+def wait_for_port(port, host="localhost", timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def write_results(path, config, results):
+    """Save a run as JSON, with what is needed to compare it against later runs"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    document = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "results": results,
+    }
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(document, file, indent=2)
+        file.write("\n")
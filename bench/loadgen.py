@@ -0,0 +1,206 @@
+"""Loopback load generator taking redis-benchmark's main options.
+
+Runs each test against a server that is already up, spreading the client
+connections over a few processes that each drive theirs from a selector,
+and reports ops/sec and p50/p99/p99.9 latency per test:
+
+    python bench/loadgen.py -c 50 -n 100000 -P 16 -d 64 -t set,get,lpush,lpop
+    python bench/loadgen.py -q -r 100000 --json results/loadgen.json
+
+A request's latency runs from sending the pipelined batch it belongs to
+until its own reply is read, as redis-benchmark measures it.
+"""
+import argparse
+import array
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import time
+
+from common import encode, reply_end, write_results
+
+TESTS = ["ping", "set", "get", "incr", "hset", "lpush", "rpush", "lpop", "lrange_100", "xadd", "xrange", "xread"]
+
+RAND_INT = b"__rand_int__"
+
+
+def test_command(test, value):
+    """The command a test sends, with __rand_int__ where a random number goes"""
+    key = b"key:" + RAND_INT
+    return {
+        "ping": [b"PING"],
+        "set": [b"SET", key, value],
+        "get": [b"GET", key],
+        "incr": [b"INCR", b"counter:" + RAND_INT],
+        "hset": [b"HSET", b"myhash", b"element:" + RAND_INT, value],
+        "lpush": [b"LPUSH", b"mylist", value],
+        "rpush": [b"RPUSH", b"mylist", value],
+        "lpop": [b"LPOP", b"mylist"],
+        "lrange_100": [b"LRANGE", b"mylist", b"0", b"99"],
+        "xadd": [b"XADD", b"mystream", b"*", b"myfield", value],
+        "xrange": [b"XRANGE", b"mystream", b"-", b"+", b"COUNT", b"10"],
+        "xread": [b"XREAD", b"COUNT", b"10", b"STREAMS", b"mystream", b"0-0"],
+    }[test]
+
+
+class Client:
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = bytearray()
+        self.pending = 0
+        self.sent_at = 0
+
+
+def drive(host, port, connections, requests, pipeline, command, keyspace, results):
+    """Send requests commands over connections and put (elapsed, latencies in us) on results"""
+    rng = random.Random(os.getpid())
+    # Without -r every request uses key 0, as in redis-benchmark
+    fixed = encode(*[arg.replace(RAND_INT, b"%012d" % 0) for arg in command])
+    randomized = keyspace is not None and any(RAND_INT in arg for arg in command)
+
+    def batch(count):
+        if not randomized:
+            return fixed * count
+        return b"".join(
+            encode(*[arg.replace(RAND_INT, b"%012d" % rng.randrange(keyspace)) for arg in command])
+            for _ in range(count)
+        )
+
+    selector = selectors.DefaultSelector()
+    clients = [Client(host, port) for _ in range(connections)]
+    latencies = array.array("Q")
+    unsent = requests
+    start = time.perf_counter()
+
+    def send(client):
+        nonlocal unsent
+        count = min(pipeline, unsent)
+        if not count:
+            return
+        unsent -= count
+        client.pending = count
+        client.sent_at = time.perf_counter()
+        # Sockets stay blocking: a batch fits the socket buffers, and replies
+        # are only read once the selector says they are there
+        client.sock.sendall(batch(count))
+
+    for client in clients:
+        selector.register(client.sock, selectors.EVENT_READ, client)
+        send(client)
+    done = 0
+    while done < requests:
+        for key, _ in selector.select():
+            client = key.data
+            data = client.sock.recv(1 << 20)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            client.buffer += data
+            now = time.perf_counter()
+            pos = 0
+            while client.pending:
+                end = reply_end(client.buffer, pos)
+                if end == -1:
+                    break
+                pos = end
+                client.pending -= 1
+                done += 1
+                latencies.append(int((now - client.sent_at) * 1e6))
+            del client.buffer[:pos]
+            if not client.pending:
+                send(client)
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.sock.close()
+    results.put((elapsed, latencies.tobytes()))
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_test(test, args):
+    command = test_command(test, b"x" * args.data_size)
+    processes = min(args.clients, args.processes)
+    results = multiprocessing.Queue()
+    workers = []
+    for i in range(processes):
+        # Spread connections and requests evenly, the first processes taking the remainders
+        connections = args.clients // processes + (i < args.clients % processes)
+        requests = args.requests // processes + (i < args.requests % processes)
+        workers.append(multiprocessing.Process(
+            target=drive,
+            args=(args.host, args.port, connections, requests, args.pipeline, command, args.keyspace, results),
+        ))
+    for worker in workers:
+        worker.start()
+    elapsed = 0
+    latencies = array.array("Q")
+    for _ in workers:
+        worker_elapsed, data = results.get()
+        elapsed = max(elapsed, worker_elapsed)
+        latencies.frombytes(data)
+    for worker in workers:
+        worker.join()
+    ordered = sorted(latencies)
+    return {
+        "test": test,
+        "requests": len(ordered),
+        "seconds": round(elapsed, 3),
+        "ops_per_sec": round(len(ordered) / elapsed, 2),
+        "p50_ms": percentile(ordered, 0.50) / 1000,
+        "p99_ms": percentile(ordered, 0.99) / 1000,
+        "p999_ms": percentile(ordered, 0.999) / 1000,
+        "max_ms": ordered[-1] / 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0], add_help=False)
+    parser.add_argument("--help", action="help")
+    parser.add_argument("-h", dest="host", default="localhost")
+    parser.add_argument("-p", dest="port", type=int, default=6379)
+    parser.add_argument("-c", dest="clients", type=int, default=50, help="parallel connections")
+    parser.add_argument("-n", dest="requests", type=int, default=100000, help="requests per test")
+    parser.add_argument("-d", dest="data_size", type=int, default=3, help="value size in bytes")
+    parser.add_argument("-P", dest="pipeline", type=int, default=1, help="requests per pipelined batch")
+    parser.add_argument("-r", dest="keyspace", type=int, help="use random keys out of this many")
+    parser.add_argument("-t", dest="tests", default=",".join(TESTS), help="comma-separated tests to run")
+    parser.add_argument("-q", dest="quiet", action="store_true", help="only show ops/sec and p50")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="client processes")
+    parser.add_argument("--json", dest="output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    tests = [test.strip().lower() for test in args.tests.split(",") if test.strip()]
+    unknown = [test for test in tests if test not in TESTS]
+    if unknown:
+        parser.error(f"unknown tests {', '.join(unknown)}; choose from {', '.join(TESTS)}")
+
+    results = []
+    for test in tests:
+        result = run_test(test, args)
+        results.append(result)
+        name = test.upper()
+        if args.quiet:
+            print(f"{name}: {result['ops_per_sec']:.2f} requests per second, p50={result['p50_ms']:.3f} msec")
+            continue
+        print(f"====== {name} ======")
+        print(f"  {result['requests']} requests completed in {result['seconds']:.2f} seconds")
+        print(f"  {args.clients} parallel clients, {args.data_size} bytes payload, pipeline {args.pipeline}")
+        print(
+            f"  latency (msec): p50={result['p50_ms']:.3f} p99={result['p99_ms']:.3f} "
+            f"p99.9={result['p999_ms']:.3f} max={result['max_ms']:.3f}"
+        )
+        print(f"  throughput: {result['ops_per_sec']:.2f} requests per second\n", flush=True)
+    if args.output:
+        config = {
+            "clients": args.clients, "requests": args.requests, "data_size": args.data_size,
+            "pipeline": args.pipeline, "keyspace": args.keyspace, "processes": args.processes,
+        }
+        write_results(args.output, config, results)
+
+
+if __name__ == "__main__":
+    main()
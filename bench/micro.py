@@ -0,0 +1,202 @@
+"""Micro-benchmarks of the RESP codec and the command handlers, run in-process.
+
+Commands go straight through Handler.dispatch on a connection without a
+socket, so the numbers cover parsing, the handlers and reply encoding
+but no network I/O:
+
+    python bench/micro.py
+    python bench/micro.py -k xadd -k xrange --json results/micro.json
+"""
+import argparse
+import sys
+import time
+
+from common import ROOT, encode, write_results
+
+sys.path.insert(0, ROOT)
+
+from app.connection import Connection  # noqa: E402
+from app.handler import Handler  # noqa: E402
+from app.hashes import HASHPACK_MAX_ENTRIES  # noqa: E402
+from app.resp import Reply, RequestParser, encode_command  # noqa: E402
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def commands(handler, connection, batch):
+    """A step running the commands in batch, dropping their replies"""
+    dispatch = handler.dispatch
+    reply = connection.reply
+
+    def step():
+        for args in batch:
+            dispatch(connection, args)
+        reply.take()
+    return step, len(batch)
+
+
+def keys(count):
+    return [b"key:%012d" % i for i in range(count)]
+
+
+# Each benchmark gets a fresh handler and returns (step, operations per step)
+
+@benchmark("resp_parse_set")
+def resp_parse_set(handler, connection, value):
+    data = b"".join(encode(b"SET", key, value) for key in keys(1000))
+    parser = RequestParser()
+
+    def step():
+        parser.feed(data)
+        parser.commands()
+    return step, 1000
+
+
+@benchmark("resp_encode_bulks")
+def resp_encode_bulks(handler, connection, value):
+    values = [value] * 10
+
+    def step():
+        reply = Reply()
+        for _ in range(100):
+            reply.bulks(values)
+        reply.take()
+    return step, 100
+
+
+@benchmark("resp_encode_command")
+def resp_encode_command(handler, connection, value):
+    args = [b"SET", b"key:000000000000", value]
+
+    def step():
+        for _ in range(100):
+            encode_command(args)
+    return step, 100
+
+
+@benchmark("set")
+def set_(handler, connection, value):
+    return commands(handler, connection, [[b"SET", key, value] for key in keys(1000)])
+
+
+@benchmark("get")
+def get(handler, connection, value):
+    batch = [[b"SET", key, value] for key in keys(1000)]
+    commands(handler, connection, batch)[0]()
+    return commands(handler, connection, [[b"GET", key] for key in keys(1000)])
+
+
+@benchmark("incr")
+def incr(handler, connection, value):
+    return commands(handler, connection, [[b"INCR", key] for key in keys(1000)])
+
+
+@benchmark("hset")
+def hset(handler, connection, value):
+    return commands(handler, connection, [[b"HSET", b"myhash:%d" % (i % 10), key, value] for i, key in enumerate(keys(1000))])
+
+
+@benchmark("hget_full_pack")
+def hget_full_pack(handler, connection, value):
+    # The most fields a hash keeps packed, each looked up in turn
+    fields = [b"field:%d" % i for i in range(HASHPACK_MAX_ENTRIES)]
+    commands(handler, connection, [[b"HSET", b"myhash", field, value] for field in fields])[0]()
+    return commands(handler, connection, [[b"HGET", b"myhash", field] for field in fields] * 8)
+
+
+@benchmark("hset_full_pack")
+def hset_full_pack(handler, connection, value):
+    # Updates alternate the value's length, so every later field moves
+    fields = [b"field:%d" % i for i in range(HASHPACK_MAX_ENTRIES)]
+    longer = value + b"x"
+    return commands(handler, connection, [[b"HSET", b"myhash", field, v] for v in (value, longer) for field in fields] * 4)
+
+
+@benchmark("lpush")
+def lpush(handler, connection, value):
+    return commands(handler, connection, [[b"LPUSH", b"mylist", value]] * 1000)
+
+
+@benchmark("lpush_lpop")
+def lpush_lpop(handler, connection, value):
+    # Pairs keep the list's length, and so its encoding, steady
+    return commands(handler, connection, [[b"LPUSH", b"mylist", value], [b"LPOP", b"mylist"]] * 500)
+
+
+@benchmark("lrange_100")
+def lrange_100(handler, connection, value):
+    commands(handler, connection, [[b"RPUSH", b"mylist", value]] * 100)[0]()
+    return commands(handler, connection, [[b"LRANGE", b"mylist", b"0", b"99"]] * 100)
+
+
+@benchmark("xadd")
+def xadd(handler, connection, value):
+    return commands(handler, connection, [[b"XADD", b"mystream", b"*", b"myfield", value]] * 1000)
+
+
+@benchmark("xrange_10")
+def xrange_10(handler, connection, value):
+    commands(handler, connection, [[b"XADD", b"mystream", b"*", b"myfield", value]] * 10000)[0]()
+    return commands(handler, connection, [[b"XRANGE", b"mystream", b"-", b"+", b"COUNT", b"10"]] * 1000)
+
+
+@benchmark("xread_10")
+def xread_10(handler, connection, value):
+    batch = [[b"XADD", b"mystream", b"%d-1" % ms, b"myfield", value] for ms in range(1, 10001)]
+    commands(handler, connection, batch)[0]()
+    # Reads from the middle of the stream, so each one has to find its start
+    return commands(
+        handler, connection,
+        [[b"XREAD", b"COUNT", b"10", b"STREAMS", b"mystream", b"%d-0" % ms] for ms in range(1, 10001, 10)]
+    )
+
+
+def measure(setup, value, min_time, repeat):
+    """Best ops/sec of repeat runs, each of at least min_time seconds"""
+    best = 0
+    for _ in range(repeat):
+        step, operations = setup(Handler(), Connection(None), value)
+        step()
+        count = 0
+        start = time.perf_counter()
+        while True:
+            step()
+            count += operations
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, count / elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-k", dest="filters", action="append", help="only run benchmarks whose name contains this")
+    parser.add_argument("-d", dest="data_size", type=int, default=3, help="value size in bytes")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds per run")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark; the best one counts")
+    parser.add_argument("--json", dest="output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    value = b"x" * args.data_size
+    results = []
+    for name, setup in BENCHMARKS.items():
+        if args.filters and not any(text in name for text in args.filters):
+            continue
+        ops_per_sec = measure(setup, value, args.min_time, args.repeat)
+        results.append({"benchmark": name, "ops_per_sec": round(ops_per_sec, 2), "ns_per_op": round(1e9 / ops_per_sec, 1)})
+        print(f"{name:<22} {ops_per_sec:>14,.0f} ops/sec {1e9 / ops_per_sec:>10,.0f} ns/op", flush=True)
+    if args.output:
+        config = {"data_size": args.data_size, "min_time": args.min_time, "repeat": args.repeat}
+        write_results(args.output, config, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Throughput of --workers mode against the number of worker processes.
+
+Starts the server once per worker count and drives it with client
+processes that pipeline SET/GET on random keys, then prints ops/sec:
+
+    python bench/workers_scaling.py --workers 1 2 4 8 --clients 16
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from common import ROOT, encode, read_replies, wait_for_port
+
+
+def client(port, duration, pipeline, keyspace, value_size, results):
+    sock = socket.create_connection(("localhost", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    value = b"x" * value_size
+    rng = random.Random(os.getpid())
+    buffer = bytearray()
+    ops = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        batch = []
+        for _ in range(pipeline):
+            key = b"key:%d" % rng.randrange(keyspace)
+            batch.append(encode(b"SET", key, value) if rng.random() < 0.5 else encode(b"GET", key))
+        sock.sendall(b"".join(batch))
+        read_replies(sock, pipeline, buffer)
+        ops += pipeline
+    sock.close()
+    results.put(ops)
+
+
+def run(workers, args):
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.main", "--port", str(args.port), "--workers", str(workers)],
+        cwd=ROOT, stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(args.port)
+        # Let every worker bind its socket before the clients connect
+        time.sleep(0.5)
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(
+                target=client, args=(args.port, args.duration, args.pipeline, args.keyspace, args.value_size, results)
+            )
+            for _ in range(args.clients)
+        ]
+        for process in clients:
+            process.start()
+        ops = sum(results.get() for _ in clients)
+        for process in clients:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return ops / args.duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--pipeline", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--keyspace", type=int, default=100000)
+    parser.add_argument("--value-size", type=int, default=32)
+    parser.add_argument("--port", type=int, default=6399)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for workers in args.workers:
+        ops_per_sec = run(workers, args)
+        results.append({"workers": workers, "ops_per_sec": round(ops_per_sec)})
+        if not args.json:
+            print(f"workers={workers:<4} {ops_per_sec:>12,.0f} ops/sec", flush=True)
+    if args.json:
+        print(json.dumps({"clients": args.clients, "pipeline": args.pipeline, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()